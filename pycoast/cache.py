@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pycoast, Writing of coastlines, borders and rivers to images in Python
+#
+# Copyright (C) 2011-2016
+#    Esben S. Nielsen
+#    Hróbjartur Þorsteinsson
+#    Stefano Cerino
+#    Katja Hungershofer
+#    Panu Lahtinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Caches used by the contour writers.
+"""
+
+from collections import OrderedDict, namedtuple
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pyproj
+
+from .display import DisplayList
+
+logger = logging.getLogger(__name__)
+
+CacheInfo = namedtuple('CacheInfo',
+                       ['hits', 'misses', 'evictions', 'nbytes', 'max_bytes',
+                        'items'])
+
+
+class ShapeCache(object):
+
+    """Memory bounded LRU cache for loaded shape datasets. The cache can be
+    shared between threads.
+
+    :Parameters:
+    max_bytes : int
+        Byte budget of the cache. Least recently used items are evicted
+        when it is exceeded. Items larger than the budget are not cached.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        """Return the item stored under *key*, or None on a miss.
+        """
+        with self._lock:
+            try:
+                value, nbytes = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Re-insert to mark as most recently used
+            self._items[key] = (value, nbytes)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, nbytes):
+        """Store *value* of size *nbytes* under *key*.
+        """
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            if nbytes > self.max_bytes:
+                logger.debug("Not caching %s, %d bytes exceeds cache size",
+                             str(key), nbytes)
+                return
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                old_key, (old_value, old_nbytes) = \
+                    self._items.popitem(last=False)
+                self.nbytes -= old_nbytes
+                self.evictions += 1
+                logger.debug("Evicted %s from shape cache", str(old_key))
+
+    def clear(self):
+        """Remove all items and reset the counters.
+        """
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        """Return cache statistics as a CacheInfo tuple.
+        """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.nbytes, self.max_bytes, len(self._items))
+
+
+class PixelCache(object):
+
+    """Directory of projected pixel geometry, one compressed numpy file per
+    key. Files are written to a temporary file and renamed, so concurrent
+    readers, also in other processes, never see a partial file. When the
+    directory grows beyond its byte budget, the least recently used files
+    are removed.
+
+    :Parameters:
+    cache_dir : str
+        Directory of the cache files, created if missing
+    max_bytes : int
+        Byte budget of the cache directory
+    """
+
+    suffix = '.npz'
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Created concurrently
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    @staticmethod
+    def make_key(*parts):
+        """Return a file name safe hash of *parts*
+        """
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        """Return the DisplayList stored under *key*, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                display_list = DisplayList(data['codes'], data['offsets'],
+                                           data['coords'])
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        except (ValueError, KeyError) as err:
+            logger.warning("Removing corrupt pixel cache file %s: %s",
+                           path, str(err))
+            self._remove(path)
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            # Mark as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return display_list
+
+    def put(self, key, display_list):
+        """Store *display_list* under *key*.
+        """
+        if display_list.nbytes > self.max_bytes:
+            logger.debug("Not caching %s, %d bytes exceeds cache size",
+                         key, display_list.nbytes)
+            return
+        fid, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fid, 'wb') as tmp_file:
+                np.savez_compressed(tmp_file, codes=display_list.codes,
+                                    offsets=display_list.offsets,
+                                    coords=display_list.coords)
+            os.rename(tmp_path, self._path(key))
+        except (IOError, OSError) as err:
+            logger.warning("Could not write pixel cache file: %s", str(err))
+            self._remove(tmp_path)
+            return
+        self._evict()
+
+    def _files(self):
+        """Return (mtime, size, path) of the cache files, oldest first
+        """
+        files = []
+        for path in glob.glob(os.path.join(self.cache_dir,
+                                           '*' + self.suffix)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return sorted(files)
+
+    def _evict(self):
+        files = self._files()
+        nbytes = sum(size for mtime, size, path in files)
+        for mtime, size, path in files:
+            if nbytes <= self.max_bytes:
+                break
+            self._remove(path)
+            nbytes -= size
+            with self._lock:
+                self.evictions += 1
+            logger.debug("Evicted %s from pixel cache", path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        """Remove all files and reset the counters.
+        """
+        for mtime, size, path in self._files():
+            self._remove(path)
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        """Return cache statistics as a CacheInfo tuple.
+        """
+        files = self._files()
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             sum(size for mtime, size, path in files),
+                             self.max_bytes, len(files))
+
+
+ProjCacheInfo = namedtuple('ProjCacheInfo',
+                           ['hits', 'misses', 'items', 'build_time',
+                            'saved_time'])
+
+
+class ProjCache(object):
+
+    """Thread safe LRU cache of projection objects keyed by their
+    normalized proj4 string.
+
+    :Parameters:
+    max_items : int
+        Number of projections to keep
+    """
+
+    def __init__(self, max_items=128):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.build_time = 0.0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, factory):
+        """Return the object stored under *key*, building it with
+        *factory()* on a miss.
+        """
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+                self.hits += 1
+                return value
+        # Build outside the lock, a concurrent miss builds it twice at worst
+        start = time.time()
+        value = factory()
+        elapsed = time.time() - start
+        with self._lock:
+            self.misses += 1
+            self.build_time += elapsed
+            self._items[key] = value
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        """Remove all items and reset the counters.
+        """
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+            self.build_time = 0.0
+
+    def info(self):
+        """Return cache statistics as a ProjCacheInfo tuple. The saved time
+        is the mean build time of the misses times the number of hits.
+        """
+        with self._lock:
+            if self.misses:
+                saved_time = self.hits * self.build_time / self.misses
+            else:
+                saved_time = 0.0
+            return ProjCacheInfo(self.hits, self.misses, len(self._items),
+                                 self.build_time, saved_time)
+
+
+def normalize_proj4(proj4_string):
+    """Return a canonical form of a proj4 string, with the parameters
+    sorted and surplus whitespace removed. The order of the steps of
+    pipelines is kept.
+    """
+    params = proj4_string.split()
+    if '+step' in params:
+        return ' '.join(params)
+    return ' '.join(sorted(params))
+
+
+def _version_tuple(version):
+    """Return the leading numbers of a version string as a tuple
+    """
+    numbers = []
+    for part in version.split('.'):
+        digits = ''
+        for char in part:
+            if not char.isdigit():
+                break
+            digits += char
+        if not digits:
+            break
+        numbers.append(int(digits))
+    return tuple(numbers)
+
+
+# Projections can be shared between threads from pyproj 3.1 on
+PROJ_THREAD_SAFE = _version_tuple(pyproj.__version__) >= (3, 1)
+
+_proj_cache = ProjCache()
+
+
+def get_proj(proj4_string):
+    """Return a pyproj.Proj for *proj4_string* from the shared projection
+    cache. With pyproj versions whose projections are not thread safe, each
+    thread gets its own.
+    """
+    key = ('proj', normalize_proj4(proj4_string))
+    if not PROJ_THREAD_SAFE:
+        key += (threading.current_thread().ident,)
+    return _proj_cache.get(key, lambda: pyproj.Proj(proj4_string))
+
+
+def proj_cache_info():
+    """Return hit/miss and timing statistics of the shared projection cache
+    """
+    return _proj_cache.info()
+
+
+def clear_proj_cache():
+    """Empty the shared projection cache
+    """
+    _proj_cache.clear()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pycoast, Writing of coastlines, borders and rivers to images in Python
+#
+# Copyright (C) 2011-2016
+#    Esben S. Nielsen
+#    Hróbjartur Þorsteinsson
+#    Stefano Cerino
+#    Katja Hungershofer
+#    Panu Lahtinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Index of the cities database used by :meth:`add_cities`.
+"""
+
+import os
+
+import numpy as np
+
+from .errors import ShapeFileError
+from .geometry import BBoxIndex, read_points
+
+# Columns of the cities attribute table
+NAME_FIELD = 3
+POPULATION_FIELDS = ('pop', 'population')
+
+
+class DbfTable(object):
+
+    """Memory mapped dBase table of a shapefile. Columns are decoded on
+    request only.
+
+    :Parameters:
+    filename : str
+        Path of the .dbf file
+    """
+
+    def __init__(self, filename):
+        try:
+            with open(filename, 'rb') as fid:
+                header = fid.read(32)
+                n_records = int(np.frombuffer(header[4:8], '<u4')[0])
+                header_size, record_size = np.frombuffer(header[8:12], '<u2')
+                n_fields = (int(header_size) - 33) // 32
+                descriptors = fid.read(32 * n_fields)
+        except (IOError, OSError, ValueError, IndexError):
+            raise ShapeFileError('Could not read dbf file %s' % filename)
+
+        self.fields = []
+        dtype = [('deletion_flag', 'S1')]
+        for i in range(n_fields):
+            descriptor = descriptors[32 * i:32 * (i + 1)]
+            name = descriptor[:11].split(b'\0')[0].decode('ascii', 'replace')
+            field_type = descriptor[11:12].decode('ascii', 'replace')
+            size = descriptor[16] if isinstance(descriptor[16], int) else \
+                ord(descriptor[16])
+            self.fields.append((name.strip(), field_type, size))
+            dtype.append(('f%d' % i, 'S%d' % size))
+        dtype = np.dtype(dtype)
+        if dtype.itemsize != record_size:
+            raise ShapeFileError('Inconsistent record size in dbf file %s'
+                                 % filename)
+        if n_records > 0:
+            self._records = np.memmap(filename, dtype=dtype, mode='r',
+                                      offset=int(header_size),
+                                      shape=(n_records,))
+        else:
+            self._records = np.zeros(0, dtype=dtype)
+
+    def __len__(self):
+        return len(self._records)
+
+    @property
+    def deleted(self):
+        """Mask of the deleted records
+        """
+        return self._records['deletion_flag'] != b' '
+
+    def column(self, field, ids=None):
+        """Return the raw, stripped bytes of a column, optionally for the
+        records *ids* only
+        """
+        values = self._records['f%d' % field]
+        if ids is not None:
+            values = values[ids]
+        return np.char.strip(np.asarray(values))
+
+    def text_column(self, field, ids=None):
+        """Return a column as a list of strings
+        """
+        return [value.decode('utf-8', 'replace')
+                for value in self.column(field, ids)]
+
+    def numeric_column(self, field, ids=None):
+        """Return a column as a float array, with NaN for empty values
+        """
+        values = np.char.replace(self.column(field, ids), b'*', b'')
+        values = np.where(values == b'', b'nan', values)
+        try:
+            return values.astype(np.float64)
+        except ValueError:
+            raise ShapeFileError('Column %s is not numeric'
+                                 % self.fields[field][0])
+
+    def find_field(self, names):
+        """Return the index of the first field called one of *names*,
+        ignoring case
+        """
+        lower_names = [name.lower() for name in self.field_names()]
+        for name in names:
+            if name.lower() in lower_names:
+                return lower_names.index(name.lower())
+        raise ShapeFileError('No field called %s' % ' or '.join(names))
+
+    def field_names(self):
+        """Return the names of the fields
+        """
+        return [field[0] for field in self.fields]
+
+
+class CityIndex(object):
+
+    """Locations and names of the cities of a cities shapefile.
+
+    The points are read once. Names are decoded from the attribute table
+    the first time a city is looked up by name, and the population column
+    and a spatial index over the points are built the first time cities
+    are selected by area.
+
+    :Parameters:
+    shapefilename : str
+        Path of the cities point shapefile. The .dbf file must be next to
+        it.
+    """
+
+    def __init__(self, shapefilename):
+        self.lonlats = read_points(shapefilename)
+        self._table = DbfTable(os.path.splitext(shapefilename)[0] + '.dbf')
+        if len(self._table) != len(self.lonlats):
+            raise ShapeFileError('Number of records and points differ in %s'
+                                 % shapefilename)
+        self._name_ids = None
+        self._population = None
+        self._population_order = None
+        self._index = None
+
+    def __len__(self):
+        return len(self.lonlats)
+
+    def _build_name_index(self):
+        name_ids = {}
+        deleted = self._table.deleted
+        for city_id, name in enumerate(self._table.text_column(NAME_FIELD)):
+            if not deleted[city_id]:
+                name_ids.setdefault(name, []).append(city_id)
+        self._name_ids = name_ids
+
+    def find(self, citylist):
+        """Return the sorted ids of the cities named in *citylist*
+        """
+        if self._name_ids is None:
+            self._build_name_index()
+        city_ids = []
+        for name in set(citylist):
+            city_ids.extend(self._name_ids.get(name, []))
+        return np.array(sorted(city_ids), dtype=np.int64)
+
+    @property
+    def population(self):
+        """Population of each city, NaN where unknown
+        """
+        if self._population is None:
+            field = self._table.find_field(POPULATION_FIELDS)
+            self._population = self._table.numeric_column(field)
+        return self._population
+
+    @property
+    def population_order(self):
+        """Ids of the cities from the most to the least populous, with
+        those of unknown population last. Sorted once.
+        """
+        if self._population_order is None:
+            population = np.where(np.isnan(self.population), -1.0,
+                                  self.population)
+            self._population_order = np.argsort(-population,
+                                                kind='mergesort')
+        return self._population_order
+
+    @property
+    def index(self):
+        """Grid index over the city locations
+        """
+        if self._index is None:
+            self._index = BBoxIndex(np.column_stack((self.lonlats,
+                                                     self.lonlats)))
+        return self._index
+
+    def query(self, lon_min, lon_max, lat_min, lat_max, min_population=None):
+        """Return the sorted ids of the cities within the lon/lat box with
+        at least *min_population* inhabitants. The box crosses the dateline
+        if *lon_min* > *lon_max*.
+        """
+        if lon_min > lon_max:
+            city_ids = np.union1d(
+                self.index.candidates(lon_min, 180.0, lat_min, lat_max),
+                self.index.candidates(-180.0, lon_max, lat_min, lat_max))
+        else:
+            city_ids = self.index.candidates(lon_min, lon_max,
+                                             lat_min, lat_max)
+        lons = self.lonlats[city_ids, 0]
+        lats = self.lonlats[city_ids, 1]
+        if lon_min > lon_max:
+            in_lon = (lons >= lon_min) | (lons <= lon_max)
+        else:
+            in_lon = (lons >= lon_min) & (lons <= lon_max)
+        mask = in_lon & (lats >= lat_min) & (lats <= lat_max)
+        city_ids = city_ids[mask]
+        if min_population is not None:
+            city_ids = self.filter_population(city_ids, min_population)
+        return city_ids
+
+    def filter_population(self, city_ids, min_population):
+        """Return the cities of *city_ids* with at least *min_population*
+        inhabitants
+        """
+        return city_ids[self.population[city_ids] >= min_population]
+
+    def most_populous(self, city_ids, max_cities):
+        """Return the sorted ids of the *max_cities* most populous cities of
+        *city_ids*
+        """
+        city_ids = np.asarray(city_ids)
+        if len(city_ids) <= max_cities:
+            return city_ids
+        # Walk the population order, keeping the candidates
+        is_candidate = np.zeros(len(self.lonlats), dtype=bool)
+        is_candidate[city_ids] = True
+        order = self.population_order
+        return np.sort(order[is_candidate[order]][:max_cities])
+
+    def names(self, city_ids):
+        """Return the names of the cities *city_ids*
+        """
+        return self._table.text_column(NAME_FIELD, city_ids)
+
+    @property
+    def nbytes(self):
+        """Approximate heap memory used by the index
+        """
+        nbytes = self.lonlats.nbytes
+        if self._name_ids is not None:
+            # Rough estimate of the name dictionary
+            nbytes += 100 * len(self.lonlats)
+        if self._population is not None:
+            nbytes += self._population.nbytes
+        if self._population_order is not None:
+            nbytes += self._population_order.nbytes
+        if self._index is not None:
+            nbytes += self._index.nbytes
+        return nbytes
@@ -47,6 +47,10 @@ class ContourWriterAGG(ContourWriterBase):
     # from PIL or from aggdraw should be used
     # (unfortunately they are not fully compatible)
 
+    # Anti-aliased lines show the sub-pixel zigzags of dense coastlines, so
+    # all vertices are drawn by default
+    _default_vertex_tolerance = 0
+
     def _get_canvas(self, image):
         """Returns AGG image object
         """
@@ -68,6 +72,18 @@ class ContourWriterAGG(ContourWriterBase):
         brush = aggdraw.Brush(kwargs['fill'], fill_opacity)
         draw.polygon(coordinates, pen, brush)
 
+    def _fill_polygons(self, draw, index_arrays, **kwargs):
+        """Fill the pieces of polygons cut at tile edges as one path, so
+        the anti-aliased edges they share are not covered twice
+        """
+        if kwargs.get('fill') is None:
+            return
+        path = aggdraw.Path()
+        for index_array in index_arrays:
+            path.polygon(index_array.flatten().tolist())
+        draw.path(path, aggdraw.Brush(kwargs['fill'],
+                                      kwargs['fill_opacity']))
+
     def _draw_rectangle(self, draw, coordinates, **kwargs):
         """Draw rectangle
         """
@@ -385,8 +401,9 @@ class ContourWriterAGG(ContourWriterBase):
             Projection of area as Proj.4 string
         area_extent : list
             Area extent as a list (LL_x, LL_y, UR_x, UR_y)
-        resolution : str, optional {'c', 'l', 'i', 'h', 'f'}
-            Dataset resolution to use
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use. 'auto' selects it from the pixel
+            size of the area.
         level : int, optional {1, 2, 3, 4}
             Detail level of dataset
         fill : str or (R, G, B), optional
@@ -425,8 +442,9 @@ class ContourWriterAGG(ContourWriterBase):
             Projection of area as Proj.4 string
         area_extent : list
             Area extent as a list (LL_x, LL_y, UR_x, UR_y)
-        resolution : str, optional {'c', 'l', 'i', 'h', 'f'}
-            Dataset resolution to use
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use. 'auto' selects it from the pixel
+            size of the area.
         level : int, optional {1, 2, 3, 4}
             Detail level of dataset
         fill : str or (R, G, B), optional
@@ -465,8 +483,9 @@ class ContourWriterAGG(ContourWriterBase):
             Projection of area as Proj.4 string
         area_extent : list
             Area extent as a list (LL_x, LL_y, UR_x, UR_y)
-        resolution : str, optional {'c', 'l', 'i', 'h', 'f'}
-            Dataset resolution to use
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use. 'auto' selects it from the pixel
+            size of the area.
         level : int, optional {1, 2, 3}
             Detail level of dataset
         outline : str or (R, G, B), optional
@@ -498,8 +517,9 @@ class ContourWriterAGG(ContourWriterBase):
             Projection of area as Proj.4 string
         area_extent : list
             Area extent as a list (LL_x, LL_y, UR_x, UR_y)
-        resolution : str, optional {'c', 'l', 'i', 'h', 'f'}
-            Dataset resolution to use
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use. 'auto' selects it from the pixel
+            size of the area.
         level : int, optional {1, 2, 3}
             Detail level of dataset
         outline : str or (R, G, B), optional
@@ -532,8 +552,9 @@ class ContourWriterAGG(ContourWriterBase):
             Projection of area as Proj.4 string
         area_extent : list
             Area extent as a list (LL_x, LL_y, UR_x, UR_y)
-        resolution : str, optional {'c', 'l', 'i', 'h', 'f'}
-            Dataset resolution to use
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use. 'auto' selects it from the pixel
+            size of the area.
         level : int, optional {1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11}
             Detail level of dataset
         outline : str or (R, G, B), optional
@@ -566,8 +587,9 @@ class ContourWriterAGG(ContourWriterBase):
             Projection of area as Proj.4 string
         area_extent : list
             Area extent as a list (LL_x, LL_y, UR_x, UR_y)
-        resolution : str, optional {'c', 'l', 'i', 'h', 'f'}
-            Dataset resolution to use
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use. 'auto' selects it from the pixel
+            size of the area.
         level : int, optional {1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11}
             Detail level of dataset
         outline : str or (R, G, B), optional
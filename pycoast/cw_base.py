@@ -22,41 +22,510 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import itertools
 import os
+from contextlib import contextmanager
+import threading
+import weakref
+from collections import namedtuple
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import shapefile
 import numpy as np
 from PIL import Image, ImageFont
-import pyproj
 import logging
 from backports import configparser
 from .errors import *
+from .cache import (PixelCache, ProjCache, ShapeCache, get_proj,
+                    normalize_proj4)
+from .cities import CityIndex
+from .display import (FILL, LINE, OUTLINE, POLYGON, DisplayList, OverlayPlan,
+                      _PlanCanvas, recording_writer)
+from .store import get_pyramid_levels, get_source_stamp, read_shapes
+from .geometry import (ShapeCollection, TiledShapes, bbox_distance,
+                       bbox_overlaps, douglas_peucker, trim_polygon,
+                       trim_polyline)
 
 logger = logging.getLogger(__name__)
 
+# Default byte budget of the in-process shape cache
+DEFAULT_CACHE_SIZE = 256 * 1024 ** 2
+
+# Default byte budget of the on-disk pixel geometry cache
+DEFAULT_PIXEL_CACHE_SIZE = 1024 ** 3
+
+# Format version of the pixel cache files, part of their keys
+PIXEL_CACHE_VERSION = 4
+
+# Pixels around the image kept when clipping projected geometry. The edges
+# polygons are closed by stay this far outside the image, so their outlines
+# do not show.
+CLIP_MARGIN = 64
+
+# Degrees added to the radius of the part of the earth visible in
+# geostationary and perspective projections, covering the flattening of the
+# earth
+HORIZON_MARGIN = 1.0
+
+# Default size, in pixels, of the grid cells within which consecutive
+# vertices are merged before drawing, for engines drawing whole pixels
+DEFAULT_VERTEX_TOLERANCE = 0.5
+
+# Largest simplification tolerance of the pyramid level drawn, as a fraction
+# of the pixel size
+PYRAMID_PIXEL_FRACTION = 0.5
+
+# Semi-major and semi-minor axes of the WGS84 ellipsoid, the default of proj
+WGS84_AXES = (6378137.0, 6356752.314245)
+
+# Lon/lat bounding boxes of areas, by projection, extent and image size
+_bbox_cache = ProjCache(max_items=256)
+
+# Number of points projected with one call
+MAX_BATCH_POINTS = 2 ** 20
+
+# Dataset resolutions from coarsest to finest
+RESOLUTIONS = ('c', 'l', 'i', 'h', 'f')
+
+# Estimated number of shapes and points drawn for a layer
+CostEstimate = namedtuple('CostEstimate', ['shapes', 'points'])
+
+# Number of shapes considered for drawing, and of those culled because
+# they are outside the area, beyond the horizon of the projection or
+# smaller than the minimum feature size
+CullInfo = namedtuple('CullInfo', ['shapes', 'outside', 'hidden', 'small'])
+
+# Database, tag and zero padding of the level of the shapefiles of each layer
+LAYERS = {'coasts': ('GSHHS', None, False),
+          'borders': ('WDBII', 'border', False),
+          'rivers': ('WDBII', 'river', True)}
+
+# Overlays drawn by worker processes in parallel batches
+PARALLEL_OVERLAYS = ('coasts', 'rivers', 'borders', 'shapefile')
+
+# Writer methods drawing the overlays of compiled plans, in the order they
+# are drawn when given as a dict
+OVERLAYS = (('coasts', 'add_coastlines'),
+            ('rivers', 'add_rivers'),
+            ('borders', 'add_borders'),
+            ('shapefile', 'add_shapefile_shapes'),
+            ('polygon', 'add_polygon'),
+            ('line', 'add_line'),
+            ('grid', 'add_grid'),
+            ('cities', 'add_cities'))
+
+
 class ContourWriterBase(object):
 
     """Base class for contourwriters. Do not instantiate.
 
+    A writer, and the caches it owns, can be shared between threads, as
+    long as no two threads draw on the same image at the same time.
+
     :Parameters:
     db_root_path : str
         Path to root dir of GSHHS and WDBII shapefiles
+    cache_size : int, optional
+        Byte budget of the in-process cache of loaded GSHHS and WDBII
+        shapes. Set to 0 to disable caching.
+    prefetch_workers : int, optional
+        Number of threads loading shapefiles in the background. When
+        larger than 0, the files of all requested levels are loaded while
+        the previous ones are drawn, see also :meth:`prefetch`.
+    pixel_cache_dir : str, optional
+        Directory of a persistent cache of the projected GSHHS and WDBII
+        geometry. Drawing the same layer again on an area with the same
+        projection, extent and image size then skips reading and projecting
+        the shapes. Disabled by default.
+    pixel_cache_size : int, optional
+        Byte budget of the pixel cache directory
+    vertex_tolerance : float, optional
+        Consecutive vertices of projected GSHHS, WDBII and shapefile shapes
+        within the same cell of a grid of this many pixels are merged
+        before drawing. Set to 0 to draw all vertices. Defaults to 0.5 for
+        PIL, and to 0 for AGG, whose anti-aliased lines show sub-pixel
+        detail.
+    simplify_tolerance : float, optional
+        If given, projected lines and polygon outlines are simplified with
+        the Douglas-Peucker algorithm, keeping them within this many pixels
+        of the original ones
+    min_feature_size : float, optional
+        If given, GSHHS and WDBII shapes whose projected bounding box is
+        less than this many pixels wide and high are not drawn. Their
+        points are then never read. Shapes of tiled stores are always
+        drawn, so no gaps show at the tile edges.
     """
 
     _draw_module = None
+    # Shapes and candidate shape ids by dataset key, preselected for a
+    # batch of areas
+    _batch_datasets = None
+    # Vertex tolerance of the drawing engine
+    _default_vertex_tolerance = DEFAULT_VERTEX_TOLERANCE
     # This is a flag to make _add_grid aware of which draw.text
     # subroutine, from PIL, aggdraw or cairo is being used
     # (unfortunately they are not fully compatible).
 
-    def __init__(self, db_root_path=None):
+    def __init__(self, db_root_path=None, cache_size=DEFAULT_CACHE_SIZE,
+                 prefetch_workers=0, pixel_cache_dir=None,
+                 pixel_cache_size=DEFAULT_PIXEL_CACHE_SIZE,
+                 vertex_tolerance=None,
+                 simplify_tolerance=None, min_feature_size=None):
         if db_root_path is None:
             self.db_root_path = os.environ['GSHHS_DATA_ROOT']
         else:
             self.db_root_path = db_root_path
+        self._shape_cache = ShapeCache(cache_size)
+        self.prefetch_workers = prefetch_workers
+        if vertex_tolerance is None:
+            vertex_tolerance = self._default_vertex_tolerance
+        self.vertex_tolerance = vertex_tolerance
+        self.simplify_tolerance = simplify_tolerance
+        self.min_feature_size = min_feature_size
+        self._pool = None
+        self._pool_finalizer = None
+        # Processes drawing parallel batches, and the number of workers and
+        # writer settings they were started with
+        self._process_pool = None
+        self._process_pool_key = None
+        self._process_pool_finalizer = None
+        # Background loads by shapefile key
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        # Bounding boxes and point counts of shapefiles, by shapefile key
+        self._stats = {}
+        # Tolerances and paths of the pyramid levels of shapefiles, by
+        # shapefile name
+        self._pyramids = {}
+        # Locks making concurrent threads wait for a dataset being loaded
+        # instead of loading it again, and the number of threads holding or
+        # waiting for them, by shapefile key
+        self._load_locks = {}
+        self._cull_counts = dict.fromkeys(CullInfo._fields, 0)
+        if pixel_cache_dir is None:
+            self._pixel_cache = None
+        else:
+            self._pixel_cache = PixelCache(pixel_cache_dir, pixel_cache_size)
+
+    def __getstate__(self):
+        # Only the settings are pickled, caches and threads belong to one
+        # process
+        if self._pixel_cache is None:
+            pixel_cache_dir = None
+            pixel_cache_size = DEFAULT_PIXEL_CACHE_SIZE
+        else:
+            pixel_cache_dir = self._pixel_cache.cache_dir
+            pixel_cache_size = self._pixel_cache.max_bytes
+        return {'db_root_path': self.db_root_path,
+                'cache_size': self._shape_cache.max_bytes,
+                'prefetch_workers': self.prefetch_workers,
+                'pixel_cache_dir': pixel_cache_dir,
+                'pixel_cache_size': pixel_cache_size,
+                'vertex_tolerance': self.vertex_tolerance,
+                'simplify_tolerance': self.simplify_tolerance,
+                'min_feature_size': self.min_feature_size}
+
+    def __setstate__(self, state):
+        ContourWriterBase.__init__(self, **state)
+
+    def close(self):
+        """Stop the prefetching threads and the processes drawing parallel
+        batches. They are also stopped when the writer is garbage collected
+        or the interpreter exits.
+        """
+        with self._pending_lock:
+            self._pending.clear()
+            finalizers = [self._pool_finalizer, self._process_pool_finalizer]
+            self._pool = None
+            self._pool_finalizer = None
+            self._process_pool = None
+            self._process_pool_key = None
+            self._process_pool_finalizer = None
+        for finalizer in finalizers:
+            if finalizer is not None:
+                finalizer()
+
+    def prefetch(self, layer, resolution='c', level=1, area_def=None,
+                 x_size=None, y_size=None):
+        """Start loading the shapefiles of a layer in the background, so
+        a following add_coastlines, add_borders or add_rivers call finds
+        them loaded. Does nothing unless the writer has prefetch_workers.
+
+        :Parameters:
+        layer : str {'coasts', 'borders', 'rivers'}
+            Layer to load
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use, 'auto' requires the area
+        level : int or list of int, optional
+            Detail level as passed to the add_* methods
+        area_def : object, optional
+            Area Definition, or (proj4_string, area_extent) tuple, the
+            layer will be drawn on. Needed to load the simplified levels
+            of datasets converted with a pyramid.
+        x_size, y_size : int, optional
+            Image size, taken from the area definition if not given
+        """
+        db_name, tag, zero_pad = LAYERS[layer]
+        max_tolerance = None
+        if area_def is not None:
+            try:
+                proj4_string = area_def.proj4_string
+                area_extent = area_def.area_extent
+            except AttributeError:
+                proj4_string = area_def[0]
+                area_extent = area_def[1]
+            if x_size is None or y_size is None:
+                x_size = getattr(area_def, 'x_size', 1000)
+                y_size = getattr(area_def, 'y_size', 1000)
+            if resolution == 'auto':
+                resolution = get_resolution(area_extent, x_size, y_size)
+            max_tolerance = _get_max_tolerance(area_extent, x_size, y_size,
+                                               get_proj(proj4_string))
+        self._prefetch_files(self._get_db_files(db_name, tag, resolution,
+                                                level, zero_pad,
+                                                max_tolerance=max_tolerance))
+
+    def clear_cache(self):
+        """Empty the cache of loaded GSHHS and WDBII shapes
+        """
+        with self._pending_lock:
+            self._pending.clear()
+            self._load_locks.clear()
+        self._shape_cache.clear()
+
+    def cache_info(self):
+        """Return hit/miss statistics of the shape cache
+        """
+        return self._shape_cache.info()
+
+    def cull_info(self):
+        """Return the number of shapes considered for drawing, and of
+        those culled, since the writer was created or the counts were
+        cleared
+        """
+        with self._pending_lock:
+            return CullInfo(**self._cull_counts)
+
+    def clear_cull_info(self):
+        """Reset the culling counts
+        """
+        with self._pending_lock:
+            for name in self._cull_counts:
+                self._cull_counts[name] = 0
+
+    def _count_culled(self, **counts):
+        """Add to the culling counts
+        """
+        with self._pending_lock:
+            for name, count in counts.items():
+                self._cull_counts[name] += count
+
+    def clear_pixel_cache(self):
+        """Remove all files of the pixel cache
+        """
+        if self._pixel_cache is not None:
+            self._pixel_cache.clear()
+
+    def pixel_cache_info(self):
+        """Return hit/miss statistics of the pixel cache, or None if it is
+        disabled
+        """
+        if self._pixel_cache is None:
+            return None
+        return self._pixel_cache.info()
+
+    def compile(self, area_def, layers, x_size=None, y_size=None):
+        """Compile overlays for an area into a plan that can be drawn on any
+        number of images of the area. Reading, culling and projection are
+        done once here, drawing the plan with :meth:`OverlayPlan.render`
+        only rasterises the stored pixel geometry, labels and styles.
+
+        :Parameters:
+        area_def : object
+            Area Definition, or (proj4_string, area_extent) tuple
+        layers : dict or list of (str, dict)
+            Keyword arguments of the add_* method of each overlay, {'coasts',
+            'rivers', 'borders', 'shapefile', 'polygon', 'line', 'grid',
+            'cities'}, without the image and area. A dict is drawn in this
+            order, a list of (overlay, arguments) pairs in its own order.
+        x_size, y_size : int, optional
+            Image size, taken from the area definition if not given
+
+        :Returns:
+        plan : OverlayPlan
+            Compiled overlays
+        """
+        if x_size is None or y_size is None:
+            try:
+                x_size = area_def.x_size
+                y_size = area_def.y_size
+            except AttributeError:
+                raise ValueError('Image size not given and not in area '
+                                 'definition')
+        methods = dict(OVERLAYS)
+        layers = _get_overlay_list(layers)
+
+        canvas = _PlanCanvas((x_size, y_size))
+        recorder = recording_writer(self)
+        for overlay, kwargs in layers:
+            getattr(recorder, methods[overlay])(canvas, area_def, **kwargs)
+        return OverlayPlan(self, canvas.size, canvas.groups)
+
+    def add_overlays_batch(self, items, layers, workers=None):
+        """Draw the same overlays on several images of different areas.
+
+        Each dataset is read once for all areas, and the shapes outside
+        the union of the lon/lat boxes of the areas are culled once. The
+        remaining shapes are culled, projected and drawn per area.
+
+        :Parameters:
+        items : list of (image, area_def)
+            Images and their Area Definitions, or (proj4_string,
+            area_extent) tuples
+        layers : dict or list of (str, dict)
+            Overlays and the keyword arguments of their add_* methods, as
+            for :meth:`compile`
+        workers : int, optional
+            Number of processes drawing the coasts, rivers, borders and
+            shapefile overlays of each area in parallel, see
+            :meth:`_add_overlays_parallel`
+        """
+        items = list(items)
+        layers = _get_overlay_list(layers)
+        methods = dict(OVERLAYS)
+        if workers:
+            self._add_overlays_parallel(items, layers, workers)
+            return
+
+        datasets = {}
+        for overlay, kwargs in layers:
+            if overlay in LAYERS:
+                datasets.update(self._get_batch_datasets(items, overlay,
+                                                         kwargs))
+        view = object.__new__(type(self))
+        view.__dict__.update(self.__dict__)
+        view._batch_datasets = datasets
+
+        for overlay, kwargs in layers:
+            method = getattr(view, methods[overlay])
+            for image, area_def in items:
+                method(image, area_def, **kwargs)
+
+    def _add_overlays_parallel(self, items, layers, workers):
+        """Draw overlays on several images with a pool of processes. Each
+        overlay of each area is drawn by a worker, and composited on the
+        area's image in the order of the layers. The workers read the
+        datasets themselves, memory mapped stores and shapefiles are shared
+        through the page cache. Overlays not in PARALLEL_OVERLAYS are drawn
+        by the calling process.
+        """
+        methods = dict(OVERLAYS)
+        pool = self._get_process_pool(workers)
+        try:
+            results = {}
+            for i, (image, area_def) in enumerate(items):
+                for j, (overlay, kwargs) in enumerate(layers):
+                    if overlay in PARALLEL_OVERLAYS:
+                        results[(i, j)] = pool.apply_async(
+                            _draw_layer, (image.size, area_def,
+                                          overlay, kwargs))
+            for i, (image, area_def) in enumerate(items):
+                for j, (overlay, kwargs) in enumerate(layers):
+                    if (i, j) in results:
+                        black, white = results[(i, j)].get()
+                        _composite(image,
+                                   Image.frombytes('RGB', image.size, black),
+                                   Image.frombytes('RGB', image.size, white))
+                    else:
+                        getattr(self, methods[overlay])(image, area_def,
+                                                        **kwargs)
+        except Exception:
+            # Do not leave the remaining work units of the batch running
+            with self._pending_lock:
+                finalizer = self._process_pool_finalizer
+                if self._process_pool is pool:
+                    self._process_pool = None
+                    self._process_pool_key = None
+                    self._process_pool_finalizer = None
+            if finalizer is not None:
+                finalizer.detach()
+            pool.terminate()
+            pool.join()
+            raise
+
+    def _get_process_pool(self, workers):
+        """Get the pool of processes drawing parallel batches, starting it
+        on first use or when the number of workers or the settings of the
+        writer changed. The processes are not forked from the calling
+        process, as they would inherit the locks of the prefetching and
+        service threads in whatever state they are.
+        """
+        state = self.__getstate__()
+        with self._pending_lock:
+            old_finalizer = None
+            if (self._process_pool_finalizer is None or
+                    not self._process_pool_finalizer.alive or
+                    self._process_pool_key != (workers, state)):
+                old_finalizer = self._process_pool_finalizer
+                self._process_pool = _get_process_context().Pool(
+                    workers, _init_worker, (type(self), state))
+                self._process_pool_key = (workers, state)
+                # As for the prefetching threads, the pool is stopped with
+                # the writer that started it
+                self._process_pool_finalizer = weakref.finalize(
+                    self, _stop_process_pool, self._process_pool)
+            pool = self._process_pool
+        if old_finalizer is not None:
+            old_finalizer()
+        return pool
+
+    def _get_batch_datasets(self, items, layer, kwargs):
+        """Load the datasets of a layer for a batch of areas. Returns the
+        shapes and the ids of the shapes overlapping any of the areas by
+        dataset key.
+        """
+        db_name, tag, zero_pad = LAYERS[layer]
+        level = kwargs.get('level', 1)
+        resolution = kwargs.get('resolution', 'c')
+
+        # Lon/lat boxes of the areas by the datasets they are drawn from
+        boxes = {}
+        for image, area_def in items:
+            try:
+                proj4_string = area_def.proj4_string
+                area_extent = area_def.area_extent
+            except AttributeError:
+                proj4_string = area_def[0]
+                area_extent = area_def[1]
+            x_size, y_size = image.size
+            if resolution == 'auto':
+                area_resolution = get_resolution(area_extent, x_size, y_size)
+            else:
+                area_resolution = resolution
+            prj = get_proj(proj4_string)
+            db_files = tuple(self._get_db_files(
+                db_name, tag, area_resolution, level, zero_pad,
+                max_tolerance=_get_max_tolerance(area_extent, x_size, y_size,
+                                                 prj)))
+            boxes.setdefault(db_files, []).append(
+                _get_lon_lat_bounding_box(area_extent, x_size, y_size, prj))
+
+        datasets = {}
+        for db_files, area_boxes in boxes.items():
+            union_box = _union_bounding_box(area_boxes)
+            for key, shapefilename in db_files:
+                shapes = self._get_shapes(key, shapefilename)
+                if union_box is None:
+                    shape_ids = np.arange(len(shapes))
+                else:
+                    shape_ids = _select_shape_ids(shapes, *union_box)
+                datasets[key] = (shapes, shape_ids)
+        return datasets
 
     def _draw_text(self, draw, position, txt, font, align='cc', **kwargs):
         """Draw text with agg module
         """
-        txt_width, txt_height = draw.textsize(txt, font)
+        txt_width, txt_height = _get_text_size(draw, txt, font)
         x_pos, y_pos = position
         ax, ay = align.lower()
         if ax == 'r':
@@ -182,7 +651,7 @@ class ContourWriterBase(object):
 
         # Area and projection info
         x_size, y_size = image.size
-        prj = pyproj.Proj(proj4_string)
+        prj = get_proj(proj4_string)
 
         x_offset = 0
         y_offset = 0
@@ -453,10 +922,14 @@ class ContourWriterBase(object):
         """ for drawing all shapes (polygon/poly-lines) from a custom shape
         file onto a PIL image
         """
-        sf = shapefile.Reader(filename)
-        for i in range(len(sf.shapes())):
-            self._add_shapefile_shape(image, area_def, filename, i,
-                                      feature_type, **kwargs)
+        # Read the file once and draw all shapes in a single pass. The
+        # pieces of tiled stores are only drawn from the GSHHS and WDBII
+        # datasets.
+        shapes = read_shapes(filename, tiled=False)
+        if feature_type is None:
+            feature_type = _get_feature_type(shapes.shape_type)
+
+        self._add_shapes(image, area_def, feature_type, shapes, **kwargs)
 
     def _add_shapefile_shape(self, image, area_def, filename, shape_id,
                              feature_type=None, **kwargs):
@@ -466,13 +939,7 @@ class ContourWriterBase(object):
         sf = shapefile.Reader(filename)
         shape = sf.shape(shape_id)
         if feature_type is None:
-            if shape.shapeType == 3:
-                feature_type = "line"
-            elif shape.shapeType == 5:
-                feature_type = "polygon"
-            else:
-                raise ShapeFileError("Unsupported shape type: "
-                                     + str(shape.shapeType))
+            feature_type = _get_feature_type(shape.shapeType)
 
         self._add_shapes(image, area_def, feature_type, [shape], **kwargs)
 
@@ -515,66 +982,66 @@ class ContourWriterBase(object):
 
         # Area and projection info
         x_size, y_size = image.size
-        prj = pyproj.Proj(proj4_string)
+        prj = get_proj(proj4_string)
 
         # Calculate min and max lons and lats of interest
         lon_min, lon_max, lat_min, lat_max = \
             _get_lon_lat_bounding_box(area_extent, x_size, y_size, prj)
 
-        # Iterate through shapes
-        for i, shape in enumerate(shapes):
-            # Check if polygon is possibly relevant
-            s_lon_ll, s_lat_ll, s_lon_ur, s_lat_ur = shape.bbox
-            if lon_min > lon_max:
-                pass
-            #     # Dateline crossing
-            #     if ((s_lon_ur < lon_min and s_lon_ll > lon_max) or
-            #             lat_max < s_lat_ll or lat_min > s_lat_ur):
-            #         # Polygon is irrelevant
-            #         continue
-            elif (lon_max < s_lon_ll or lon_min > s_lon_ur or
-                  lat_max < s_lat_ll or lat_min > s_lat_ur):
-                # Polygon is irrelevant
-                continue
-
-            # iterate over shape parts (some shapes split into parts)
-            # dummy shape part object
-            shape_part = type("", (), {})()
-            parts = list(shape.parts) + [len(shape.points)]
-
-            for i in range(len(parts) - 1):
-
-                shape_part.points = shape.points[parts[i]:parts[i + 1]]
+        # Iterate over the parts of the relevant shapes (some shapes split
+        # into parts), projecting them in batches
+        if not isinstance(shapes, ShapeCollection):
+            shapes = list(shapes)
+        selected = _select_shapes(shapes, lon_min, lon_max, lat_min, lat_max)
+        visible = _visible_mask([shape.bbox for shape in selected],
+                                _get_visible_cap(proj4_string))
+        self._count_culled(shapes=len(shapes),
+                           outside=len(shapes) - len(selected),
+                           hidden=len(selected) - np.count_nonzero(visible))
+        selected = [shape for shape, is_visible in zip(selected, visible)
+                    if is_visible]
+        part_points = _iter_part_points(selected)
+        ops = _iter_shape_ops(feature_type, part_points,
+                              area_extent, x_size, y_size, prj,
+                              x_offset=x_offset, y_offset=y_offset)
+        ops = self._decimate_ops(_clip_ops(ops, x_size, y_size))
+        self._draw_ops(draw, ops, **kwargs)
 
-                # Get pixel index coordinates of shape
-                index_arrays, is_reduced = _get_pixel_index(shape_part,
-                                                            area_extent,
-                                                            x_size, y_size,
-                                                            prj,
-                                                            x_offset=x_offset,
-                                                            y_offset=y_offset)
-
-                # Skip empty datasets
-                if len(index_arrays) == 0:
-                    continue
+        self._finalize(draw)
 
-                # Make PIL draw the polygon or line
-                for index_array in index_arrays:
-                    if feature_type.lower() == 'polygon' and not is_reduced:
-                        # Draw polygon if dataset has not been reduced
-                        self._draw_polygon(draw,
-                                           index_array.flatten().tolist(),
-                                           **kwargs)
-                    elif feature_type.lower() == 'line' or is_reduced:
-                        # Draw line
-                        self._draw_line(draw,
-                                        index_array.flatten().tolist(),
-                                        **kwargs)
-                    else:
-                        raise ValueError('Unknown contour type: %s'
-                                         % feature_type)
+    def _draw_ops(self, draw, ops, **kwargs):
+        """Draw (operation, pixel index array) pairs, e.g. a DisplayList
+        """
+        fills = []
+        for code, index_array in ops:
+            if code == FILL:
+                fills.append(index_array)
+                continue
+            if fills:
+                self._fill_polygons(draw, fills, **kwargs)
+                fills = []
+            if code == POLYGON:
+                self._draw_polygon(draw, index_array.flatten().tolist(),
+                                   **kwargs)
+            elif code == LINE:
+                self._draw_line(draw, index_array.flatten().tolist(),
+                                **kwargs)
+            elif kwargs.get('outline') is not None:
+                self._draw_line(draw, index_array.flatten().tolist(),
+                                **kwargs)
+        if fills:
+            self._fill_polygons(draw, fills, **kwargs)
 
-        self._finalize(draw)
+    def _fill_polygons(self, draw, index_arrays, **kwargs):
+        """Fill the pieces of polygons cut at tile edges, without outline
+        """
+        if kwargs.get('fill') is None:
+            return
+        fill_kwargs = kwargs.copy()
+        fill_kwargs['outline'] = None
+        for index_array in index_arrays:
+            self._draw_polygon(draw, index_array.flatten().tolist(),
+                               **fill_kwargs)
 
     def _add_feature(self, image, area_def, feature_type,
                      db_name, tag=None, zero_pad=False, resolution='c',
@@ -593,65 +1060,216 @@ class ContourWriterBase(object):
 
         # Area and projection info
         x_size, y_size = image.size
-        prj = pyproj.Proj(proj4_string)
+
+        if resolution == 'auto':
+            resolution = get_resolution(area_extent, x_size, y_size)
+
+        ops = None
+        key = None
+        if self._pixel_cache is not None:
+            key = self._get_pixel_cache_key(proj4_string, area_extent,
+                                            x_size, y_size, feature_type,
+                                            db_name, tag, zero_pad,
+                                            resolution, level,
+                                            x_offset, y_offset)
+            if key is not None:
+                ops = self._pixel_cache.get(key)
+
+        if ops is None:
+            ops = self._iter_feature_ops(proj4_string, area_extent,
+                                         x_size, y_size, feature_type,
+                                         db_name, tag, zero_pad, resolution,
+                                         level, x_offset, y_offset)
+            if key is not None:
+                ops = DisplayList.from_ops(ops)
+                self._pixel_cache.put(key, ops)
+
+        self._draw_ops(draw, ops, **kwargs)
+
+        self._finalize(draw)
+
+    def _get_pixel_cache_key(self, proj4_string, area_extent, x_size, y_size,
+                             feature_type, db_name, tag, zero_pad,
+                             resolution, level, x_offset, y_offset):
+        """Return the pixel cache key of a feature, or None if a dataset is
+        missing
+        """
+        max_tolerance = _get_max_tolerance(area_extent, x_size, y_size,
+                                           get_proj(proj4_string))
+        try:
+            stamps = [get_source_stamp(shapefilename) for key, shapefilename
+                      in self._get_db_files(db_name, tag, resolution, level,
+                                            zero_pad,
+                                            max_tolerance=max_tolerance)]
+        except OSError:
+            return None
+        return PixelCache.make_key(
+            PIXEL_CACHE_VERSION, normalize_proj4(proj4_string),
+            tuple(float(val) for val in area_extent), x_size, y_size,
+            feature_type.lower(), stamps,
+            float(x_offset), float(y_offset),
+            self.vertex_tolerance, self.simplify_tolerance,
+            self.min_feature_size)
+
+    def _iter_feature_ops(self, proj4_string, area_extent, x_size, y_size,
+                          feature_type, db_name, tag, zero_pad, resolution,
+                          level, x_offset, y_offset):
+        """Iterate over the drawing operations of a contour feature
+        """
+        prj = get_proj(proj4_string)
 
         # Calculate min and max lons and lats of interest
         lon_min, lon_max, lat_min, lat_max = \
             _get_lon_lat_bounding_box(area_extent, x_size, y_size, prj)
+        cap = _get_visible_cap(proj4_string)
+        max_tolerance = _get_max_tolerance(area_extent, x_size, y_size, prj)
 
         # Iterate through detail levels
-        for shapes in self._iterate_db(db_name, tag,
-                                       resolution, level, zero_pad):
-
-            # Iterate through shapes
-            for i, shape in enumerate(shapes):
-                # Check if polygon is possibly relevant
-                s_lon_ll, s_lat_ll, s_lon_ur, s_lat_ur = shape.bbox
-                if lon_min > lon_max:
-                    pass
-                #    # Dateline crossing
-                #    if ((s_lon_ur < lon_min and s_lon_ll > lon_max) or
-                #            lat_max < s_lat_ll or lat_min > s_lat_ur):
-                #        # Polygon is irrelevant
-                #        continue
-                elif (lon_max < s_lon_ll or lon_min > s_lon_ur or
-                      lat_max < s_lat_ll or lat_min > s_lat_ur):
-                    # Polygon is irrelevant
-                    continue
+        for shapes, candidate_ids in self._iterate_datasets(
+                db_name, tag, resolution, level, zero_pad,
+                max_tolerance=max_tolerance):
+
+            # Only the shapes, or tiles, overlapping the area are read
+            shape_ids = _select_shape_ids(shapes, lon_min, lon_max,
+                                          lat_min, lat_max,
+                                          candidate_ids=candidate_ids)
+            n_selected = len(shape_ids)
+            if cap is not None:
+                # Drop the shapes, or tiles, beyond the horizon before
+                # projecting their points
+                shape_ids = shape_ids[_visible_mask(
+                    shapes.bbox[shape_ids], cap)]
+            n_visible = len(shape_ids)
+            if self.min_feature_size and \
+                    not isinstance(shapes, TiledShapes):
+                # Drop the shapes smaller than the minimum size, from the
+                # projected corners of their bounding boxes
+                extents = _get_pixel_extents(
+                    shapes.bbox[shape_ids], area_extent,
+                    x_size, y_size, prj)
+                shape_ids = shape_ids[extents >= self.min_feature_size]
+            self._count_culled(shapes=len(shapes),
+                               outside=len(shapes) - n_selected,
+                               hidden=n_selected - n_visible,
+                               small=n_visible - len(shape_ids))
+            if isinstance(shapes, TiledShapes):
+                ops = _iter_tiled_ops(feature_type, shapes, shape_ids,
+                                      area_extent, x_size, y_size, prj,
+                                      x_offset=x_offset, y_offset=y_offset)
+            else:
+                # Iterate through relevant shapes, projecting them in
+                # batches
+                shape_points = (shapes[shape_id].points
+                                for shape_id in shape_ids)
+                ops = _iter_shape_ops(feature_type, shape_points,
+                                      area_extent, x_size, y_size, prj,
+                                      x_offset=x_offset, y_offset=y_offset)
+            for op in self._decimate_ops(_clip_ops(ops, x_size, y_size)):
+                yield op
+
+    def _decimate_ops(self, ops):
+        """Reduce the vertices of drawing operations as set by the
+        vertex and simplify tolerances of the writer
+        """
+        if self.vertex_tolerance:
+            ops = _decimate_ops(ops, self.vertex_tolerance)
+        if self.simplify_tolerance:
+            ops = _simplify_ops(ops, self.simplify_tolerance)
+        return ops
 
-                # Get pixel index coordinates of shape
+    def estimate_cost(self, area_def, layers, x_size=None, y_size=None,
+                      resolutions=RESOLUTIONS):
+        """Estimate the number of shapes and points drawn for an area at
+        each dataset resolution.
 
-                index_arrays, is_reduced = _get_pixel_index(shape,
-                                                            area_extent,
-                                                            x_size, y_size,
-                                                            prj,
-                                                            x_offset=x_offset,
-                                                            y_offset=y_offset)
+        The estimate counts the shapes whose bounding box overlaps the
+        area and their points. Only the bounding boxes and point counts of
+        the datasets are read, and kept for later estimates.
 
-                # Skip empty datasets
-                if len(index_arrays) == 0:
-                    continue
+        :Parameters:
+        area_def : object
+            Area Definition, or (proj4_string, area_extent) tuple
+        layers : dict or list of str
+            Layers to draw, {'coasts', 'borders', 'rivers'}, as a dict of
+            layer and level as passed to the add_* methods, or as a list of
+            layers drawn at level 1
+        x_size, y_size : int, optional
+            Image size, taken from the area definition if not given
+        resolutions : list of str, optional
+            Resolutions to estimate
+
+        :Returns:
+        costs : dict
+            CostEstimate(shapes, points) of all layers per resolution.
+            Resolutions for which a dataset is missing are left out.
+        """
+        try:
+            proj4_string = area_def.proj4_string
+            area_extent = area_def.area_extent
+        except AttributeError:
+            proj4_string = area_def[0]
+            area_extent = area_def[1]
+        if x_size is None or y_size is None:
+            x_size = getattr(area_def, 'x_size', 1000)
+            y_size = getattr(area_def, 'y_size', 1000)
+        if not isinstance(layers, dict):
+            layers = dict((layer, 1) for layer in layers)
 
-                # Make PIL draw the polygon or line
-                for index_array in index_arrays:
-                    if feature_type.lower() == 'polygon' and not is_reduced:
-                        # Draw polygon if dataset has not been reduced
-                        self._draw_polygon(draw,
-                                           index_array.flatten().tolist(),
-                                           **kwargs)
-                    elif feature_type.lower() == 'line' or is_reduced:
-                        # Draw line
-                        self._draw_line(draw,
-                                        index_array.flatten().tolist(),
-                                        **kwargs)
-                    else:
-                        raise ValueError('Unknown contour type: %s'
-                                         % feature_type)
+        prj = get_proj(proj4_string)
+        lon_min, lon_max, lat_min, lat_max = \
+            _get_lon_lat_bounding_box(area_extent, x_size, y_size, prj)
+        cap = _get_visible_cap(proj4_string)
+        max_tolerance = _get_max_tolerance(area_extent, x_size, y_size, prj)
 
-        self._finalize(draw)
+        costs = {}
+        for resolution in resolutions:
+            n_shapes = 0
+            n_points = 0
+            try:
+                for layer, level in layers.items():
+                    db_name, tag, zero_pad = LAYERS[layer]
+                    for key, shapefilename in self._get_db_files(
+                            db_name, tag, resolution, level, zero_pad,
+                            max_tolerance=max_tolerance):
+                        bbox, point_counts = self._get_stats(key,
+                                                             shapefilename)
+                        mask = bbox_overlaps(bbox, lon_min, lon_max,
+                                             lat_min, lat_max)
+                        if cap is not None:
+                            mask[mask] = _visible_mask(bbox[mask], cap)
+                        n_shapes += np.count_nonzero(mask)
+                        n_points += int(point_counts[mask].sum())
+            except ShapeFileError as err:
+                logger.debug("No estimate for resolution %s: %s",
+                             resolution, str(err))
+                continue
+            costs[resolution] = CostEstimate(n_shapes, n_points)
+        return costs
 
-    def _iterate_db(self, db_name, tag, resolution, level, zero_pad):
-        """Iterate trough datasets
+    def _get_stats(self, key, shapefilename):
+        """Get the bounding boxes and point counts of the shapes of a
+        shapefile
+        """
+        with self._pending_lock:
+            stats = self._stats.get(key)
+        if stats is None:
+            shapes = None
+            if key in self._shape_cache:
+                shapes = self._shape_cache.get(key)
+            if shapes is None:
+                shapes = read_shapes(shapefilename)
+            stats = (np.asarray(shapes.bbox, dtype=np.float64),
+                     shapes.point_counts)
+            with self._pending_lock:
+                self._stats[key] = stats
+        return stats
+
+    def _get_db_files(self, db_name, tag, resolution, level, zero_pad,
+                      max_tolerance=None):
+        """Return the cache keys and file names of the shapefiles of the
+        requested levels. If *max_tolerance* is given, the coarsest level
+        of the pyramid of a shapefile simplified to within it is used
+        instead, and its tolerance is added to the key.
         """
 
         format_string = '%s_%s_'
@@ -666,7 +1284,9 @@ class ContourWriterBase(object):
         if type(level) == int:
             level = range(level-1,level)
 
+        db_files = []
         for i in level:
+            key = (db_name, tag, resolution, i + 1)
             # One shapefile per level
             if tag is None:
                 shapefilename = \
@@ -678,13 +1298,136 @@ class ContourWriterBase(object):
                     os.path.join(self.db_root_path, '%s_shp' % db_name,
                                  resolution, format_string %
                                  (db_name, tag, resolution, (i + 1)))
-            try:
-                s = shapefile.Reader(shapefilename)
-                shapes = s.shapes()
-            except AttributeError:
-                raise ShapeFileError('Could not find shapefile %s'
-                                     % shapefilename)
-            yield shapes
+            if max_tolerance:
+                for tolerance, store_path in reversed(
+                        self._get_pyramid_levels(shapefilename)):
+                    if tolerance <= max_tolerance:
+                        key += (tolerance,)
+                        shapefilename = store_path
+                        break
+            db_files.append((key, shapefilename))
+        return db_files
+
+    def _get_pyramid_levels(self, shapefilename):
+        """Get the tolerances and paths of the pyramid levels of a
+        shapefile
+        """
+        with self._pending_lock:
+            levels = self._pyramids.get(shapefilename)
+        if levels is None:
+            levels = get_pyramid_levels(shapefilename)
+            with self._pending_lock:
+                self._pyramids[shapefilename] = levels
+        return levels
+
+    def _iterate_datasets(self, db_name, tag, resolution, level, zero_pad,
+                          max_tolerance=None):
+        """Iterate through the datasets of the requested levels, with the
+        ids of the candidate shapes preselected for a batch of areas, or
+        None
+        """
+        if self._batch_datasets is not None:
+            db_files = self._get_db_files(db_name, tag, resolution, level,
+                                          zero_pad,
+                                          max_tolerance=max_tolerance)
+            if all(key in self._batch_datasets for key, name in db_files):
+                for key, shapefilename in db_files:
+                    yield self._batch_datasets[key]
+                return
+        for shapes in self._iterate_db(db_name, tag, resolution, level,
+                                       zero_pad, max_tolerance=max_tolerance):
+            yield shapes, None
+
+    def _iterate_db(self, db_name, tag, resolution, level, zero_pad,
+                    max_tolerance=None):
+        """Iterate trough datasets
+        """
+        db_files = self._get_db_files(db_name, tag, resolution, level,
+                                      zero_pad, max_tolerance=max_tolerance)
+        if len(db_files) > 1:
+            # Load the following levels while the first ones are drawn
+            self._prefetch_files(db_files[1:])
+        for key, shapefilename in db_files:
+            yield self._get_shapes(key, shapefilename)
+
+    def _prefetch_files(self, db_files):
+        """Load shapefiles in the background into the shape cache
+        """
+        if not self.prefetch_workers:
+            return
+        with self._pending_lock:
+            # The pool is stopped with the writer that started it, which
+            # may be a view sharing the state of this one
+            if (self._pool_finalizer is None or
+                    not self._pool_finalizer.alive):
+                self._pool = ThreadPool(self.prefetch_workers)
+                self._pool_finalizer = weakref.finalize(self, _stop_pool,
+                                                        self._pool)
+            # Finished loads are in the shape cache
+            for key, pending in list(self._pending.items()):
+                if pending.ready():
+                    del self._pending[key]
+            for key, shapefilename in db_files:
+                if key in self._pending or key in self._shape_cache:
+                    continue
+                # The writer can go away while its loads are queued
+                self._pending[key] = self._pool.apply_async(
+                    _prefetch_shapes,
+                    (weakref.ref(self), key, shapefilename))
+
+    def _load_shapes(self, key, shapefilename):
+        """Load the shapes of a shapefile into the cache, unless another
+        thread loaded them meanwhile
+        """
+        with self._load_lock(key):
+            if key not in self._shape_cache:
+                self._read_shapes(key, shapefilename)
+
+    def _get_shapes(self, key, shapefilename):
+        """Get the shapes of a shapefile from the cache, waiting for a
+        background or concurrent load of it, or from the file itself
+        """
+        with self._pending_lock:
+            self._pending.pop(key, None)
+        shapes = self._shape_cache.get(key)
+        if shapes is not None:
+            return shapes
+        # A background load holds the lock of its dataset while loading
+        with self._load_lock(key):
+            if key in self._shape_cache:
+                shapes = self._shape_cache.get(key)
+            if shapes is None:
+                shapes = self._read_shapes(key, shapefilename)
+        return shapes
+
+    @contextmanager
+    def _load_lock(self, key):
+        """Hold the lock serializing the loading of a dataset. The lock is
+        dropped once no thread holds or waits for it.
+        """
+        with self._pending_lock:
+            entry = self._load_locks.get(key)
+            if entry is None:
+                entry = self._load_locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._pending_lock:
+                entry[1] -= 1
+                # clear_cache may have dropped the entry meanwhile
+                if not entry[1] and self._load_locks.get(key) is entry:
+                    del self._load_locks[key]
+
+    def _read_shapes(self, key, shapefilename):
+        """Read the shapes of a shapefile and cache them
+        """
+        shapes = read_shapes(shapefilename)
+        # Build the bounding box index up front so it is accounted for
+        shapes.index
+        self._shape_cache.put(key, shapes, shapes.nbytes)
+        return shapes
 
     def _finalize(self, draw):
         """Do any need finalization of the drawing
@@ -692,7 +1435,7 @@ class ContourWriterBase(object):
 
         pass
 
-    def add_overlay_from_config(self, config_file, area_def):
+    def add_overlay_from_config(self, config_file, area_def, workers=None):
         """Create and return a transparent image adding all the
            overlays contained in a configuration file.
 
@@ -701,6 +1444,9 @@ class ContourWriterBase(object):
             Configuration file name
         area_def : object
             Area Definition of the creating image
+        workers : int, optional
+            Number of processes drawing the coasts, rivers and borders in
+            parallel
         """
 
         config = configparser()
@@ -743,24 +1489,8 @@ class ContourWriterBase(object):
         foreground = Image.new('RGBA', (x_size, y_size), (0, 0, 0, 0))
 
     # Lines (coasts, rivers, borders) management
-        x_resolution = ((area_def.area_extent[2] -
-                         area_def.area_extent[0]) /
-                        x_size)
-        y_resolution = ((area_def.area_extent[3] -
-                         area_def.area_extent[1]) /
-                        y_size)
-        res = min(x_resolution, y_resolution)
-
-        if res > 25000:
-            default_resolution = "c"
-        elif res > 5000:
-            default_resolution = "l"
-        elif res > 1000:
-            default_resolution = "i"
-        elif res > 200:
-            default_resolution = "h"
-        else:
-            default_resolution = "f"
+        default_resolution = get_resolution(area_def.area_extent,
+                                            x_size, y_size)
 
         DEFAULT = {'level': 1,
                    'outline': 'white',
@@ -783,11 +1513,20 @@ class ContourWriterBase(object):
 
         is_agg = self._draw_module == "AGG"
 
+        # Load the shapefiles of all layers in the background while the
+        # first ones are drawn
+        for section in ['coasts', 'rivers', 'borders']:
+            if section in overlays and not workers:
+                self.prefetch(section,
+                              overlays[section].get('resolution',
+                                                    default_resolution),
+                              int(overlays[section].get('level', 1)),
+                              area_def=area_def, x_size=x_size,
+                              y_size=y_size)
+
         # Coasts
-        for section, fun in zip(['coasts', 'rivers', 'borders'],
-                                [self.add_coastlines,
-                                 self.add_rivers,
-                                 self.add_borders]):
+        layers = []
+        for section in ['coasts', 'rivers', 'borders']:
 
             if overlays.has_key(section):
 
@@ -809,16 +1548,29 @@ class ContourWriterBase(object):
                     for key in ['width', 'outline_opacity', 'fill_opacity']:
                         params.pop(key, None)
 
-                fun(foreground, area_def, **params)
-                logger.info("%s added", section.capitalize())
+                layers.append((section, params))
+
+        self.add_overlays_batch([(foreground, area_def)], layers,
+                                workers=workers)
+        for section, params in layers:
+            logger.info("%s added", section.capitalize())
 
         # Cities management
         if overlays.has_key('cities'):
             DEFAULT_FONT_SIZE = 12
             DEFAULT_OUTLINE = "yellow"
 
-            citylist = [s.lstrip()
-                        for s in overlays['cities']['list'].split(',')]
+            if 'list' in overlays['cities']:
+                citylist = [s.lstrip()
+                            for s in overlays['cities']['list'].split(',')]
+            else:
+                citylist = None
+            min_population = overlays['cities'].get('min_population', None)
+            if min_population is not None:
+                min_population = int(min_population)
+            max_cities = overlays['cities'].get('max_cities', None)
+            if max_cities is not None:
+                max_cities = int(max_cities)
             font_file = overlays['cities']['font']
             font_size = int(overlays['cities'].get('font_size',
                                                    DEFAULT_FONT_SIZE))
@@ -829,7 +1581,8 @@ class ContourWriterBase(object):
 
             self.add_cities(foreground, area_def, citylist, font_file,
                             font_size, pt_size, outline, box_outline,
-                            box_opacity)
+                            box_opacity, min_population=min_population,
+                            max_cities=max_cities)
 
         if cache_file is not None:
             try:
@@ -839,10 +1592,33 @@ class ContourWriterBase(object):
 
         return foreground
 
+    def _get_cities(self, shapefilename):
+        """Get the index of the cities database, loading it on first use
+        """
+        key = ('CITIES', shapefilename)
+        cities = self._shape_cache.get(key)
+        if cities is None:
+            with self._load_lock(key):
+                if key in self._shape_cache:
+                    cities = self._shape_cache.get(key)
+                if cities is None:
+                    cities = CityIndex(shapefilename)
+                    self._shape_cache.put(key, cities, cities.nbytes)
+        return cities
+
     def add_cities(self, image, area_def, citylist, font_file, font_size,
-                   ptsize, outline, box_outline, box_opacity):
+                   ptsize, outline, box_outline, box_opacity,
+                   min_population=None, max_cities=None):
         """Add cities (point and name) to a PIL image object
 
+        :Parameters:
+        citylist : list of str or None
+            Names of the cities to add. If None, all cities within the
+            area are candidates.
+        min_population : int, optional
+            Only add cities with at least this many inhabitants
+        max_cities : int, optional
+            Only add the this many most populous of the selected cities
         """
 
         try:
@@ -856,7 +1632,7 @@ class ContourWriterBase(object):
 
         # Area and projection info
         x_size, y_size = image.size
-        prj = pyproj.Proj(proj4_string)
+        prj = get_proj(proj4_string)
 
         # read shape file with points
         # Sc-Kh shapefilename = os.path.join(self.db_root_path,
@@ -864,54 +1640,349 @@ class ContourWriterBase(object):
         shapefilename = os.path.join(
             self.db_root_path, os.path.join("CITIES",
                                             "cities_15000_alternativ.shp"))
-        try:
-            s = shapefile.Reader(shapefilename)
-            shapes = s.shapes()
-        except AttributeError:
-            raise ShapeFileError('Could not find shapefile %s'
-                                 % shapefilename)
+        cities = self._get_cities(shapefilename)
 
         font = self._get_font(outline, font_file, font_size)
 
-        # Iterate through shapes
-        for i, shape in enumerate(shapes):
-            # Select cities with name
-            record = s.record(i)
-            if record[3] in citylist:
+        # Select cities with name, or within the area, and project them all
+        # at once
+        if citylist is None:
+            lon_min, lon_max, lat_min, lat_max = \
+                _get_lon_lat_bounding_box(area_extent, x_size, y_size, prj)
+            city_ids = cities.query(lon_min, lon_max, lat_min, lat_max,
+                                    min_population=min_population)
+        else:
+            city_ids = cities.find(citylist)
+            if min_population is not None:
+                city_ids = cities.filter_population(city_ids, min_population)
+        xs, ys, inside = _get_point_pixels(cities.lonlats[city_ids],
+                                           area_extent, x_size, y_size, prj)
+        if not inside.all():
+            logger.debug("%d cities outside the area not added",
+                         np.count_nonzero(~inside))
+        city_ids = city_ids[inside]
+        xs = xs[inside]
+        ys = ys[inside]
+        if max_cities is not None:
+            keep = np.searchsorted(city_ids,
+                                   cities.most_populous(city_ids, max_cities))
+            city_ids = city_ids[keep]
+            xs = xs[keep]
+            ys = ys[keep]
+        city_names = cities.names(city_ids)
+
+        for city_name, x, y in zip(city_names, xs, ys):
+            # add_dot
+            if ptsize is not None:
+                dot_box = [x - ptsize, y - ptsize,
+                           x + ptsize, y + ptsize]
+                self._draw_ellipse(
+                    draw, dot_box, fill=outline, outline=outline)
+                text_position = [x + 9, y - 5]  # FIX ME
+            else:
+                text_position = [x, y]
 
-                city_name = record[3]
+            # add text_box
+            self._draw_text_box(draw, text_position, city_name, font,
+                                outline, box_outline, box_opacity)
+            logger.info("%s added", str(city_name))
 
-                # use only parts of _get_pixel_index
-                # Get shape data as array and reproject
-                shape_data = np.array(shape.points)
-                lons = shape_data[:, 0][0]
-                lats = shape_data[:, 1][0]
+        self._finalize(draw)
 
-                try:
-                    (x, y) = area_def.get_xy_from_lonlat(lons, lats)
-                except ValueError as exc:
-                    logger.debug("Point not added (%s)", str(exc))
-                else:
 
-                    # add_dot
-                    if ptsize is not None:
-                        dot_box = [x - ptsize, y - ptsize,
-                                   x + ptsize, y + ptsize]
-                        self._draw_ellipse(
-                            draw, dot_box, fill=outline, outline=outline)
-                        text_position = [x + 9, y - 5]  # FIX ME
-                    else:
-                        text_position = [x, y]
+# Writer of a worker process of a parallel batch
+_worker_writer = None
 
-                # add text_box
-                    self._draw_text_box(draw, text_position, city_name, font,
-                                        outline, box_outline, box_opacity)
-                    logger.info("%s added", str(city_name))
 
-        self._finalize(draw)
+def _get_text_size(draw, txt, font):
+    """Return the width and height of a text drawn on a canvas
+    """
+    try:
+        textsize = draw.textsize
+    except AttributeError:
+        # Pillow 10 removed ImageDraw.textsize
+        left, top, right, bottom = draw.textbbox((0, 0), txt, font)
+        return right - left, bottom - top
+    return textsize(txt, font)
+
+
+def _prefetch_shapes(writer_ref, key, shapefilename):
+    """Load a shapefile in the background for a writer still in use
+    """
+    writer = writer_ref()
+    if writer is not None:
+        writer._load_shapes(key, shapefilename)
+
+
+def _stop_pool(pool):
+    """Stop the prefetching threads of a writer
+    """
+    pool.close()
+    # The writer may be collected by one of its own threads, which
+    # cannot wait for itself
+    if threading.current_thread() not in pool._pool:
+        pool.join()
+
+
+def _get_process_context():
+    """Return the multiprocessing context starting the drawing processes
+    """
+    try:
+        return multiprocessing.get_context('forkserver')
+    except ValueError:
+        # No forkserver on Windows
+        return multiprocessing.get_context('spawn')
+
+
+def _stop_process_pool(pool):
+    """Stop the drawing processes of a writer
+    """
+    pool.close()
+    pool.join()
+
+
+def _init_worker(writer_class, state):
+    """Create the writer of a worker process
+    """
+    global _worker_writer
+    _worker_writer = object.__new__(writer_class)
+    _worker_writer.__setstate__(state)
+
+
+def _draw_layer(size, area_def, overlay, kwargs):
+    """Draw one overlay of an area in a worker process. The overlay is
+    compiled once and drawn on a black and on a white image, which together
+    give the blending of every pixel with any background. Returns the data
+    of both images.
+    """
+    plan = _worker_writer.compile(area_def, [(overlay, kwargs)],
+                                  size[0], size[1])
+    black = plan.render(Image.new('RGB', size, (0, 0, 0)))
+    white = plan.render(Image.new('RGB', size, (255, 255, 255)))
+    return black.tobytes(), white.tobytes()
+
+
+def _composite(image, black, white):
+    """Draw a layer, given as RGB images of the layer drawn on black and on
+    white, over *image*. Drawing blends each channel linearly, so the
+    result is black + (white - black) * background / 255.
+    """
+    mode = image.mode
+    base = image if mode in ('RGB', 'RGBA') else image.convert('RGB')
+    data = np.asarray(base, dtype=np.float64)
+    black = np.asarray(black, dtype=np.float64)
+    white = np.asarray(white, dtype=np.float64)
+    res = data.copy()
+    res[:, :, :3] = black + (white - black) * data[:, :, :3] / 255.0
+    if mode == 'RGBA':
+        # Opacity of the layer, drawn over the alpha channel
+        alpha = 1.0 - (white - black).mean(axis=2) / 255.0
+        res[:, :, 3] = data[:, :, 3] + (255.0 - data[:, :, 3]) * alpha
+    res = Image.fromarray(np.round(res).astype(np.uint8), base.mode)
+    image.paste(res if mode == base.mode else res.convert(mode))
+
+
+def _get_overlay_list(layers):
+    """Return overlays given as a dict, or list, as a list of (overlay,
+    arguments) pairs in drawing order
+    """
+    if isinstance(layers, dict):
+        return [(overlay, layers[overlay])
+                for overlay, method in OVERLAYS if overlay in layers]
+    methods = dict(OVERLAYS)
+    for overlay, kwargs in layers:
+        if overlay not in methods:
+            raise ValueError('Unknown overlay: %s' % overlay)
+    return list(layers)
+
+
+def _select_shape_ids(shapes, lon_min, lon_max, lat_min, lat_max,
+                      candidate_ids=None):
+    """Return ids of the shapes in a collection whose bounding box overlaps
+    the lon/lat box, optionally among the sorted *candidate_ids* only
+    """
+    if candidate_ids is not None:
+        mask = bbox_overlaps(shapes.bbox[candidate_ids],
+                             lon_min, lon_max, lat_min, lat_max)
+        return candidate_ids[mask]
+    return shapes.query(lon_min, lon_max, lat_min, lat_max)
+
+
+def _union_bounding_box(boxes):
+    """Return the lon/lat box covering all *boxes*, or None if one of them
+    crosses the dateline
+    """
+    lon_mins, lon_maxs, lat_mins, lat_maxs = \
+        np.asarray(boxes, dtype=np.float64).T
+    if (lon_mins > lon_maxs).any():
+        return None
+    return (lon_mins.min(), lon_maxs.max(), lat_mins.min(), lat_maxs.max())
+
+
+def _get_visible_cap(proj4_string):
+    """Return the lon and lat of the centre and the radius, in degrees, of
+    the part of the earth visible in a geostationary, near-sided
+    perspective or orthographic projection, or None for other projections
+    """
+    params = {}
+    for param in proj4_string.split():
+        key, _, value = param.lstrip('+').partition('=')
+        params[key] = value
+    proj = params.get('proj')
+    if proj not in ('geos', 'nsper', 'ortho') or 'step' in params:
+        return None
+    try:
+        lon_0 = float(params.get('lon_0', 0.0))
+        lat_0 = 0.0 if proj == 'geos' else float(params.get('lat_0', 0.0))
+        if proj == 'ortho':
+            radius = 90.0
+        else:
+            semi_major = float(params.get('a', params.get('R',
+                                                          WGS84_AXES[0])))
+            semi_minor = float(params.get('b', params.get(
+                'R', min(semi_major, WGS84_AXES[1]))))
+            # The horizon seen from the satellite, on a sphere the size of
+            # the polar radius
+            radius = np.degrees(np.arccos(
+                semi_minor / (semi_major + float(params['h']))))
+    except (KeyError, ValueError):
+        return None
+    return lon_0, lat_0, radius + HORIZON_MARGIN
+
+
+def _visible_mask(bbox, cap):
+    """Return the mask of the bounding boxes of *bbox* that may be visible
+    within the *cap* of :func:`_get_visible_cap`, all if *cap* is None
+    """
+    bbox = np.asarray(bbox, dtype=np.float64).reshape(-1, 4)
+    if cap is None:
+        return np.ones(len(bbox), dtype=bool)
+    lon_0, lat_0, radius = cap
+    return bbox_distance(bbox, lon_0, lat_0) <= radius
+
+
+def _get_pixel_extents(bbox, area_extent, x_size, y_size, prj):
+    """Return the larger of the width and height, in pixels, of the
+    projected corners of each of the lon/lat bounding boxes in *bbox*. For
+    boxes small enough for the projection to be nearly linear across them,
+    this bounds the projected size of the shapes within. Boxes with a
+    corner outside the projection get an infinite extent.
+    """
+    bbox = np.asarray(bbox, dtype=np.float64).reshape(-1, 4)
+    if len(bbox) == 0:
+        return np.zeros(0)
+    x, y = prj(bbox[:, [0, 2, 0, 2]].ravel(), bbox[:, [1, 1, 3, 3]].ravel())
+    x = np.asarray(x, dtype=np.float64).reshape(-1, 4)
+    y = np.asarray(y, dtype=np.float64).reshape(-1, 4)
+    x_ll, y_ll, x_ur, y_ur = area_extent
+    with np.errstate(invalid='ignore'):
+        width = (x.max(axis=1) - x.min(axis=1)) * x_size / (x_ur - x_ll)
+        height = (y.max(axis=1) - y.min(axis=1)) * y_size / (y_ur - y_ll)
+        extents = np.maximum(np.abs(width), np.abs(height))
+    valid = _valid_points(x, y).all(axis=1) & np.isfinite(extents)
+    return np.where(valid, extents, np.inf)
+
+
+def _get_max_tolerance(area_extent, x_size, y_size, prj):
+    """Get the largest simplification tolerance, in degrees, of the shapes
+    drawn on an area. The result is memoized per projection, area extent
+    and image size.
+    """
+    key = ('tolerance', normalize_proj4(prj.srs), tuple(area_extent),
+           x_size, y_size)
+    return _bbox_cache.get(key, lambda: PYRAMID_PIXEL_FRACTION *
+                           _compute_pixel_size(area_extent, x_size, y_size,
+                                               prj))
+
+
+def _compute_pixel_size(area_extent, x_size, y_size, prj, n_samples=11):
+    """Compute the smallest distance, in degrees of arc, between
+    neighbouring pixels over a grid of *n_samples* by *n_samples* points of
+    the area. Returns 0 if no point is within the projection.
+    """
+    x_ll, y_ll, x_ur, y_ur = area_extent
+    pixel_x = (x_ur - x_ll) / float(x_size)
+    pixel_y = (y_ur - y_ll) / float(y_size)
+    x, y = np.meshgrid(np.linspace(x_ll, x_ur - pixel_x, n_samples),
+                       np.linspace(y_ll, y_ur - pixel_y, n_samples))
+    x = x.ravel()
+    y = y.ravel()
+    lons, lats = prj(np.concatenate((x, x + pixel_x, x)),
+                     np.concatenate((y, y, y + pixel_y)), inverse=True)
+    lons = np.radians(np.asarray(lons).reshape(3, -1))
+    lats = np.radians(np.asarray(lats).reshape(3, -1))
+    with np.errstate(invalid='ignore'):
+        cos_dist = (np.sin(lats[0]) * np.sin(lats[1:]) +
+                    np.cos(lats[0]) * np.cos(lats[1:]) *
+                    np.cos(lons[1:] - lons[0]))
+        dist = np.degrees(np.arccos(np.clip(cos_dist, -1.0, 1.0)))
+    # Pixels collapsing to a point, e.g. at the poles of lon/lat grids,
+    # are left out
+    valid = (_valid_points(lons[0], lats[0]) &
+             _valid_points(lons[1:], lats[1:]) & (dist > 0))
+    if not valid.any():
+        return 0.0
+    return float(dist[valid].min())
+
+
+def get_resolution(area_extent, x_size, y_size):
+    """Get the dataset resolution, {'c', 'l', 'i', 'h', 'f'}, matching the
+    pixel size of an area
+    """
+    x_resolution = (area_extent[2] - area_extent[0]) / float(x_size)
+    y_resolution = (area_extent[3] - area_extent[1]) / float(y_size)
+    res = min(x_resolution, y_resolution)
+
+    if res > 25000:
+        return "c"
+    elif res > 5000:
+        return "l"
+    elif res > 1000:
+        return "i"
+    elif res > 200:
+        return "h"
+    else:
+        return "f"
+
+
+def _get_feature_type(shape_type):
+    """Get the feature type to draw shapes of a shapefile shape type as
+    """
+    if shape_type == shapefile.POLYLINE:
+        return "line"
+    elif shape_type == shapefile.POLYGON:
+        return "polygon"
+    else:
+        raise ShapeFileError("Unsupported shape type: " + str(shape_type))
+
+
+def _select_shapes(shapes, lon_min, lon_max, lat_min, lat_max):
+    """Return the shapes whose bounding box overlaps the lon/lat box
+    """
+    if isinstance(shapes, ShapeCollection):
+        shape_ids = _select_shape_ids(shapes, lon_min, lon_max,
+                                      lat_min, lat_max)
+    else:
+        shapes = list(shapes)
+        bbox = np.array([shape.bbox for shape in shapes],
+                        dtype=np.float64).reshape(-1, 4)
+        shape_ids = np.flatnonzero(bbox_overlaps(bbox, lon_min, lon_max,
+                                                 lat_min, lat_max))
+    return [shapes[shape_id] for shape_id in shape_ids]
+
 
 def _get_lon_lat_bounding_box(area_extent, x_size, y_size, prj):
-    """Get extreme lon and lat values
+    """Get extreme lon and lat values. The result is memoized per
+    projection, area extent and image size.
+    """
+    key = ('bbox', normalize_proj4(prj.srs), tuple(area_extent),
+           x_size, y_size)
+    return _bbox_cache.get(key, lambda: _compute_lon_lat_bounding_box(
+        area_extent, x_size, y_size, prj))
+
+
+def _compute_lon_lat_bounding_box(area_extent, x_size, y_size, prj):
+    """Compute extreme lon and lat values from the edges of the area
     """
 
     x_ll, y_ll, x_ur, y_ur = area_extent
@@ -923,15 +1994,17 @@ def _get_lon_lat_bounding_box(area_extent, x_size, y_size, prj):
     lons_s3, lats_s3 = prj(np.ones(y_range.size) * x_ur, y_range, inverse=True)
     lons_s4, lats_s4 = prj(x_range, np.ones(x_range.size) * y_ll, inverse=True)
 
-    angle_sum = 0
-    prev = None
-    for lon in np.concatenate((lons_s1, lons_s2, lons_s3[::-1], lons_s4[::-1])):
-        if prev is not None:
-            delta = lon - prev
-            if abs(delta) > 180:
-                delta = (abs(delta) - 360) * np.sign(delta)
-            angle_sum += delta
-        prev = lon
+    lons = np.concatenate((lons_s1, lons_s2, lons_s3[::-1], lons_s4[::-1]))
+    lats = np.concatenate((lats_s1, lats_s2, lats_s3, lats_s4))
+    if not np.all(_valid_points(lons, lats)):
+        # Edges outside the projection, e.g. full disk geos
+        return -180, 180, -90, 90
+
+    # Winding of the edges around the poles
+    delta = np.diff(lons)
+    wrap = np.abs(delta) > 180
+    delta[wrap] = (np.abs(delta[wrap]) - 360) * np.sign(delta[wrap])
+    angle_sum = delta.sum()
 
     if round(angle_sum) == -360:
         # Covers NP
@@ -982,55 +2055,338 @@ def _get_lon_lat_bounding_box(area_extent, x_size, y_size, prj):
     return lon_min, lon_max, lat_min, lat_max
 
 
+def _iter_part_points(shapes):
+    """Iterate over the points of the parts of shapes
+    """
+    for shape in shapes:
+        parts = list(shape.parts) + [len(shape.points)]
+        for i in range(len(parts) - 1):
+            yield shape.points[parts[i]:parts[i + 1]]
+
+
+def _iter_projected(point_arrays, area_extent, x_size, y_size, prj,
+                    x_offset=0, y_offset=0, max_points=MAX_BATCH_POINTS):
+    """Project lon/lat point arrays in batches of about *max_points* points,
+    with one projection call and one conversion to image coordinates per
+    batch. Yields the projected x and y and the image coordinates n_x and
+    n_y of each array.
+    """
+    batch = []
+    n_points = 0
+    for points in point_arrays:
+        points = np.asarray(points).reshape(-1, 2)
+        batch.append(points)
+        n_points += len(points)
+        if n_points >= max_points:
+            for projected in _project_batch(batch, area_extent,
+                                            x_size, y_size, prj,
+                                            x_offset, y_offset):
+                yield projected
+            batch = []
+            n_points = 0
+    if batch:
+        for projected in _project_batch(batch, area_extent, x_size, y_size,
+                                        prj, x_offset, y_offset):
+            yield projected
+
+
+def _project_batch(batch, area_extent, x_size, y_size, prj,
+                   x_offset, y_offset):
+    """Project a list of point arrays as one coordinate buffer and split
+    the result back per array
+    """
+    coords = np.concatenate(batch)
+    if len(coords) == 0:
+        empty = np.zeros(0)
+        return [(empty, empty, empty, empty)] * len(batch)
+
+    x_ll, y_ll, x_ur, y_ur = area_extent
+    x, y = prj(coords[:, 0], coords[:, 1])
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    # Convert to pixel index coordinates
+    l_x = (x_ur - x_ll) / x_size
+    l_y = (y_ur - y_ll) / y_size
+    n_x = ((-x_ll + x) / l_x) + 0.5 + x_offset
+    n_y = ((y_ur - y) / l_y) + 0.5 + y_offset
+
+    bounds = np.cumsum([len(points) for points in batch])[:-1]
+    return zip(np.split(x, bounds), np.split(y, bounds),
+               np.split(n_x, bounds), np.split(n_y, bounds))
+
+
+def _get_point_pixels(lonlats, area_extent, x_size, y_size, prj):
+    """Map lon/lat points to the integer column and row of the pixels
+    containing them. Returns the columns, the rows and the mask of the
+    points inside the image.
+    """
+    x_ll, y_ll, x_ur, y_ur = area_extent
+    x, y = prj(lonlats[:, 0], lonlats[:, 1])
+    with np.errstate(invalid='ignore'):
+        cols = np.floor((np.asarray(x) - x_ll) / ((x_ur - x_ll) / x_size))
+        rows = np.floor((y_ur - np.asarray(y)) / ((y_ur - y_ll) / y_size))
+        inside = ((cols >= 0) & (cols < x_size) &
+                  (rows >= 0) & (rows < y_size))
+    cols = np.where(inside, cols, 0).astype(np.int64)
+    rows = np.where(inside, rows, 0).astype(np.int64)
+    return cols, rows, inside
+
+
+def _iter_pixel_coords(point_arrays, area_extent, x_size, y_size, prj,
+                       x_offset=0, y_offset=0):
+    """Map lon/lat point arrays to image coordinates. Yields the (n, 2)
+    array of image coordinates and the mask of points within the
+    projection of each array.
+    """
+    for x, y, n_x, n_y in _iter_projected(point_arrays, area_extent,
+                                          x_size, y_size, prj,
+                                          x_offset=x_offset,
+                                          y_offset=y_offset):
+        yield np.vstack((n_x, n_y)).T, _valid_points(x, y)
+
+
+def _iter_pixel_index(point_arrays, area_extent, x_size, y_size, prj,
+                      x_offset=0, y_offset=0):
+    """Map lon/lat point arrays to image coordinates, split where they
+    leave the projection. Yields the index arrays of the segments within
+    the projection and whether the array was split for each non-empty
+    array.
+    """
+    for x, y, n_x, n_y in _iter_projected(point_arrays, area_extent,
+                                          x_size, y_size, prj,
+                                          x_offset=x_offset,
+                                          y_offset=y_offset):
+        if len(x) == 0:
+            continue
+        yield _get_segments(x, y, n_x, n_y)
+
+
+def _iter_shape_ops(feature_type, point_arrays, area_extent, x_size, y_size,
+                    prj, x_offset=0, y_offset=0):
+    """Iterate over the drawing operations of lon/lat point arrays drawn as
+    polygons or lines. Polygons split where they leave the projection are
+    drawn as lines.
+    """
+    feature_type = feature_type.lower()
+    if feature_type not in ('polygon', 'line'):
+        raise ValueError('Unknown contour type: %s' % feature_type)
+    for index_arrays, is_reduced in _iter_pixel_index(point_arrays,
+                                                      area_extent,
+                                                      x_size, y_size, prj,
+                                                      x_offset=x_offset,
+                                                      y_offset=y_offset):
+        if feature_type == 'polygon' and not is_reduced:
+            code = POLYGON
+        else:
+            code = LINE
+        for index_array in index_arrays:
+            yield code, index_array
+
+
+def _iter_tiled_ops(feature_type, shapes, shape_ids, area_extent,
+                    x_size, y_size, prj, x_offset=0, y_offset=0):
+    """Iterate over the drawing operations of shapes clipped at tile edges.
+    The pieces of each parent shape are filled together, and only the
+    edges of the parent shape are outlined so no seams show at the tile
+    edges.
+    """
+    feature_type = feature_type.lower()
+    if feature_type not in ('polygon', 'line'):
+        raise ValueError('Unknown contour type: %s' % feature_type)
+
+    parent_ids = shapes.parent_ids[shape_ids]
+    order = np.argsort(parent_ids, kind='mergesort')
+    groups = np.split(shape_ids[order],
+                      np.flatnonzero(np.diff(parent_ids[order])) + 1)
+
+    # Project the pieces of all groups in batches
+    projected = _iter_pixel_coords(
+        (np.asarray(shapes[shape_id].points, dtype=np.float64)
+         for group in groups for shape_id in group),
+        area_extent, x_size, y_size, prj,
+        x_offset=x_offset, y_offset=y_offset)
+
+    for group in groups:
+        rings = []
+        outlines = []
+        is_reduced = False
+        for shape_id in group:
+            index_array, valid = next(projected)
+            if len(index_array) == 0:
+                continue
+            if valid.all():
+                rings.append(index_array)
+            else:
+                is_reduced = True
+            # Outline the original edges with both ends within the
+            # projection
+            clip_edges = np.asarray(shapes[shape_id].clip_edges)
+            edge_ok = ~clip_edges[:-1] & valid[:-1] & valid[1:]
+            outlines.extend(_split_runs(index_array, edge_ok))
+
+        if feature_type == 'polygon':
+            if not is_reduced:
+                for index_array in rings:
+                    yield FILL, index_array
+            for index_array in outlines:
+                yield OUTLINE, index_array
+        else:
+            for index_array in outlines:
+                yield LINE, index_array
+
+
+def _clip_ops(ops, x_size, y_size, margin=CLIP_MARGIN, chunk_size=1024):
+    """Clip drawing operations to the image extended by *margin* pixels, so
+    only the geometry on or near the image reaches the drawing engine.
+    Polygons and lines lose their vertices beyond the extended image, the
+    edges crossing it are kept whole, so the image is drawn the same. The
+    bounds of the operations are computed for chunks of *chunk_size*
+    operations at once.
+    """
+    x_min = y_min = -margin
+    x_max = x_size + margin
+    y_max = y_size + margin
+    ops = iter(ops)
+    while True:
+        chunk = list(itertools.islice(ops, chunk_size))
+        if not chunk:
+            return
+        sizes = np.array([len(index_array) for code, index_array in chunk])
+        inside = sizes == 0
+        outside = np.zeros(len(chunk), dtype=bool)
+        nonempty = ~inside
+        if nonempty.any():
+            coords = np.concatenate([index_array for code, index_array
+                                     in chunk if len(index_array)])
+            starts = np.concatenate(([0], np.cumsum(sizes[nonempty])[:-1]))
+            lower = np.minimum.reduceat(coords, starts, axis=0)
+            upper = np.maximum.reduceat(coords, starts, axis=0)
+            inside[nonempty] = ((lower[:, 0] >= x_min) &
+                                (lower[:, 1] >= y_min) &
+                                (upper[:, 0] <= x_max) &
+                                (upper[:, 1] <= y_max))
+            outside[nonempty] = ((lower[:, 0] > x_max) |
+                                 (lower[:, 1] > y_max) |
+                                 (upper[:, 0] < x_min) |
+                                 (upper[:, 1] < y_min))
+
+        for (code, index_array), is_inside, is_outside in \
+                zip(chunk, inside, outside):
+            if is_inside:
+                yield code, index_array
+            elif is_outside:
+                continue
+            elif code in (LINE, OUTLINE):
+                for piece in trim_polyline(index_array, x_min, y_min,
+                                           x_max, y_max):
+                    yield code, piece
+            else:
+                ring = trim_polygon(index_array, x_min, y_min, x_max, y_max)
+                if ring is not None:
+                    yield code, ring
+
+
+def _decimate_ops(ops, tolerance, chunk_size=1024):
+    """Drop the vertices of polygons and lines in the same cell of a grid
+    of *tolerance* pixels as the vertex before them, keeping the first and
+    last vertex of each. The vertices kept are never more than a cell
+    diagonal apart from those dropped. The vertices of chunks of
+    *chunk_size* operations are binned at once. Fills of tile pieces are
+    kept as they are, so the pieces still meet at the tile edges.
+    """
+    ops = iter(ops)
+    while True:
+        chunk = list(itertools.islice(ops, chunk_size))
+        if not chunk:
+            return
+        sizes = np.array([len(index_array) for code, index_array in chunk])
+        if not sizes.any():
+            for op in chunk:
+                yield op
+            continue
+        coords = np.concatenate([index_array for code, index_array
+                                 in chunk])
+        cells = np.floor(coords / tolerance)
+        keep = np.ones(len(coords), dtype=bool)
+        keep[1:] = (cells[1:] != cells[:-1]).any(axis=1)
+        ends = np.cumsum(sizes)
+        starts = ends - sizes
+        keep[starts[sizes > 0]] = True
+        keep[ends[sizes > 0] - 1] = True
+
+        for (code, index_array), start, end in zip(chunk, starts, ends):
+            if code == FILL:
+                yield code, index_array
+            else:
+                yield code, index_array[keep[start:end]]
+
+
+def _simplify_ops(ops, tolerance):
+    """Simplify polygons and lines with the Douglas-Peucker algorithm.
+    Fills of tile pieces are kept as they are.
+    """
+    for code, index_array in ops:
+        if code == FILL:
+            yield code, index_array
+        else:
+            yield code, douglas_peucker(index_array, tolerance)
+
+
+def _split_runs(index_array, edge_mask):
+    """Split a poly-line at the edges, from point i to i + 1, that are not
+    in *edge_mask*
+    """
+    padded = np.concatenate(([0], edge_mask.astype(np.int8), [0]))
+    steps = np.diff(padded)
+    starts = np.flatnonzero(steps == 1)
+    ends = np.flatnonzero(steps == -1)
+    return [index_array[start:end + 1] for start, end in zip(starts, ends)]
+
+
 def _get_pixel_index(shape, area_extent, x_size, y_size, prj,
                      x_offset=0, y_offset=0):
     """Map coordinates of shape to image coordinates
     """
+    for index_arrays, is_reduced in _iter_pixel_index([shape.points],
+                                                      area_extent,
+                                                      x_size, y_size, prj,
+                                                      x_offset=x_offset,
+                                                      y_offset=y_offset):
+        return index_arrays, is_reduced
+    return [], False
+
+
+def _valid_points(x, y):
+    """Return the mask of projected points within the projection. Points
+    outside are marked by 1e30, inf or NaN depending on the pyproj version.
+    """
+    return (np.isfinite(x) & np.isfinite(y) & (x != 1e30) & (y != 1e30))
 
-    # Get shape data as array and reproject
-    shape_data = np.array(shape.points)
-    lons = shape_data[:, 0]
-    lats = shape_data[:, 1]
-
-    x_ll, y_ll, x_ur, y_ur = area_extent
 
-    x, y = prj(lons, lats)
+def _get_segments(x, y, n_x, n_y):
+    """Split projected points, x and y, in segments within the projection.
+    Returns the image coordinates, n_x and n_y, of the segments and whether
+    the points were split.
+    """
 
     # Handle out of bounds
-    i = 0
-    segments = []
-    if 1e30 in x or 1e30 in y:
-        # Split polygon in line segments within projection
+    valid = _valid_points(x, y)
+    if not valid.all():
+        # Split polygon in line segments within projection, at the
+        # boundaries of the runs of valid points
         is_reduced = True
-        if x[0] == 1e30 or y[0] == 1e30:
-            in_segment = False
-        else:
-            in_segment = True
-
-        for j in range(x.size):
-            if (x[j] == 1e30 or y[j] == 1e30):
-                if in_segment:
-                    segments.append((x[i:j], y[i:j]))
-                    in_segment = False
-            elif not in_segment:
-                in_segment = True
-                i = j
-        if in_segment:
-            segments.append((x[i:], y[i:]))
-
+        steps = np.diff(np.concatenate(([0], valid.astype(np.int8), [0])))
+        starts = np.flatnonzero(steps == 1)
+        ends = np.flatnonzero(steps == -1)
+        segments = [(n_x[start:end], n_y[start:end])
+                    for start, end in zip(starts, ends)]
     else:
         is_reduced = False
-        segments = [(x, y)]
-
-    # Convert to pixel index coordinates
-    l_x = (x_ur - x_ll) / x_size
-    l_y = (y_ur - y_ll) / y_size
+        segments = [(n_x, n_y)]
 
     index_arrays = []
-    for x, y in segments:
-        n_x = ((-x_ll + x) / l_x) + 0.5 + x_offset
-        n_y = ((y_ur - y) / l_y) + 0.5 + y_offset
-
+    for n_x, n_y in segments:
         index_array = np.vstack((n_x, n_y)).T
         index_arrays.append(index_array)
 
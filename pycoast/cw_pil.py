@@ -50,7 +50,7 @@ class ContourWriter(ContourWriterBase):
         return ImageDraw.Draw(image)
 
     def _engine_text_draw(self, draw, x_pos, y_pos, txt, font, **kwargs):
-        draw.text(x_pos, y_pos, txt, font=font, fill=kwargs['fill'])
+        draw.text((x_pos, y_pos), txt, font=font, fill=kwargs['fill'])
 
     def _draw_polygon(self, draw, coordinates, **kwargs):
         """Draw polygon
@@ -298,8 +298,9 @@ class ContourWriter(ContourWriterBase):
             Projection of area as Proj.4 string
         area_extent : list
             Area extent as a list (LL_x, LL_y, UR_x, UR_y)
-        resolution : str, optional {'c', 'l', 'i', 'h', 'f'}
-            Dataset resolution to use
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use. 'auto' selects it from the pixel
+            size of the area.
         level : int, optional {1, 2, 3, 4}
             Detail level of dataset
         fill : str or (R, G, B), optional
@@ -329,8 +330,9 @@ class ContourWriter(ContourWriterBase):
             Projection of area as Proj.4 string
         area_extent : list
             Area extent as a list (LL_x, LL_y, UR_x, UR_y)
-        resolution : str, optional {'c', 'l', 'i', 'h', 'f'}
-            Dataset resolution to use
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use. 'auto' selects it from the pixel
+            size of the area.
         level : int, optional {1, 2, 3, 4}
             Detail level of dataset
         fill : str or (R, G, B)
@@ -361,8 +363,9 @@ class ContourWriter(ContourWriterBase):
             Projection of area as Proj.4 string
         area_extent : list
             Area extent as a list (LL_x, LL_y, UR_x, UR_y)
-        resolution : str, optional {'c', 'l', 'i', 'h', 'f'}
-            Dataset resolution to use
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use. 'auto' selects it from the pixel
+            size of the area.
         level : int, optional {1, 2, 3}
             Detail level of dataset
         outline : str or (R, G, B), optional
@@ -389,8 +392,9 @@ class ContourWriter(ContourWriterBase):
             Projection of area as Proj.4 string
         area_extent : list
             Area extent as a list (LL_x, LL_y, UR_x, UR_y)
-        resolution : str, optional {'c', 'l', 'i', 'h', 'f'}
-            Dataset resolution to use
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use. 'auto' selects it from the pixel
+            size of the area.
         level : int, optional {1, 2, 3}
             Detail level of dataset
         outline : str or (R, G, B), optional
@@ -417,8 +421,9 @@ class ContourWriter(ContourWriterBase):
             Projection of area as Proj.4 string
         area_extent : list
             Area extent as a list (LL_x, LL_y, UR_x, UR_y)
-        resolution : str, optional {'c', 'l', 'i', 'h', 'f'}
-            Dataset resolution to use
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use. 'auto' selects it from the pixel
+            size of the area.
         level : int, optional {1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11}
             Detail level of dataset
         outline : str or (R, G, B), optional
@@ -445,8 +450,9 @@ class ContourWriter(ContourWriterBase):
             Projection of area as Proj.4 string
         area_extent : list
             Area extent as a list (LL_x, LL_y, UR_x, UR_y)
-        resolution : str, optional {'c', 'l', 'i', 'h', 'f'}
-            Dataset resolution to use
+        resolution : str, optional {'c', 'l', 'i', 'h', 'f', 'auto'}
+            Dataset resolution to use. 'auto' selects it from the pixel
+            size of the area.
         level : int, optional {1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11}
             Detail level of dataset
         outline : str or (R, G, B), optional
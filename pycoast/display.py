@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pycoast, Writing of coastlines, borders and rivers to images in Python
+#
+# Copyright (C) 2011-2016
+#    Esben S. Nielsen
+#    Hróbjartur Þorsteinsson
+#    Stefano Cerino
+#    Katja Hungershofer
+#    Panu Lahtinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pixel geometry of overlays, ready to be drawn.
+"""
+
+import numpy as np
+
+# Drawing operations
+POLYGON = 0  # filled and outlined polygon
+LINE = 1     # outlined line
+FILL = 2     # polygon filled only, if a fill colour is given. Runs of
+             # FILL pieces of shapes cut at tile edges are filled together
+OUTLINE = 3  # outline of FILL pieces, if an outline colour is given
+
+
+class DisplayList(object):
+
+    """Sequence of drawing operations on pixel coordinates, stored as flat
+    arrays. Iterating over it gives (operation, (n, 2) array) pairs.
+
+    :Parameters:
+    codes : array
+        (n_ops,) operation of each item, POLYGON, LINE, FILL or OUTLINE
+    offsets : array
+        (n_ops + 1,) index of the first point of each item
+    coords : array
+        (n_points, 2) pixel coordinates
+    """
+
+    def __init__(self, codes, offsets, coords):
+        self.codes = np.asarray(codes, dtype=np.int8)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.coords = np.asarray(coords, dtype=np.float64).reshape((-1, 2))
+
+    @classmethod
+    def from_ops(cls, ops):
+        """Build a display list from (operation, (n, 2) array) pairs
+        """
+        codes = []
+        arrays = []
+        for code, index_array in ops:
+            codes.append(code)
+            arrays.append(index_array)
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        if arrays:
+            offsets[1:] = np.cumsum([len(array) for array in arrays])
+            coords = np.concatenate(arrays)
+        else:
+            coords = np.zeros((0, 2))
+        return cls(codes, offsets, coords)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        for i, code in enumerate(self.codes):
+            yield (code, self.coords[self.offsets[i]:self.offsets[i + 1]])
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays
+        """
+        return self.codes.nbytes + self.offsets.nbytes + self.coords.nbytes
+
+
+class OverlayPlan(object):
+
+    """Overlay compiled for an area and image size by
+    :meth:`ContourWriterBase.compile`. All reading, culling and projection
+    is done when compiling, rendering only rasterises the stored drawing
+    operations.
+
+    :Parameters:
+    writer : ContourWriterBase
+        Writer drawing the plan
+    size : tuple of int
+        (x_size, y_size) of the images the plan is drawn on
+    groups : list of list
+        Drawing calls, (method name, arguments, style) triples, of each
+        canvas of the overlay
+    """
+
+    def __init__(self, writer, size, groups):
+        self.writer = writer
+        self.size = tuple(size)
+        self.groups = groups
+
+    def __len__(self):
+        return sum(len(group) for group in self.groups)
+
+    @property
+    def nbytes(self):
+        """Memory used by the pixel coordinates of the contour layers
+        """
+        return sum(args[0].nbytes for group in self.groups
+                   for name, args, kwargs in group if name == '_draw_ops')
+
+    def render(self, image):
+        """Draw the overlay on *image*, which must have the size the plan
+        was compiled for. Returns the image.
+        """
+        if tuple(image.size) != self.size:
+            raise ValueError('Plan compiled for image size %s, not %s'
+                             % (str(self.size), str(tuple(image.size))))
+        for group in self.groups:
+            draw = self.writer._get_canvas(image)
+            for name, args, kwargs in group:
+                getattr(self.writer, name)(draw, *args, **kwargs)
+            self.writer._finalize(draw)
+        return image
+
+
+class _PlanCanvas(object):
+
+    """Stands in for the image while a plan is compiled, collecting the
+    drawing calls of each canvas
+    """
+
+    def __init__(self, size):
+        self.size = tuple(size)
+        self.groups = []
+
+
+class _RecordingMixin(object):
+
+    """Writer methods recording drawing calls instead of drawing
+    """
+
+    def _get_canvas(self, image):
+        group = []
+        image.groups.append(group)
+        return group
+
+    def _finalize(self, draw):
+        pass
+
+    def _draw_ops(self, draw, ops, **kwargs):
+        if not isinstance(ops, DisplayList):
+            ops = DisplayList.from_ops(ops)
+        draw.append(('_draw_ops', (ops,), kwargs))
+
+    def _draw_polygon(self, draw, *args, **kwargs):
+        draw.append(('_draw_polygon', args, kwargs))
+
+    def _draw_line(self, draw, *args, **kwargs):
+        draw.append(('_draw_line', args, kwargs))
+
+    def _draw_ellipse(self, draw, *args, **kwargs):
+        draw.append(('_draw_ellipse', args, kwargs))
+
+    def _draw_rectangle(self, draw, *args, **kwargs):
+        draw.append(('_draw_rectangle', args, kwargs))
+
+    def _draw_text(self, draw, *args, **kwargs):
+        draw.append(('_draw_text', args, kwargs))
+
+    def _draw_text_box(self, draw, *args, **kwargs):
+        draw.append(('_draw_text_box', args, kwargs))
+
+
+_recording_classes = {}
+
+
+def recording_writer(writer):
+    """Return a writer sharing the state, caches included, of *writer* but
+    recording its drawing calls on a :class:`_PlanCanvas`
+    """
+    cls = type(writer)
+    recording_cls = _recording_classes.get(cls)
+    if recording_cls is None:
+        recording_cls = type('Recording' + cls.__name__,
+                             (_RecordingMixin, cls), {})
+        _recording_classes[cls] = recording_cls
+    recorder = object.__new__(recording_cls)
+    recorder.__dict__ = writer.__dict__
+    return recorder
@@ -0,0 +1,936 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pycoast, Writing of coastlines, borders and rivers to images in Python
+#
+# Copyright (C) 2011-2016
+#    Esben S. Nielsen
+#    Hróbjartur Þorsteinsson
+#    Stefano Cerino
+#    Katja Hungershofer
+#    Panu Lahtinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Columnar in-memory representation of shapefile geometry.
+"""
+
+import logging
+import os
+
+import numpy as np
+import shapefile
+
+from .errors import ShapeFileError
+
+logger = logging.getLogger(__name__)
+
+
+class Shape(object):
+
+    """Light weight shape object with the attributes of a pyshp shape
+    that are used by the contour writers.
+    """
+
+    __slots__ = ('points', 'parts', 'bbox', 'shapeType', 'clip_edges')
+
+    def __init__(self, points, parts, bbox, shapeType, clip_edges=None):
+        self.points = points
+        self.parts = parts
+        self.bbox = bbox
+        self.shapeType = shapeType
+        # Mask of the edges, from point i to i + 1, created by clipping
+        self.clip_edges = clip_edges
+
+
+def bbox_overlaps(bbox, lon_min, lon_max, lat_min, lat_max):
+    """Return a mask of the bounding boxes in *bbox*, an (n, 4) array of
+    (lon_min, lat_min, lon_max, lat_max), that overlap the given box. The
+    box crosses the dateline if *lon_min* > *lon_max*.
+    """
+    if lon_min > lon_max:
+        # The longitudes from lon_min to lon_max + 360, also shifted by a
+        # turn for boxes on the other side of the dateline
+        return (bbox_overlaps(bbox, lon_min, lon_max + 360.0,
+                              lat_min, lat_max) |
+                bbox_overlaps(bbox, lon_min - 360.0, lon_max,
+                              lat_min, lat_max))
+    return ~((lon_max < bbox[:, 0]) | (lon_min > bbox[:, 2]) |
+             (lat_max < bbox[:, 1]) | (lat_min > bbox[:, 3]))
+
+
+def bbox_distance(bbox, lon_0, lat_0):
+    """Return the great circle distance in degrees, on the unit sphere, from
+    the point (*lon_0*, *lat_0*) to the nearest point of each of the
+    bounding boxes in *bbox*, an (n, 4) array of (lon_min, lat_min,
+    lon_max, lat_max)
+    """
+    bbox = np.radians(np.asarray(bbox, dtype=np.float64).reshape(-1, 4))
+    lon_min, lat_min, lon_max, lat_max = bbox.T
+    lon_0 = np.radians(lon_0)
+    lat_0 = np.radians(lat_0)
+
+    # Boxes spanning the longitude of the point are nearest along its
+    # meridian
+    in_lon = np.mod(lon_0 - lon_min, 2 * np.pi) <= lon_max - lon_min
+    along = np.maximum(np.maximum(lat_min - lat_0, lat_0 - lat_max), 0.0)
+
+    # Other boxes are nearest on one of their edge meridians
+    edges = np.minimum(_meridian_distance(lon_min - lon_0, lat_min, lat_max,
+                                          lat_0),
+                       _meridian_distance(lon_max - lon_0, lat_min, lat_max,
+                                          lat_0))
+    return np.degrees(np.where(in_lon, along, edges))
+
+
+def _meridian_distance(delta_lon, lat_min, lat_max, lat_0):
+    """Return the great circle distance in radians from the point (0,
+    *lat_0*) to the nearest point of the meridian *delta_lon* between
+    *lat_min* and *lat_max*
+    """
+    # Latitude of the point of the meridian's great circle nearest to the
+    # point, which is on the meridian or beyond a pole
+    nearest = np.arctan2(np.sin(lat_0), np.cos(lat_0) * np.cos(delta_lon))
+    cos_dist = np.sin(lat_0) * np.sin(lat_min) + \
+        np.cos(lat_0) * np.cos(lat_min) * np.cos(delta_lon)
+    for lat in (lat_max, np.clip(nearest, lat_min, lat_max)):
+        cos_dist = np.maximum(cos_dist, np.sin(lat_0) * np.sin(lat) +
+                              np.cos(lat_0) * np.cos(lat) *
+                              np.cos(delta_lon))
+    return np.arccos(np.clip(cos_dist, -1.0, 1.0))
+
+
+class _GridIndex(object):
+
+    """Uniform lon/lat grid of cells holding sorted lists of ids.
+    """
+
+    def __init__(self, cell_size, ids, offsets, big):
+        self.cell_size = cell_size
+        self.nx = int(np.ceil(360.0 / cell_size))
+        self.ny = int(np.ceil(180.0 / cell_size))
+        self._ids = ids
+        self._offsets = offsets
+        self._big = big
+
+    def _cell(self, lons, lats):
+        """Return grid cell indices of the given coordinates
+        """
+        ix = np.floor((np.asarray(lons) + 180.0) / self.cell_size)
+        iy = np.floor((np.asarray(lats) + 90.0) / self.cell_size)
+        ix = np.clip(ix, 0, self.nx - 1).astype(np.int64)
+        iy = np.clip(iy, 0, self.ny - 1).astype(np.int64)
+        return ix, iy
+
+    def candidates(self, lon_min, lon_max, lat_min, lat_max):
+        """Return sorted ids that may overlap the query box
+        """
+        (ix0, ix1), (iy0, iy1) = self._cell([lon_min, lon_max],
+                                             [lat_min, lat_max])
+        # The cells of one grid row are contiguous in the index
+        rows = np.arange(iy0, iy1 + 1) * self.nx
+        starts = self._offsets[rows + ix0]
+        ends = self._offsets[rows + ix1 + 1]
+        chunks = [self._ids[start:end] for start, end in zip(starts, ends)]
+        return np.unique(np.concatenate(chunks + [self._big]))
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in (self._ids, self._offsets, self._big)
+                   if not isinstance(arr, np.memmap))
+
+
+class BBoxIndex(_GridIndex):
+
+    """Uniform lon/lat grid index over bounding boxes.
+
+    Every bounding box is registered in the grid cells it overlaps, and
+    boxes covering more than *max_cells* cells are kept in a separate list
+    that is always returned as candidates. A query only visits the cells
+    overlapping the query box, so its cost scales with the number of
+    candidates rather than with the size of the dataset.
+
+    :Parameters:
+    bbox : array (n, 4)
+        Bounding boxes as (lon_min, lat_min, lon_max, lat_max)
+    cell_size : float, optional
+        Grid cell size in degrees, chosen from the number of boxes by
+        default
+    max_cells : int, optional
+        Maximum number of cells a box is registered in
+    """
+
+    def __init__(self, bbox, cell_size=None, max_cells=64):
+        bbox = np.asarray(bbox, dtype=np.float64).reshape(-1, 4)
+        n_boxes = len(bbox)
+        if cell_size is None:
+            # Aim for a handful of boxes per cell
+            cell_size = np.sqrt(360.0 * 180.0 * 4 / max(n_boxes, 1))
+            cell_size = float(np.clip(cell_size, 0.5, 30.0))
+        _GridIndex.__init__(self, cell_size, None, None, None)
+
+        ids = np.arange(n_boxes, dtype=np.int64)
+        valid = np.all(np.isfinite(bbox), axis=1)
+        ix0, iy0 = self._cell(bbox[valid, 0], bbox[valid, 1])
+        ix1, iy1 = self._cell(bbox[valid, 2], bbox[valid, 3])
+        width = ix1 - ix0 + 1
+        counts = width * (iy1 - iy0 + 1)
+        small = counts <= max_cells
+        self._big = np.sort(np.concatenate((ids[~valid],
+                                            ids[valid][~small])))
+
+        ix0, iy0, width, counts = ix0[small], iy0[small], width[small], \
+            counts[small]
+        box_ids = np.repeat(ids[valid][small], counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        local = np.arange(counts.sum(), dtype=np.int64) - first
+        width = np.repeat(width, counts)
+        cells = ((np.repeat(iy0, counts) + local // width) * self.nx +
+                 np.repeat(ix0, counts) + local % width)
+        order = np.argsort(cells, kind='mergesort')
+        self._ids = box_ids[order]
+        self._offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(cells,
+                                        minlength=self.nx * self.ny))))
+
+
+class TileIndex(_GridIndex):
+
+    """Index of shapes that are sorted by and clipped to the cells of a
+    regular tile grid.
+
+    :Parameters:
+    tile_size : float
+        Tile size in degrees
+    tile_offsets : array (n_tiles + 1,)
+        Index of the first shape of each tile
+    """
+
+    def __init__(self, tile_size, tile_offsets):
+        _GridIndex.__init__(self, tile_size,
+                            np.arange(tile_offsets[-1], dtype=np.int64),
+                            tile_offsets, np.zeros(0, dtype=np.int64))
+
+
+class ShapeCollection(object):
+
+    """Base class for collections of shapes.
+
+    Subclasses set :attr:`bbox`, an (n, 4) array of (lon_min, lat_min,
+    lon_max, lat_max) per shape, and :attr:`shape_type`, and implement
+    :meth:`_get_shape`.
+    """
+
+    bbox = None
+    shape_type = None
+    _index = None
+
+    def __len__(self):
+        return len(self.bbox)
+
+    def __getitem__(self, shape_id):
+        if shape_id < 0:
+            shape_id += len(self)
+        if not 0 <= shape_id < len(self):
+            raise IndexError('Shape index out of range: %d' % shape_id)
+        return self._get_shape(shape_id)
+
+    def __iter__(self):
+        for shape_id in range(len(self)):
+            yield self._get_shape(shape_id)
+
+    def _get_shape(self, shape_id):
+        raise NotImplementedError
+
+    @property
+    def index(self):
+        """Bounding box index of the shapes, built on first use
+        """
+        if self._index is None:
+            self._index = BBoxIndex(self.bbox)
+        return self._index
+
+    def query(self, lon_min, lon_max, lat_min, lat_max):
+        """Return sorted ids of the shapes whose bounding box overlaps the
+        given lon/lat box. The box crosses the dateline if *lon_min* >
+        *lon_max*.
+        """
+        if lon_min > lon_max:
+            shape_ids = np.union1d(
+                self.index.candidates(lon_min, 180.0, lat_min, lat_max),
+                self.index.candidates(-180.0, lon_max, lat_min, lat_max))
+        else:
+            shape_ids = self.index.candidates(lon_min, lon_max,
+                                              lat_min, lat_max)
+        mask = bbox_overlaps(self.bbox[shape_ids],
+                             lon_min, lon_max, lat_min, lat_max)
+        return shape_ids[mask]
+
+    @property
+    def point_counts(self):
+        """Number of points of each shape
+        """
+        return np.array([len(shape.points) for shape in self],
+                        dtype=np.int64)
+
+    def _arrays(self):
+        """Return the arrays holding the data of the collection
+        """
+        return [self.bbox]
+
+    @property
+    def nbytes(self):
+        """Heap memory used by the collection. Memory mapped arrays live in
+        the page cache and are not counted.
+        """
+        nbytes = sum(arr.nbytes for arr in self._arrays()
+                     if not isinstance(arr, np.memmap))
+        if self._index is not None:
+            nbytes += self._index.nbytes
+        return nbytes
+
+
+class Shapes(ShapeCollection):
+
+    """Shapes stored as flat coordinate, offset and bounding box arrays.
+
+    :Parameters:
+    coords : array (n_points, 2)
+        Lon/lat coordinates of all points of all shapes
+    part_offsets : array (n_parts + 1,)
+        Index in *coords* of the first point of each part
+    shape_offsets : array (n_shapes + 1,)
+        Index in *part_offsets* of the first part of each shape
+    bbox : array (n_shapes, 4)
+        Bounding box of each shape as (lon_min, lat_min, lon_max, lat_max)
+    shape_type : int
+        Shapefile shape type of the shapes
+    """
+
+    def __init__(self, coords, part_offsets, shape_offsets, bbox, shape_type):
+        self.coords = coords
+        self.part_offsets = part_offsets
+        self.shape_offsets = shape_offsets
+        self.bbox = bbox
+        self.shape_type = int(shape_type)
+
+    @classmethod
+    def from_shapes(cls, shapes, shape_type=None):
+        """Create from a sequence of pyshp shapes
+        """
+        n_points = []
+        parts = []
+        bbox = []
+        points = []
+        for shape in shapes:
+            if shape_type is None:
+                shape_type = shape.shapeType
+            n_points.append(len(shape.points))
+            parts.append(list(shape.parts) or [0])
+            bbox.append(getattr(shape, 'bbox', [np.nan] * 4))
+            points.extend(shape.points)
+
+        coords = np.array(points, dtype=np.float64).reshape(-1, 2)
+        point_starts = np.cumsum([0] + n_points)
+        part_offsets = np.concatenate([np.asarray(p, dtype=np.int64) + start
+                                       for p, start in zip(parts,
+                                                           point_starts)] +
+                                      [point_starts[-1:]]).astype(np.int64)
+        shape_offsets = np.cumsum([0] + [len(p) for p in parts],
+                                  dtype=np.int64)
+        bbox = np.array(bbox, dtype=np.float64).reshape(-1, 4)
+        if shape_type is None:
+            shape_type = shapefile.NULL
+        return cls(coords, part_offsets, shape_offsets, bbox, shape_type)
+
+    @property
+    def point_counts(self):
+        part_offsets = np.asarray(self.part_offsets)
+        shape_offsets = np.asarray(self.shape_offsets)
+        return (part_offsets[shape_offsets[1:]] -
+                part_offsets[shape_offsets[:-1]])
+
+    def _arrays(self):
+        return [self.coords, self.part_offsets, self.shape_offsets, self.bbox]
+
+    def _get_shape(self, shape_id):
+        first_part = self.shape_offsets[shape_id]
+        last_part = self.shape_offsets[shape_id + 1]
+        start = self.part_offsets[first_part]
+        end = self.part_offsets[last_part]
+        parts = self.part_offsets[first_part:last_part] - start
+        return Shape(self.coords[start:end], parts, self.bbox[shape_id],
+                     self.shape_type)
+
+
+class TiledShapes(Shapes):
+
+    """Shapes clipped at the edges of a regular lon/lat tile grid and
+    sorted by tile, so only the tiles overlapping an area are read.
+
+    Each shape is the piece of one part of a parent shape within one tile.
+
+    :Parameters:
+    tile_size : float
+        Tile size in degrees
+    tile_offsets : array (n_tiles + 1,)
+        Index of the first shape of each tile
+    parent_ids : array (n_shapes,)
+        Index of the parent shape in the original dataset
+    clip_edges : array (n_points,)
+        True where the edge from a point to the next one lies on a tile
+        edge, i.e. was created by the clipping
+    """
+
+    def __init__(self, coords, part_offsets, shape_offsets, bbox, shape_type,
+                 tile_size, tile_offsets, parent_ids, clip_edges):
+        Shapes.__init__(self, coords, part_offsets, shape_offsets, bbox,
+                        shape_type)
+        self.tile_size = float(tile_size)
+        self.tile_offsets = tile_offsets
+        self.parent_ids = parent_ids
+        self.clip_edges = clip_edges
+        self._index = TileIndex(self.tile_size, tile_offsets)
+
+    def _arrays(self):
+        return Shapes._arrays(self) + [self.tile_offsets, self.parent_ids,
+                                       self.clip_edges]
+
+    def _get_shape(self, shape_id):
+        shape = Shapes._get_shape(self, shape_id)
+        start = self.part_offsets[self.shape_offsets[shape_id]]
+        shape.clip_edges = self.clip_edges[start:start + len(shape.points)]
+        return shape
+
+
+def _clip_ring_at(points, clip_edges, axis, bound, keep_greater):
+    """Clip a ring (without closing point) to one side of the line
+    points[:, axis] == bound, Sutherland-Hodgman style.
+
+    Returns a list of (points, clip_edges) rings.
+    """
+    coord = points[:, axis]
+    if keep_greater:
+        inside = coord >= bound
+    else:
+        inside = coord <= bound
+    if inside.all():
+        return [(points, clip_edges)]
+    if not inside.any():
+        return []
+
+    nxt = np.roll(points, -1, axis=0)
+    crossing = inside != np.roll(inside, -1)
+    delta = np.where(crossing, nxt[:, axis] - coord, 1.0)
+    ratio = np.where(crossing, (bound - coord) / delta, 0.0)
+    intersections = points + ratio[:, np.newaxis] * (nxt - points)
+    intersections[:, axis] = bound
+
+    # Each edge emits its start point if inside, then the intersection if
+    # it crosses. The edge leaving the clip region continues along the
+    # clip line and is marked as created by the clipping.
+    out_points = np.stack((points, intersections), axis=1)
+    out_edges = np.column_stack((clip_edges, inside | clip_edges))
+    is_entry = np.column_stack((np.zeros_like(inside), crossing & ~inside))
+    mask = np.column_stack((inside, crossing))
+    return _split_ring_at(out_points[mask], out_edges[mask], is_entry[mask],
+                          1 - axis)
+
+
+def _split_ring_at(points, clip_edges, is_entry, axis):
+    """Split a ring clipped at a line into separate rings.
+
+    Sutherland-Hodgman joins all pieces of a concave ring by zero width
+    bridges along the clip line. The ring consists of chains running from
+    an entry point on the clip line to an exit point on it. Along the line
+    the crossings of a simple ring pair up as exit and entry of the same
+    gap, so following each exit to its paired entry closes the rings.
+    """
+    entries = np.flatnonzero(is_entry)
+    if len(entries) < 2:
+        return [(points, clip_edges)]
+    # Chains from each entry point to the point before the next entry
+    starts = entries
+    ends = np.roll(entries, -1)
+    n_points = len(points)
+    chains = [np.arange(start, end + (n_points if end <= start else 0)) %
+              n_points for start, end in zip(starts, ends)]
+    # The exit point is the last point of each chain
+    exits = np.array([chain[-1] for chain in chains])
+
+    crossings = np.concatenate((entries, exits))
+    order = np.argsort(points[crossings, axis], kind='mergesort')
+    pairs = crossings[order].reshape(-1, 2)
+    pair_is_entry = is_entry[pairs]
+    if not np.all(pair_is_entry[:, 0] != pair_is_entry[:, 1]):
+        # Not a simple ring, keep the bridges
+        return [(points, clip_edges)]
+    exit_to_entry = {}
+    for first, second in pairs:
+        if is_entry[first]:
+            exit_to_entry[second] = first
+        else:
+            exit_to_entry[first] = second
+    chain_of_entry = dict((entry, i) for i, entry in enumerate(entries))
+
+    rings = []
+    done = np.zeros(len(chains), dtype=bool)
+    for i in range(len(chains)):
+        if done[i]:
+            continue
+        ring = []
+        while not done[i]:
+            done[i] = True
+            ring.append(chains[i])
+            i = chain_of_entry[exit_to_entry[exits[i]]]
+        ring = np.concatenate(ring)
+        if len(ring) >= 3:
+            rings.append((points[ring], clip_edges[ring]))
+    return rings
+
+
+def clip_polygon(points, x_min, y_min, x_max, y_max, clip_edges=None):
+    """Clip a closed ring to a rectangle.
+
+    Returns a list of the clipped, closed rings together with the masks of
+    their edges lying on the rectangle that were created by the clipping.
+    Concave rings leaving and re-entering the rectangle give one ring per
+    piece left inside. The list is empty if nothing is left.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if clip_edges is None:
+        clip_edges = np.zeros(len(points), dtype=bool)
+    if len(points) > 1 and np.all(points[0] == points[-1]):
+        points = points[:-1]
+        clip_edges = clip_edges[:-1]
+
+    rings = [(points, clip_edges)]
+    for axis, bound, keep_greater in ((0, x_min, True), (0, x_max, False),
+                                      (1, y_min, True), (1, y_max, False)):
+        clipped = []
+        for ring, ring_edges in rings:
+            clipped.extend(_clip_ring_at(ring, ring_edges, axis, bound,
+                                         keep_greater))
+        rings = clipped
+    return [(np.concatenate((ring, ring[:1])),
+             np.concatenate((ring_edges, [False])))
+            for ring, ring_edges in rings if len(ring) >= 3]
+
+
+def clip_polyline(points, x_min, y_min, x_max, y_max):
+    """Clip a polyline to a rectangle, Liang-Barsky style.
+
+    Returns the list of pieces of the line inside the rectangle.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 2:
+        return []
+    start = points[:-1]
+    delta = points[1:] - start
+    t_in = np.zeros(len(delta))
+    t_out = np.ones(len(delta))
+    keep = np.ones(len(delta), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-delta[:, 0], start[:, 0] - x_min),
+                     (delta[:, 0], x_max - start[:, 0]),
+                     (-delta[:, 1], start[:, 1] - y_min),
+                     (delta[:, 1], y_max - start[:, 1])):
+            keep &= ~((p == 0) & (q < 0))
+            ratio = q / p
+            t_in = np.where(p < 0, np.maximum(t_in, ratio), t_in)
+            t_out = np.where(p > 0, np.minimum(t_out, ratio), t_out)
+    keep &= t_in <= t_out
+    if not keep.any():
+        return []
+
+    # Keep the original points where segments are not cut
+    seg_start = np.where((t_in == 0)[:, np.newaxis], start,
+                         start + t_in[:, np.newaxis] * delta)
+    seg_end = np.where((t_out == 1)[:, np.newaxis], points[1:],
+                       start + t_out[:, np.newaxis] * delta)
+
+    # A kept segment continues the piece of the previous one if that ends
+    # at the shared point
+    continues = np.zeros(len(delta), dtype=bool)
+    continues[1:] = keep[:-1] & keep[1:] & (t_out[:-1] == 1) & (t_in[1:] == 0)
+    new_piece = keep & ~continues
+
+    out_points = np.stack((seg_start, seg_end), axis=1)
+    mask = np.column_stack((new_piece, keep))
+    out_points = out_points[mask]
+    piece_starts = np.flatnonzero(np.column_stack((new_piece,
+                                                   np.zeros_like(keep)))[mask])
+    return np.split(out_points, piece_starts[1:])
+
+
+def _beyond_bounds(x_min, y_min, x_max, y_max):
+    """Yield the tests of points beyond each side of a rectangle
+    """
+    yield lambda points: points[:, 0] < x_min
+    yield lambda points: points[:, 0] > x_max
+    yield lambda points: points[:, 1] < y_min
+    yield lambda points: points[:, 1] > y_max
+
+
+def trim_polygon(points, x_min, y_min, x_max, y_max):
+    """Drop the vertices of a ring beyond the sides of a rectangle.
+
+    Of each run of vertices beyond a side, the first and last are kept, and
+    the edge joining them stays beyond that side. Unlike
+    :func:`clip_polygon`, no points are added, so the edges crossing the
+    rectangle keep their original end points and the ring covers exactly
+    the same part of the rectangle. Returns None if nothing is left.
+    """
+    points = np.asarray(points)
+    is_closed = len(points) > 1 and np.all(points[0] == points[-1])
+    ring = points[:-1] if is_closed else points
+    for is_beyond in _beyond_bounds(x_min, y_min, x_max, y_max):
+        beyond = is_beyond(ring)
+        if beyond.all():
+            return None
+        ring = ring[~beyond | ~np.roll(beyond, 1) | ~np.roll(beyond, -1)]
+    if len(ring) < 3:
+        return None
+    if is_closed:
+        ring = np.concatenate((ring, ring[:1]))
+    return ring
+
+
+def trim_polyline(points, x_min, y_min, x_max, y_max):
+    """Cut a polyline at the segments beyond a side of a rectangle.
+
+    Unlike :func:`clip_polyline`, the segments crossing the rectangle are
+    kept whole, so they are drawn the same as the uncut line. Returns the
+    list of pieces left.
+    """
+    pieces = [np.asarray(points)]
+    for is_beyond in _beyond_bounds(x_min, y_min, x_max, y_max):
+        trimmed = []
+        for piece in pieces:
+            beyond = is_beyond(piece)
+            shown = ~(beyond[:-1] & beyond[1:])
+            if shown.all():
+                trimmed.append(piece)
+                continue
+            steps = np.diff(np.concatenate(([0], shown.astype(np.int8),
+                                            [0])))
+            starts = np.flatnonzero(steps == 1)
+            ends = np.flatnonzero(steps == -1)
+            trimmed.extend(piece[start:end + 1]
+                           for start, end in zip(starts, ends))
+        pieces = trimmed
+    return pieces
+
+
+def douglas_peucker(points, tolerance, closed=False):
+    """Return the points of a poly-line kept by the Douglas-Peucker
+    algorithm, within *tolerance* of the original poly-line. The end points
+    are always kept. If *closed*, the poly-line is a ring, and three points
+    spanning it are kept as well, so it does not collapse.
+    """
+    points = np.asarray(points)
+    n_points = len(points)
+    if n_points < 3:
+        return points
+    keep = np.zeros(n_points, dtype=bool)
+    keep[0] = keep[-1] = True
+    if closed and n_points >= 4:
+        # The point farthest from the start, and the point farthest from
+        # the line through both
+        rel = points - points[0]
+        farthest = int(np.argmax(np.hypot(rel[:, 0], rel[:, 1])))
+        seg_x, seg_y = rel[farthest]
+        keep[farthest] = True
+        keep[int(np.argmax(np.abs(seg_x * rel[:, 1] -
+                                  seg_y * rel[:, 0])))] = True
+    kept = np.flatnonzero(keep)
+    ranges = list(zip(kept[:-1], kept[1:]))
+    while ranges:
+        first, last = ranges.pop()
+        if last - first < 2:
+            continue
+        start = points[first]
+        seg_x, seg_y = points[last] - start
+        rel = points[first + 1:last] - start
+        length = np.hypot(seg_x, seg_y)
+        if length == 0:
+            # Closed ring, distance from its end points
+            distance = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            distance = np.abs(seg_x * rel[:, 1] - seg_y * rel[:, 0]) / length
+        farthest = int(np.argmax(distance))
+        if distance[farthest] > tolerance:
+            mid = first + 1 + farthest
+            keep[mid] = True
+            ranges.append((first, mid))
+            ranges.append((mid, last))
+    return points[keep]
+
+
+def simplify_shapes(shapes, tolerance):
+    """Simplify the parts of the shapes of a collection with the
+    Douglas-Peucker algorithm, to within *tolerance* degrees.
+
+    Returns a :class:`Shapes` collection with the same shapes and parts, so
+    shape ids and bounding boxes are kept. The end points of lines, where
+    they meet other lines, are kept, and rings keep enough points not to
+    collapse.
+    """
+    is_polygon = shapes.shape_type in (shapefile.POLYGON, shapefile.POLYGONZ,
+                                       shapefile.POLYGONM)
+    pieces = []
+    part_offsets = [0]
+    shape_offsets = [0]
+    for shape in shapes:
+        parts = list(shape.parts) + [len(shape.points)]
+        for first, last in zip(parts[:-1], parts[1:]):
+            points = np.asarray(shape.points[first:last], dtype=np.float64)
+            points = douglas_peucker(points.reshape(-1, 2), tolerance,
+                                     closed=is_polygon)
+            pieces.append(points)
+            part_offsets.append(part_offsets[-1] + len(points))
+        shape_offsets.append(shape_offsets[-1] + len(parts) - 1)
+    if pieces:
+        coords = np.concatenate(pieces)
+    else:
+        coords = np.zeros((0, 2))
+    return Shapes(coords, np.array(part_offsets, dtype=np.int64),
+                  np.array(shape_offsets, dtype=np.int64),
+                  np.array(shapes.bbox, dtype=np.float64), shapes.shape_type)
+
+
+def tile_shapes(shapes, tile_size=10.0):
+    """Clip the shapes of a collection at the edges of a regular lon/lat
+    tile grid.
+
+    Returns a :class:`TiledShapes` collection with one shape per part of a
+    shape per tile.
+    """
+    index = TileIndex(tile_size, np.zeros(1, dtype=np.int64))
+    is_polygon = shapes.shape_type in (shapefile.POLYGON, shapefile.POLYGONZ,
+                                       shapefile.POLYGONM)
+    tiles = []
+    parents = []
+    rings = []
+    edges = []
+
+    def add_piece(tile, parent, ring, ring_edges):
+        tiles.append(tile)
+        parents.append(parent)
+        rings.append(ring)
+        edges.append(ring_edges)
+
+    for parent, shape in enumerate(shapes):
+        bbox = shape.bbox
+        if not np.all(np.isfinite(bbox)):
+            continue
+        (ix0, ix1), (iy0, iy1) = index._cell([bbox[0], bbox[2]],
+                                             [bbox[1], bbox[3]])
+        parts = list(shape.parts) + [len(shape.points)]
+        for first, last in zip(parts[:-1], parts[1:]):
+            points = np.asarray(shape.points[first:last], dtype=np.float64)
+            if ix0 == ix1 and iy0 == iy1:
+                add_piece(iy0 * index.nx + ix0, parent, points,
+                          np.zeros(len(points), dtype=bool))
+                continue
+            # Clip to latitude bands first, then to the tiles of each band
+            for iy in range(iy0, iy1 + 1):
+                y_min = -90.0 + iy * tile_size
+                y_max = min(y_min + tile_size, 90.0)
+                if is_polygon:
+                    for band, band_edges in clip_polygon(points, -np.inf,
+                                                         y_min, np.inf,
+                                                         y_max):
+                        for ix in range(ix0, ix1 + 1):
+                            x_min = -180.0 + ix * tile_size
+                            x_max = min(x_min + tile_size, 180.0)
+                            for ring, ring_edges in clip_polygon(
+                                    band, x_min, y_min, x_max, y_max,
+                                    band_edges):
+                                add_piece(iy * index.nx + ix, parent, ring,
+                                          ring_edges)
+                else:
+                    for band in clip_polyline(points, -np.inf, y_min,
+                                              np.inf, y_max):
+                        for ix in range(ix0, ix1 + 1):
+                            x_min = -180.0 + ix * tile_size
+                            x_max = min(x_min + tile_size, 180.0)
+                            for piece in clip_polyline(band, x_min, y_min,
+                                                       x_max, y_max):
+                                add_piece(iy * index.nx + ix, parent, piece,
+                                          np.zeros(len(piece), dtype=bool))
+
+    order = np.argsort(np.asarray(tiles, dtype=np.int64), kind='mergesort')
+    tiles = np.asarray(tiles, dtype=np.int64)[order]
+    rings = [rings[i] for i in order]
+    sizes = np.array([len(ring) for ring in rings], dtype=np.int64)
+
+    coords = np.concatenate(rings + [np.zeros((0, 2))])
+    part_offsets = np.concatenate(([0], np.cumsum(sizes)))
+    shape_offsets = np.arange(len(rings) + 1, dtype=np.int64)
+    bbox = np.array([np.concatenate((ring.min(axis=0), ring.max(axis=0)))
+                     for ring in rings]).reshape(-1, 4)
+    tile_offsets = np.concatenate(
+        ([0], np.cumsum(np.bincount(tiles, minlength=index.nx * index.ny))))
+    return TiledShapes(coords, part_offsets, shape_offsets, bbox,
+                       shapes.shape_type, tile_size, tile_offsets,
+                       np.asarray(parents, dtype=np.int64)[order],
+                       np.concatenate([edges[i] for i in order] +
+                                      [np.zeros(0, dtype=bool)]))
+
+
+# Record header of polyline and polygon records in a .shp file: the record
+# number and content length in 16 bit words, then the record content
+_RECORD_HEADER = np.dtype([('record_number', '>i4'),
+                           ('content_length', '>i4'),
+                           ('shape_type', '<i4'),
+                           ('bbox', '<f8', (4,)),
+                           ('num_parts', '<i4'),
+                           ('num_points', '<i4')])
+# Record of a .shx file, offset and content length in 16 bit words
+_INDEX_RECORD = np.dtype([('offset', '>i4'), ('content_length', '>i4')])
+# Record of a .shp file of points
+_POINT_RECORD = np.dtype([('record_number', '>i4'),
+                          ('content_length', '>i4'),
+                          ('shape_type', '<i4'),
+                          ('point', '<f8', (2,))])
+_FILE_HEADER_SIZE = 100
+_POLY_TYPES = (shapefile.POLYLINE, shapefile.POLYGON,
+               shapefile.POLYLINEZ, shapefile.POLYGONZ,
+               shapefile.POLYLINEM, shapefile.POLYGONM)
+
+
+def _open_shp(filename):
+    """Memory map a .shp file and read the byte offsets of its records
+    from the .shx file next to it
+    """
+    shx_filename = os.path.splitext(filename)[0] + '.shx'
+    try:
+        shp = np.memmap(filename, dtype=np.uint8, mode='r')
+        n_records = ((os.path.getsize(shx_filename) - _FILE_HEADER_SIZE) //
+                     _INDEX_RECORD.itemsize)
+        if n_records > 0:
+            shx = np.memmap(shx_filename, dtype=_INDEX_RECORD, mode='r',
+                            offset=_FILE_HEADER_SIZE, shape=(n_records,))
+            offsets = shx['offset'].astype(np.int64) * 2
+        else:
+            offsets = np.zeros(0, dtype=np.int64)
+    except (IOError, OSError, ValueError):
+        raise ShapeFileError('Could not find shapefile %s' % filename)
+    if len(shp) < _FILE_HEADER_SIZE:
+        raise ShapeFileError('Not a shapefile: %s' % filename)
+    return shp, offsets
+
+
+def _gather_records(shp, offsets, dtype):
+    """Gather the fixed size starts of all records of a .shp file into a
+    structured array with one fancy indexing operation
+    """
+    byte_index = offsets[:, np.newaxis] + np.arange(dtype.itemsize)
+    np.clip(byte_index, 0, len(shp) - 1, out=byte_index)
+    return np.ascontiguousarray(shp[byte_index]).view(dtype).reshape(-1)
+
+
+def read_points(filename):
+    """Read the coordinates of all points of a point shapefile as an
+    (n, 2) array. Null shapes get NaN coordinates.
+    """
+    shp, offsets = _open_shp(filename)
+    shape_type = int(shp[32:36].view('<i4')[0])
+    if shape_type not in (shapefile.POINT, shapefile.POINTZ,
+                          shapefile.POINTM):
+        raise ShapeFileError('Not a point shapefile: %s' % filename)
+    records = _gather_records(shp, offsets, _POINT_RECORD)
+    is_point = ((records['shape_type'] == shape_type) &
+                (offsets + _POINT_RECORD.itemsize <= len(shp)))
+    return np.where(is_point[:, np.newaxis], records['point'],
+                    np.nan).astype(np.float64)
+
+
+class ShapefileShapes(ShapeCollection):
+
+    """Polyline or polygon shapes read lazily from a shapefile.
+
+    Only the .shx index and the record headers of the .shp file, holding
+    the bounding boxes, are read up front. The parts and points of a shape
+    are decoded from the memory mapped .shp file when the shape is
+    accessed, so culled shapes are never read.
+
+    :Parameters:
+    filename : str
+        Path of the .shp file. The .shx file must be next to it.
+    """
+
+    def __init__(self, filename):
+        shp, offsets = _open_shp(filename)
+        self.shape_type = int(shp[32:36].view('<i4')[0])
+        if self.shape_type not in _POLY_TYPES:
+            raise ShapeFileError('Unsupported shape type: %d'
+                                 % self.shape_type)
+        headers = _gather_records(shp, offsets, _RECORD_HEADER)
+
+        # Null shapes and truncated records have no geometry
+        has_geometry = ((headers['shape_type'] == self.shape_type) &
+                        (headers['content_length'] * 2 >=
+                         _RECORD_HEADER.itemsize - 8) &
+                        (offsets + _RECORD_HEADER.itemsize <= len(shp)))
+        self.bbox = np.where(has_geometry[:, np.newaxis],
+                             headers['bbox'], np.nan).astype(np.float64)
+        self.num_parts = np.where(has_geometry, headers['num_parts'],
+                                  0).astype(np.int64)
+        self.num_points = np.where(has_geometry, headers['num_points'],
+                                   0).astype(np.int64)
+        self.offsets = offsets
+        self._shp = shp
+
+    @property
+    def point_counts(self):
+        return self.num_points
+
+    def _arrays(self):
+        return [self.bbox, self.num_parts, self.num_points, self.offsets]
+
+    def _get_shape(self, shape_id):
+        num_parts = self.num_parts[shape_id]
+        num_points = self.num_points[shape_id]
+        start = self.offsets[shape_id] + _RECORD_HEADER.itemsize
+        points_start = start + 4 * num_parts
+        if num_parts == 0:
+            parts = np.zeros(1, dtype=np.int32)
+        else:
+            parts = self._shp[start:points_start].view('<i4')
+        points = self._shp[points_start:points_start + 16 * num_points]
+        return Shape(points.view('<f8').reshape(-1, 2), parts,
+                     self.bbox[shape_id], self.shape_type)
+
+
+def open_shapefile(filename):
+    """Open a shapefile for reading shapes lazily if possible, otherwise
+    read all of its shapes
+    """
+    try:
+        return ShapefileShapes(filename)
+    except ShapeFileError as err:
+        logger.debug("Reading all shapes of %s: %s", filename, str(err))
+        return read_shapefile(filename)
+
+
+def read_shapefile(filename):
+    """Read all shapes of a shapefile into a :class:`Shapes` collection
+    """
+    try:
+        reader = shapefile.Reader(filename)
+        shapes = reader.shapes()
+    except (AttributeError, shapefile.ShapefileException):
+        raise ShapeFileError('Could not find shapefile %s' % filename)
+    return Shapes.from_shapes(shapes, reader.shapeType)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pycoast, Writing of coastlines, borders and rivers to images in Python
+#
+# Copyright (C) 2011-2016
+#    Esben S. Nielsen
+#    Hróbjartur Þorsteinsson
+#    Stefano Cerino
+#    Katja Hungershofer
+#    Panu Lahtinen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Memory mapped geometry stores for the GSHHS and WDBII shapefiles.
+
+A store is a directory next to the shapefile, e.g. ``GSHHS_f_L1.geom`` for
+``GSHHS_f_L1.shp``, holding the geometry as flat ``.npy`` arrays::
+
+  coords.npy          (n_points, 2) float64 or float32 lon/lat
+  part_offsets.npy    (n_parts + 1,) int64 index of first point of each part
+  shape_offsets.npy   (n_shapes + 1,) int64 index of first part of each shape
+  bbox.npy            (n_shapes, 4) float64 lon_min, lat_min, lon_max, lat_max
+  meta.json           format version, shape type and the modification
+                      time and size of the source shapefile
+
+The arrays are opened with :func:`numpy.load` in memory mapped mode, so
+several processes rendering from the same store share the page cached data.
+
+A tiled store, e.g. ``GSHHS_f_L1.tiles``, holds the shapes clipped at the
+edges of a regular lon/lat tile grid and sorted by tile, with the additional
+arrays::
+
+  tile_offsets.npy    (n_tiles + 1,) int64 index of first shape of each tile
+  parent_ids.npy      (n_shapes,) int64 index of the original shape
+  clip_edges.npy      (n_points,) bool edges created by the clipping
+
+Only the pages of the tiles overlapping an area are then read. Tiled stores
+take precedence over plain stores. A store is not used, with a warning, once
+its shapefile has been replaced, until it is converted again.
+
+A pyramid, e.g. ``GSHHS_f_L1.pyramid``, holds plain stores of the shapes
+simplified to within fixed tolerances in degrees, one per level::
+
+  level0/ ... levelN/ stores, from the finest to the coarsest
+  meta.json           format version, tolerance of each level and the
+                      modification time and size of the source shapefile
+
+The contour writers draw from the coarsest level whose tolerance is below
+the pixel size of an area. Convert a whole database with::
+
+  python -m pycoast.store /path/to/gshhs [--tiles 10] [--pyramid]
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from .geometry import (Shapes, TiledShapes, open_shapefile, read_shapefile,
+                       simplify_shapes, tile_shapes)
+from .errors import ShapeFileError
+
+logger = logging.getLogger(__name__)
+
+STORE_SUFFIX = '.geom'
+TILES_SUFFIX = '.tiles'
+PYRAMID_SUFFIX = '.pyramid'
+STORE_VERSION = 1
+
+_ARRAYS = ('coords', 'part_offsets', 'shape_offsets', 'bbox')
+_TILE_ARRAYS = ('tile_offsets', 'parent_ids', 'clip_edges')
+
+# Tolerances, in degrees, of the levels of a pyramid
+DEFAULT_PYRAMID_TOLERANCES = (0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2)
+
+# Outdated stores already warned about
+_warned_outdated = set()
+
+
+def get_store_path(shapefilename, tiled=False):
+    """Return the path of the store belonging to a shapefile
+    """
+    suffix = TILES_SUFFIX if tiled else STORE_SUFFIX
+    return os.path.splitext(shapefilename)[0] + suffix
+
+
+def write_store(shapes, path, dtype=np.float64, source=None):
+    """Write a :class:`Shapes` collection to a store at *path*. If *source*
+    is given, the modification time and size of this shapefile are recorded,
+    so the store is not used once the shapefile changes.
+
+    The store is written to a temporary directory first and moved in place
+    when complete, so readers never see a partial store.
+    """
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    try:
+        arrays = {'coords': np.asarray(shapes.coords, dtype=dtype),
+                  'part_offsets': np.asarray(shapes.part_offsets,
+                                             dtype=np.int64),
+                  'shape_offsets': np.asarray(shapes.shape_offsets,
+                                              dtype=np.int64),
+                  'bbox': np.asarray(shapes.bbox, dtype=np.float64)}
+        meta = {'version': STORE_VERSION,
+                'shape_type': shapes.shape_type,
+                'dtype': np.dtype(dtype).name}
+        if source is not None:
+            meta['source'] = _get_shapefile_stamp(source)
+        names = _ARRAYS
+        if isinstance(shapes, TiledShapes):
+            arrays.update({'tile_offsets': np.asarray(shapes.tile_offsets,
+                                                      dtype=np.int64),
+                           'parent_ids': np.asarray(shapes.parent_ids,
+                                                    dtype=np.int64),
+                           'clip_edges': np.asarray(shapes.clip_edges,
+                                                    dtype=bool)})
+            meta['tile_size'] = shapes.tile_size
+            names = _ARRAYS + _TILE_ARRAYS
+        for name in names:
+            np.save(os.path.join(tmp_path, name + '.npy'), arrays[name])
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as fid:
+            json.dump(meta, fid)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def load_store(path):
+    """Open the store at *path* as a memory mapped :class:`Shapes`, or
+    :class:`TiledShapes`, collection
+    """
+    try:
+        with open(os.path.join(path, 'meta.json')) as fid:
+            meta = json.load(fid)
+    except (IOError, OSError, ValueError):
+        raise ShapeFileError('Could not read geometry store %s' % path)
+    if meta.get('version') != STORE_VERSION:
+        raise ShapeFileError('Unsupported version of geometry store %s'
+                             % path)
+    arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+              for name in _ARRAYS]
+    if 'tile_size' not in meta:
+        return Shapes(*arrays, shape_type=meta['shape_type'])
+    tile_arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                   for name in _TILE_ARRAYS]
+    return TiledShapes(*(arrays + [meta['shape_type'], meta['tile_size']] +
+                         tile_arrays))
+
+
+def get_pyramid_path(shapefilename):
+    """Return the path of the pyramid belonging to a shapefile
+    """
+    return os.path.splitext(shapefilename)[0] + PYRAMID_SUFFIX
+
+
+def write_pyramid(shapes, path, tolerances=DEFAULT_PYRAMID_TOLERANCES,
+                  dtype=np.float64, source=None):
+    """Write the shapes of a collection, simplified to within each of
+    *tolerances* degrees, to a pyramid at *path*. Like stores, pyramids are
+    written to a temporary directory first, and record the modification
+    time and size of the *source* shapefile if given.
+    """
+    tolerances = sorted(float(tolerance) for tolerance in tolerances)
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    try:
+        for i, tolerance in enumerate(tolerances):
+            write_store(simplify_shapes(shapes, tolerance),
+                        os.path.join(tmp_path, 'level%d' % i), dtype=dtype)
+        meta = {'version': STORE_VERSION, 'tolerances': tolerances}
+        if source is not None:
+            meta['source'] = _get_shapefile_stamp(source)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as fid:
+            json.dump(meta, fid)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def get_pyramid_levels(shapefilename):
+    """Return the tolerances and store paths of the levels of the pyramid
+    of *shapefilename*, from the finest to the coarsest, or an empty list
+    if there is no pyramid converted from the shapefile as it is now
+    """
+    path = get_pyramid_path(shapefilename)
+    if not os.path.isdir(path) or not _is_current(path, shapefilename):
+        return []
+    try:
+        with open(os.path.join(path, 'meta.json')) as fid:
+            meta = json.load(fid)
+    except (IOError, OSError, ValueError):
+        raise ShapeFileError('Could not read pyramid %s' % path)
+    if meta.get('version') != STORE_VERSION:
+        raise ShapeFileError('Unsupported version of pyramid %s' % path)
+    return [(tolerance, os.path.join(path, 'level%d' % i))
+            for i, tolerance in enumerate(meta['tolerances'])]
+
+
+def _get_shapefile_stamp(shapefilename):
+    """Return the modification time and size of a shapefile, or None if it
+    does not exist
+    """
+    try:
+        stat = os.stat(shapefilename)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+
+def _is_current(path, shapefilename):
+    """Tell whether the store or pyramid at *path* was converted from the
+    shapefile as it is now. Stores not recording their source, or whose
+    shapefile is gone, are taken as current.
+    """
+    try:
+        with open(os.path.join(path, 'meta.json')) as fid:
+            source = json.load(fid).get('source')
+    except (IOError, OSError, ValueError):
+        # Reported when the store is read
+        return True
+    stamp = _get_shapefile_stamp(shapefilename)
+    if source is None or stamp is None or source == stamp:
+        return True
+    if path not in _warned_outdated:
+        _warned_outdated.add(path)
+        logger.warning("%s has changed since it was converted to %s, "
+                       "reading the shapefile instead", shapefilename, path)
+    return False
+
+
+def get_source_path(shapefilename, tiled=True):
+    """Return the path of the tiled or plain store of *shapefilename* if
+    there is one converted from the shapefile as it is now, otherwise
+    *shapefilename* itself, which may be a store. Tiled stores are skipped
+    unless *tiled* is set.
+    """
+    if os.path.isdir(shapefilename):
+        return shapefilename
+    for is_tiled in ((True, False) if tiled else (False,)):
+        store_path = get_store_path(shapefilename, tiled=is_tiled)
+        if os.path.isdir(store_path) and _is_current(store_path,
+                                                     shapefilename):
+            return store_path
+    return shapefilename
+
+
+def get_source_stamp(shapefilename):
+    """Return the path, modification time and size of the data read for
+    *shapefilename*, to detect changed datasets
+    """
+    path = get_source_path(shapefilename)
+    if os.path.isdir(path):
+        stat = os.stat(os.path.join(path, 'meta.json'))
+    else:
+        stat = os.stat(path)
+    return (path, stat.st_mtime, stat.st_size)
+
+
+def read_shapes(shapefilename, tiled=True):
+    """Read shapes from the tiled or plain store of *shapefilename* if there
+    is one, otherwise lazily from the shapefile itself. Tiled stores are
+    skipped unless *tiled* is set.
+    """
+    path = get_source_path(shapefilename, tiled=tiled)
+    if os.path.isdir(path):
+        logger.debug("Reading geometry store %s", path)
+        return load_store(path)
+    return open_shapefile(shapefilename)
+
+
+def convert_shapefile(shapefilename, dtype=np.float64, tile_size=None):
+    """Convert a shapefile to a geometry store next to it. If *tile_size*
+    is given, a tiled store with tiles of *tile_size* degrees is written.
+    """
+    shapes = read_shapefile(shapefilename)
+    if tile_size is not None:
+        shapes = tile_shapes(shapes, tile_size)
+    store_path = get_store_path(shapefilename, tiled=tile_size is not None)
+    write_store(shapes, store_path, dtype=dtype, source=shapefilename)
+    logger.info("Converted %s to %s", shapefilename, store_path)
+    return store_path
+
+
+def convert_pyramid(shapefilename, tolerances=DEFAULT_PYRAMID_TOLERANCES,
+                    dtype=np.float64):
+    """Write the pyramid of simplified versions of a shapefile next to it
+    """
+    pyramid_path = get_pyramid_path(shapefilename)
+    write_pyramid(read_shapefile(shapefilename), pyramid_path,
+                  tolerances=tolerances, dtype=dtype, source=shapefilename)
+    logger.info("Simplified %s to %s", shapefilename, pyramid_path)
+    return pyramid_path
+
+
+def convert_db(db_root_path, dtype=np.float64, resolutions=None,
+               tile_size=None, pyramid=None):
+    """Convert all GSHHS and WDBII level shapefiles under *db_root_path*,
+    i.e. ``<db>_shp/<resolution>/*.shp``, to geometry stores. If *pyramid*
+    is given, pyramids with levels of these tolerances are written too.
+    """
+    store_paths = []
+    for db_name in ('GSHHS', 'WDBII'):
+        db_dir = os.path.join(db_root_path, '%s_shp' % db_name)
+        for res_dir in sorted(glob.glob(os.path.join(db_dir, '*'))):
+            resolution = os.path.basename(res_dir)
+            if resolutions is not None and resolution not in resolutions:
+                continue
+            for shapefilename in sorted(glob.glob(os.path.join(res_dir,
+                                                               '*.shp'))):
+                store_paths.append(convert_shapefile(shapefilename,
+                                                     dtype=dtype,
+                                                     tile_size=tile_size))
+                if pyramid is not None:
+                    store_paths.append(convert_pyramid(shapefilename,
+                                                       tolerances=pyramid,
+                                                       dtype=dtype))
+    return store_paths
+
+
+def main(args=None):
+    """Command line interface of the store converter
+    """
+    parser = argparse.ArgumentParser(
+        description="Convert GSHHS and WDBII shapefiles to memory mapped "
+        "geometry stores")
+    parser.add_argument('db_root_path',
+                        help="Root dir of GSHHS and WDBII shapefiles")
+    parser.add_argument('-r', '--resolutions', default=None,
+                        help="Resolutions to convert, e.g. 'hf' "
+                        "(default: all)")
+    parser.add_argument('--float32', action='store_true',
+                        help="Store coordinates as float32")
+    parser.add_argument('-t', '--tiles', type=float, default=None,
+                        metavar='SIZE',
+                        help="Write tiled stores with tiles of SIZE degrees")
+    parser.add_argument('-p', '--pyramid', nargs='?', default=None,
+                        const=','.join(str(tolerance) for tolerance
+                                       in DEFAULT_PYRAMID_TOLERANCES),
+                        metavar='TOLERANCES',
+                        help="Write pyramids of shapes simplified to the "
+                        "comma separated TOLERANCES in degrees "
+                        "(default: %(const)s)")
+    opts = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    dtype = np.float32 if opts.float32 else np.float64
+    pyramid = None
+    if opts.pyramid is not None:
+        pyramid = [float(tolerance) for tolerance in opts.pyramid.split(',')]
+    convert_db(opts.db_root_path, dtype=dtype, resolutions=opts.resolutions,
+               tile_size=opts.tiles, pyramid=pyramid)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,8 +15,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import gc
 import os
+import shutil
+import tempfile
+import threading
 import unittest
+import weakref
 
 import numpy as np
 from PIL import Image, ImageFont
@@ -527,10 +532,1488 @@ class TestPILAGG(TestPycoast):
         res = np.array(img)
         self.failUnless(fft_metric(grid_data, res), 'Writing of Brazil shapefiles failed')
 
+class TestShapefileShapes(unittest.TestCase):
+    def test_single_pass(self):
+        import shapefile
+        filename = os.path.join(os.path.dirname(__file__),
+                                'test_data/shapes/divisao_politica/'
+                                'BR_Regioes.shp')
+        proj4_string = '+proj=merc +lon_0=-60 +lat_ts=-30.0 +a=6371228.0 +units=m'
+        area_extent = (-2000000.0, -5000000.0, 5000000.0, 2000000.0)
+        area_def = (proj4_string, area_extent)
+        cw = ContourWriter(gshhs_root_dir)
+
+        img = Image.new('RGB', (425, 425))
+        for i in range(len(shapefile.Reader(filename).shapes())):
+            cw.add_shapefile_shape(img, area_def, filename, i,
+                                   outline='blue', fill='green')
+        expected = np.array(img)
+
+        img = Image.new('RGB', (425, 425))
+        cw.add_shapefile_shapes(img, area_def, filename,
+                                outline='blue', fill='green')
+        np.testing.assert_array_equal(np.array(img), expected)
+
+    def test_tiled_store_ignored(self):
+        from pycoast.store import convert_shapefile
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            src_dir = os.path.join(os.path.dirname(__file__), 'test_data',
+                                   'shapes', 'divisao_politica')
+            for name in os.listdir(src_dir):
+                if name.startswith('BR_Regioes.'):
+                    shutil.copy(os.path.join(src_dir, name), tmp_dir)
+            filename = os.path.join(tmp_dir, 'BR_Regioes.shp')
+            area_def = ('+proj=merc +lon_0=-60 +lat_ts=-30.0 +a=6371228.0 '
+                        '+units=m',
+                        (-2000000.0, -5000000.0, 5000000.0, 2000000.0))
+            cw = ContourWriter(gshhs_root_dir)
+            img = Image.new('RGB', (425, 425))
+            cw.add_shapefile_shapes(img, area_def, filename,
+                                    outline='blue', fill='green')
+            expected = np.array(img)
+
+            # User shapefiles are drawn whole, not from tile pieces
+            convert_shapefile(filename, tile_size=5.0)
+            img = Image.new('RGB', (425, 425))
+            cw.add_shapefile_shapes(img, area_def, filename,
+                                    outline='blue', fill='green')
+            np.testing.assert_array_equal(np.array(img), expected)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_lazy_reader(self):
+        from pycoast.geometry import ShapefileShapes, read_shapefile
+        filename = os.path.join(gshhs_root_dir, 'GSHHS_shp', 'l',
+                                'GSHHS_l_L2.shp')
+        lazy = ShapefileShapes(filename)
+        shapes = read_shapefile(filename)
+        self.assertEqual(len(lazy), len(shapes))
+        self.assertEqual(lazy.shape_type, shapes.shape_type)
+        np.testing.assert_array_equal(lazy.bbox, shapes.bbox)
+        for shape_id in (0, 17, len(shapes) - 1):
+            np.testing.assert_array_equal(lazy[shape_id].points,
+                                          shapes[shape_id].points)
+            np.testing.assert_array_equal(lazy[shape_id].parts,
+                                          shapes[shape_id].parts)
+
+    def test_lazy_reader_null_shape(self):
+        import shapefile
+        from pycoast.geometry import ShapefileShapes
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'null.shp')
+            writer = shapefile.Writer(shapefile.POLYGON)
+            writer.field('ID', 'N')
+            writer.poly(parts=[[[0, 0], [0, 1], [1, 1], [0, 0]]])
+            writer.record(1)
+            writer.null()
+            writer.record(2)
+            writer.save(filename)
+            lazy = ShapefileShapes(filename)
+            self.assertEqual(len(lazy), 2)
+            np.testing.assert_array_equal(lazy.bbox[0], [0, 0, 1, 1])
+            self.assertTrue(np.all(np.isnan(lazy.bbox[1])))
+            self.assertEqual(len(lazy[1].points), 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+class TestCities(unittest.TestCase):
+    cities = [('Oslo', 10.75, 59.91, 580000),
+              ('Copenhagen', 12.57, 55.68, 1153615),
+              ('Helsinki', 24.94, 60.17, 558457),
+              ('Oslo', -89.0, 40.0, 15000),
+              ('Reykjavik', -21.9, 64.1, 113906)]
+
+    def setUp(self):
+        import shapefile
+        self.db_root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.db_root, 'CITIES'))
+        writer = shapefile.Writer(shapefile.POINT)
+        for name in ('OID', 'GEONAMID', 'name', 'asciiname'):
+            writer.field(name, 'C', 40)
+        writer.field('pop', 'N', 10)
+        for i, (name, lon, lat, population) in enumerate(self.cities):
+            writer.point(lon, lat)
+            writer.record(str(i), str(i), name, name, population)
+        writer.save(os.path.join(self.db_root, 'CITIES',
+                                 'cities_15000_alternativ'))
+        self.area_def = ('+proj=stere +lon_0=8.00 +lat_0=50.00 '
+                         '+lat_ts=50.00 +ellps=WGS84',
+                         (-3363403.31, -2291879.85, 2630596.69, 2203620.1))
+        self.font_file = os.path.join(os.path.dirname(__file__),
+                                      'test_data', 'DejaVuSerif.ttf')
+
+    def tearDown(self):
+        shutil.rmtree(self.db_root)
+
+    def test_find(self):
+        from pycoast.cities import CityIndex
+        cities = CityIndex(os.path.join(self.db_root, 'CITIES',
+                                        'cities_15000_alternativ.shp'))
+        self.assertEqual(len(cities), len(self.cities))
+        city_ids = cities.find(['Oslo', 'Helsinki', 'Atlantis'])
+        np.testing.assert_array_equal(city_ids, [0, 2, 3])
+        self.assertEqual(cities.names(city_ids),
+                         ['Oslo', 'Helsinki', 'Oslo'])
+        np.testing.assert_allclose(cities.lonlats[2], [24.94, 60.17])
+
+    def test_query(self):
+        from pycoast.cities import CityIndex
+        cities = CityIndex(os.path.join(self.db_root, 'CITIES',
+                                        'cities_15000_alternativ.shp'))
+        np.testing.assert_array_equal(cities.query(0, 30, 50, 70), [0, 1, 2])
+        np.testing.assert_array_equal(
+            cities.query(0, 30, 50, 70, min_population=570000), [0, 1])
+        # Box crossing the dateline
+        np.testing.assert_array_equal(cities.query(170, -50, 30, 70), [3])
+        np.testing.assert_array_equal(cities.most_populous([0, 1, 2, 4], 2),
+                                      [0, 1])
+        # Selected from the population order sorted once
+        order = cities.population_order
+        self.assertTrue(cities.population_order is order)
+        np.testing.assert_array_equal(cities.most_populous([1, 2, 4], 1),
+                                      [order[np.isin(order, [1, 2, 4])][0]])
+
+    def test_add_cities_auto(self):
+        import pyproj
+        from pycoast import ContourWriterAGG
+        cw = ContourWriterAGG(self.db_root)
+        img = Image.new('RGB', (640, 480))
+        cw.add_cities(img, self.area_def, None, self.font_file, 12, 2,
+                      'red', None, 255, min_population=560000, max_cities=1)
+        res = np.array(img)
+        prj = pyproj.Proj(self.area_def[0])
+        x_ll, y_ll, x_ur, y_ur = self.area_def[1]
+        for lon, lat, added in ((12.57, 55.68, True), (10.75, 59.91, False),
+                                (24.94, 60.17, False)):
+            x, y = prj(lon, lat)
+            col = int((x - x_ll) / ((x_ur - x_ll) / 640))
+            row = int((y_ur - y) / ((y_ur - y_ll) / 480))
+            self.assertEqual(tuple(res[row, col]) == (255, 0, 0), added)
+
+    def test_add_cities(self):
+        import pyproj
+        from pycoast import ContourWriterAGG
+        cw = ContourWriterAGG(self.db_root)
+        img = Image.new('RGB', (640, 480))
+        cw.add_cities(img, self.area_def, ['Oslo', 'Copenhagen'],
+                      self.font_file, 12, 2, 'red', None, 255)
+        res = np.array(img)
+        # The dot of each city is centred on its pixel, the Oslo outside
+        # the area is skipped
+        prj = pyproj.Proj(self.area_def[0])
+        x_ll, y_ll, x_ur, y_ur = self.area_def[1]
+        for lon, lat in ((10.75, 59.91), (12.57, 55.68)):
+            x, y = prj(lon, lat)
+            col = int((x - x_ll) / ((x_ur - x_ll) / 640))
+            row = int((y_ur - y) / ((y_ur - y_ll) / 480))
+            np.testing.assert_array_equal(res[row, col], [255, 0, 0])
+        self.assertEqual(cw.cache_info().misses, 1)
+        cw.add_cities(img, self.area_def, ['Helsinki'],
+                      self.font_file, 12, 2, 'red', None, 255)
+        self.assertEqual(cw.cache_info().hits, 1)
+
+
+class TestShapeCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        from pycoast.cache import ShapeCache
+        cache = ShapeCache(100)
+        cache.put('a', 1, 40)
+        cache.put('b', 2, 40)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3, 40)
+        self.assertTrue('b' not in cache)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        cache.put('d', 4, 1000)
+        self.assertTrue('d' not in cache)
+        info = cache.info()
+        self.assertEqual((info.hits, info.misses, info.evictions), (2, 1, 1))
+        self.assertEqual(info.nbytes, 80)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.info().nbytes, 0)
+
+    def test_writer_cache(self):
+        img = Image.new('RGB', (640, 480))
+        proj4_string = '+proj=stere +lon_0=8.00 +lat_0=50.00 +lat_ts=50.00 +ellps=WGS84'
+        area_extent = (-3363403.31, -2291879.85, 2630596.69, 2203620.1)
+        area_def = (proj4_string, area_extent)
+        cw = ContourWriter(gshhs_root_dir)
+        cw.add_coastlines(img, area_def, resolution='l', level=4)
+        info = cw.cache_info()
+        self.assertEqual((info.hits, info.misses), (0, 1))
+        cw.add_coastlines(img, area_def, resolution='l', level=4)
+        info = cw.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+        cw.clear_cache()
+        self.assertEqual(cw.cache_info().items, 0)
+
+        cw = ContourWriter(gshhs_root_dir, cache_size=0)
+        cw.add_coastlines(img, area_def, resolution='l', level=4)
+        cw.add_coastlines(img, area_def, resolution='l', level=4)
+        info = cw.cache_info()
+        self.assertEqual((info.hits, info.misses, info.items), (0, 2, 0))
+
+
+class TestPrefetch(unittest.TestCase):
+    area_def = ('+proj=stere +lon_0=8.00 +lat_0=50.00 +lat_ts=50.00 +ellps=WGS84',
+                (-3363403.31, -2291879.85, 2630596.69, 2203620.1))
+
+    def _draw(self, cw):
+        img = Image.new('RGB', (640, 480))
+        cw.add_coastlines(img, self.area_def, resolution='l',
+                          level=[0, 1, 2, 3], fill='green')
+        cw.add_rivers(img, self.area_def, level=5, outline='blue')
+        cw.add_borders(img, self.area_def, outline='red')
+        return np.array(img)
+
+    def test_prefetch(self):
+        expected = self._draw(ContourWriter(gshhs_root_dir))
+        cw = ContourWriter(gshhs_root_dir, prefetch_workers=2)
+        try:
+            cw.prefetch('rivers', 'c', 5)
+            cw.prefetch('borders', 'c', 1)
+            np.testing.assert_array_equal(self._draw(cw), expected)
+            # All background loads were used
+            self.assertEqual(len(cw._pending), 0)
+            self.assertEqual(cw.cache_info().items, 6)
+        finally:
+            cw.close()
+
+    def test_no_prefetch_workers(self):
+        cw = ContourWriter(gshhs_root_dir)
+        cw.prefetch('coasts', 'l', [0, 1])
+        self.assertEqual(len(cw._pending), 0)
+        self.assertTrue(cw._pool is None)
+
+    def test_pending_cleared(self):
+        cw = ContourWriter(gshhs_root_dir, prefetch_workers=1)
+        cw.prefetch('coasts', 'l', [1, 2])
+        self.assertEqual(len(cw._pending), 2)
+        for pending in cw._pending.values():
+            pending.wait()
+        # Finished loads are in the cache, not held by the pending loads
+        cw.prefetch('borders', 'c', 1)
+        self.assertEqual(len(cw._pending), 1)
+        self.assertEqual(cw.cache_info().items, 2)
+        cw.clear_cache()
+        self.assertEqual(len(cw._pending), 0)
+        finalizer = cw._pool_finalizer
+        self.assertTrue(finalizer.alive)
+        cw.close()
+        self.assertFalse(finalizer.alive)
+        self.assertTrue(cw._pool is None)
+
+    def test_writer_collected(self):
+        cw = ContourWriter(gshhs_root_dir, prefetch_workers=1)
+        cw.prefetch('coasts', 'l', [1, 2, 3])
+        ref = weakref.ref(cw)
+        pending = list(cw._pending.values())
+        # Queued loads do not keep the writer and its threads alive
+        del cw
+        for result in pending:
+            result.wait()
+        gc.collect()
+        self.assertTrue(ref() is None)
+
+
+class TestResolution(unittest.TestCase):
+    area_def = ('+proj=stere +lon_0=8.00 +lat_0=50.00 +lat_ts=50.00 +ellps=WGS84',
+                (-3363403.31, -2291879.85, 2630596.69, 2203620.1))
+
+    def test_get_resolution(self):
+        from pycoast.cw_base import get_resolution
+        area_extent = self.area_def[1]
+        self.assertEqual(get_resolution(area_extent, 64, 48), 'c')
+        self.assertEqual(get_resolution(area_extent, 640, 480), 'l')
+        self.assertEqual(get_resolution(area_extent, 6400, 4800), 'h')
+
+    def test_auto_resolution(self):
+        cw = ContourWriter(gshhs_root_dir)
+        expected = Image.new('RGB', (640, 480))
+        cw.add_coastlines(expected, self.area_def, resolution='l', level=4)
+        img = Image.new('RGB', (640, 480))
+        cw.add_coastlines(img, self.area_def, resolution='auto', level=4)
+        np.testing.assert_array_equal(np.array(img), np.array(expected))
+
+    def test_estimate_cost(self):
+        from pycoast.geometry import read_shapefile
+        cw = ContourWriter(gshhs_root_dir)
+        costs = cw.estimate_cost(self.area_def, {'coasts': [0, 1]},
+                                 x_size=640, y_size=480)
+        # Only the low resolution coastlines are in the test data
+        self.assertEqual(list(costs.keys()), ['l'])
+        shapes = [shape for i in (1, 2)
+                  for shape in read_shapefile(
+                      os.path.join(gshhs_root_dir, 'GSHHS_shp', 'l',
+                                   'GSHHS_l_L%d.shp' % i))]
+        self.assertTrue(0 < costs['l'].shapes < len(shapes))
+        self.assertTrue(0 < costs['l'].points <
+                        sum(len(shape.points) for shape in shapes))
+        # Estimates do not load the shapes into the shape cache
+        self.assertEqual(cw.cache_info().items, 0)
+        self.assertEqual(cw.estimate_cost(self.area_def, ['coasts'],
+                                          x_size=640, y_size=480,
+                                          resolutions=['f']), {})
+
+
+class TestProjCache(unittest.TestCase):
+    def test_proj_cache(self):
+        from pycoast.cache import (clear_proj_cache, get_proj,
+                                   normalize_proj4, proj_cache_info)
+        clear_proj_cache()
+        proj4_string = '+proj=stere +lon_0=8.00 +lat_0=50.00 +ellps=WGS84'
+        prj = get_proj(proj4_string)
+        self.assertTrue(get_proj('+lat_0=50.00  +proj=stere +lon_0=8.00 '
+                                 '+ellps=WGS84') is prj)
+        self.assertFalse(get_proj('+proj=merc +ellps=WGS84') is prj)
+        info = proj_cache_info()
+        self.assertEqual((info.hits, info.misses, info.items), (1, 2, 2))
+        self.assertTrue(info.saved_time >= 0)
+        # Steps of pipelines are not reordered
+        pipeline = '+proj=pipeline +step +proj=a +step +proj=b'
+        self.assertEqual(normalize_proj4(pipeline), pipeline)
+
+    def test_lru(self):
+        from pycoast.cache import ProjCache
+        cache = ProjCache(max_items=2)
+        for key in ('a', 'b', 'a', 'c'):
+            cache.get(key, lambda: key.upper())
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a', lambda: None), 'A')
+        self.assertEqual(cache.info().misses, 3)
+
+
+class TestBatchProjection(unittest.TestCase):
+    def test_batches(self):
+        import pyproj
+        from pycoast.cw_base import _iter_projected
+        prj = pyproj.Proj('+proj=stere +lon_0=8.00 +lat_0=50.00 '
+                          '+lat_ts=50.00 +ellps=WGS84')
+        area_extent = (-3363403.31, -2291879.85, 2630596.69, 2203620.1)
+        rng = np.random.RandomState(0)
+        point_arrays = [np.column_stack((rng.uniform(-10, 30, size),
+                                         rng.uniform(40, 70, size)))
+                        for size in (3, 0, 10, 1, 7)]
+        expected = list(_iter_projected(point_arrays, area_extent, 640, 480,
+                                        prj, x_offset=1))
+        self.assertEqual(len(expected), len(point_arrays))
+        for points, (x, y, n_x, n_y) in zip(point_arrays, expected):
+            ref_x, ref_y = prj(points[:, 0], points[:, 1])
+            np.testing.assert_array_equal(x, ref_x)
+            np.testing.assert_array_equal(y, ref_y)
+            self.assertEqual(len(n_x), len(points))
+        # Small batches give the same results
+        for result, ref in zip(_iter_projected(point_arrays, area_extent,
+                                               640, 480, prj, x_offset=1,
+                                               max_points=4), expected):
+            for arr, ref_arr in zip(result, ref):
+                np.testing.assert_array_equal(arr, ref_arr)
+
+
+class TestSegments(unittest.TestCase):
+    @staticmethod
+    def _reference_segments(x, y):
+        """Segments as split by the former point by point loop
+        """
+        i = 0
+        segments = []
+        in_segment = not (x[0] == 1e30 or y[0] == 1e30)
+        for j in range(x.size):
+            if (x[j] == 1e30 or y[j] == 1e30):
+                if in_segment:
+                    segments.append((x[i:j], y[i:j]))
+                    in_segment = False
+            elif not in_segment:
+                in_segment = True
+                i = j
+        if in_segment:
+            segments.append((x[i:], y[i:]))
+        return segments
+
+    def test_split(self):
+        from pycoast.cw_base import _get_segments
+        rng = np.random.RandomState(1)
+        for _ in range(50):
+            x = rng.uniform(0, 100, 20)
+            y = rng.uniform(0, 100, 20)
+            x[rng.uniform(size=20) < 0.3] = 1e30
+            y[rng.uniform(size=20) < 0.1] = 1e30
+            index_arrays, is_reduced = _get_segments(x, y, x, y)
+            expected = self._reference_segments(x, y)
+            self.assertEqual(is_reduced, 1e30 in x or 1e30 in y)
+            self.assertEqual(len(index_arrays), len(expected))
+            for index_array, (seg_x, seg_y) in zip(index_arrays, expected):
+                np.testing.assert_array_equal(index_array,
+                                              np.vstack((seg_x, seg_y)).T)
+
+    def test_inf_nan(self):
+        from pycoast.cw_base import _get_segments
+        x = np.array([1.0, 2.0, np.inf, 4.0, 5.0, 6.0, np.nan, 8.0])
+        y = np.array([1.0, 2.0, np.inf, 4.0, 5.0, 6.0, np.nan, 8.0])
+        index_arrays, is_reduced = _get_segments(x, y, x, y)
+        self.assertTrue(is_reduced)
+        self.assertEqual([len(index_array) for index_array in index_arrays],
+                         [2, 3, 1])
+
+
+class TestBoundingBox(unittest.TestCase):
+    def test_bounding_box(self):
+        import pyproj
+        from pycoast.cw_base import _get_lon_lat_bounding_box
+        prj = pyproj.Proj('+proj=laea +lat_0=90 +lon_0=0 +a=6371228.0 '
+                          '+units=m')
+        area_extent = (-5326849.0625, -5326849.0625,
+                       5326849.0625, 5326849.0625)
+        lon_min, lon_max, lat_min, lat_max = \
+            _get_lon_lat_bounding_box(area_extent, 425, 425, prj)
+        # Covers the north pole
+        self.assertEqual((lon_min, lon_max, lat_max), (-180, 180, 90))
+        self.assertTrue(0 < lat_min < 90)
+
+        prj = pyproj.Proj('+proj=stere +lon_0=-170.00 +lat_0=60.00 '
+                          '+lat_ts=50.00 +ellps=WGS84')
+        area_extent = (-3363403.31, -2291879.85, 2630596.69, 2203620.1)
+        lon_min, lon_max, lat_min, lat_max = \
+            _get_lon_lat_bounding_box(area_extent, 640, 480, prj)
+        # Crosses the dateline
+        self.assertTrue(lon_min > lon_max)
+
+    def test_geos_full_disk(self):
+        import pyproj
+        from pycoast.cw_base import _get_lon_lat_bounding_box
+        prj = pyproj.Proj('+proj=geos +lon_0=0.0 +a=6378169.00 '
+                          '+b=6356583.80 +h=35785831.0')
+        area_extent = (-5570248.4773392612, -5567248.074173444,
+                       5567248.074173444, 5570248.4773392612)
+        self.assertEqual(_get_lon_lat_bounding_box(area_extent, 425, 425,
+                                                   prj),
+                         (-180, 180, -90, 90))
+
+    def test_memoized(self):
+        import pyproj
+        from pycoast.cw_base import _bbox_cache, _get_lon_lat_bounding_box
+        prj = pyproj.Proj('+proj=stere +lon_0=8.00 +lat_0=50.00 '
+                          '+lat_ts=50.00 +ellps=WGS84')
+        area_extent = (-3363403.31, -2291879.85, 2630596.69, 2203620.1)
+        first = _get_lon_lat_bounding_box(area_extent, 640, 480, prj)
+        hits = _bbox_cache.info().hits
+        self.assertEqual(_get_lon_lat_bounding_box(area_extent, 640, 480,
+                                                   prj), first)
+        self.assertEqual(_bbox_cache.info().hits, hits + 1)
+
+
+class TestGeometryStore(unittest.TestCase):
+    def setUp(self):
+        self.db_root = tempfile.mkdtemp()
+        shutil.copytree(os.path.join(gshhs_root_dir, 'GSHHS_shp'),
+                        os.path.join(self.db_root, 'GSHHS_shp'))
+
+    def tearDown(self):
+        shutil.rmtree(self.db_root)
+
+    def _draw_europe(self, db_root):
+        img = Image.new('RGB', (640, 480))
+        proj4_string = '+proj=stere +lon_0=8.00 +lat_0=50.00 +lat_ts=50.00 +ellps=WGS84'
+        area_extent = (-3363403.31, -2291879.85, 2630596.69, 2203620.1)
+        cw = ContourWriter(db_root)
+        cw.add_coastlines(img, (proj4_string, area_extent), resolution='l',
+                          level=4, fill='green')
+        return np.array(img)
+
+    def test_convert(self):
+        from pycoast.store import convert_db, load_store
+        from pycoast.geometry import read_shapefile
+        store_paths = convert_db(self.db_root)
+        self.assertEqual(len(store_paths), 4)
+        shapefilename = os.path.join(self.db_root, 'GSHHS_shp', 'l',
+                                     'GSHHS_l_L1.shp')
+        shapes = read_shapefile(shapefilename)
+        stored = load_store(os.path.join(self.db_root, 'GSHHS_shp', 'l',
+                                         'GSHHS_l_L1.geom'))
+        self.assertTrue(isinstance(stored.coords, np.memmap))
+        self.assertEqual(stored.nbytes, 0)
+        self.assertEqual(len(stored), len(shapes))
+        np.testing.assert_array_equal(stored.bbox, shapes.bbox)
+        np.testing.assert_array_equal(stored[10].points, shapes[10].points)
+
+    def test_outdated_store(self):
+        from pycoast.store import (convert_db, get_source_path,
+                                   get_source_stamp, read_shapes)
+        convert_db(self.db_root, tile_size=10.0)
+        convert_db(self.db_root)
+        shapefilename = os.path.join(self.db_root, 'GSHHS_shp', 'l',
+                                     'GSHHS_l_L1.shp')
+        self.assertTrue(get_source_path(shapefilename).endswith('.tiles'))
+        # A replaced shapefile is read instead of its stores
+        stat = os.stat(shapefilename)
+        os.utime(shapefilename, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(get_source_path(shapefilename), shapefilename)
+        self.assertEqual(get_source_stamp(shapefilename)[0], shapefilename)
+        self.assertEqual(type(read_shapes(shapefilename)).__name__,
+                         'ShapefileShapes')
+        # Until it is converted again
+        convert_db(self.db_root)
+        self.assertTrue(get_source_path(shapefilename).endswith('.geom'))
+
+    def test_render_from_store(self):
+        from pycoast.store import convert_db
+        expected = self._draw_europe(self.db_root)
+        convert_db(self.db_root)
+        np.testing.assert_array_equal(self._draw_europe(self.db_root),
+                                      expected)
+
+    def test_float32_store(self):
+        from pycoast.store import convert_db, load_store
+        convert_db(self.db_root, dtype=np.float32)
+        stored = load_store(os.path.join(self.db_root, 'GSHHS_shp', 'l',
+                                         'GSHHS_l_L1.geom'))
+        self.assertEqual(stored.coords.dtype, np.float32)
+        self._draw_europe(self.db_root)
+
+    def test_tiled_store(self):
+        from pycoast.store import convert_db, load_store
+        expected = self._draw_europe(self.db_root)
+        store_paths = convert_db(self.db_root, tile_size=10.0)
+        self.assertTrue(all(path.endswith('.tiles') for path in store_paths))
+        stored = load_store(store_paths[0])
+        self.assertEqual(stored.tile_size, 10.0)
+        self.assertEqual(len(stored.parent_ids), len(stored))
+        # Pieces only differ from the whole shapes along the tile edges
+        res = self._draw_europe(self.db_root)
+        diff = np.any(res != expected, axis=2)
+        self.assertTrue(diff.mean() < 0.005)
+
+    def test_tiled_fill_only(self):
+        from pycoast.store import convert_db
+        area_def = ('+proj=stere +lon_0=8.00 +lat_0=50.00 +lat_ts=50.00 +ellps=WGS84',
+                    (-3363403.31, -2291879.85, 2630596.69, 2203620.1))
+        images = []
+        for tile_size in (None, 10.0):
+            if tile_size:
+                convert_db(self.db_root, tile_size=tile_size)
+            img = Image.new('RGB', (640, 480))
+            cw = ContourWriter(self.db_root)
+            cw.add_coastlines(img, area_def, resolution='l',
+                              level=[0, 1, 2, 3], fill='green',
+                              outline=None)
+            images.append(np.array(img))
+        # The outlines of the pieces are not drawn without outline colour
+        colours = set(map(tuple, images[1].reshape(-1, 3)))
+        self.assertEqual(colours, set([(0, 0, 0), (0, 128, 0)]))
+        diff = np.any(images[0] != images[1], axis=2)
+        self.assertTrue(diff.mean() < 0.0002)
+
+    def test_tiled_agg_fills(self):
+        from pycoast import ContourWriterAGG
+        from pycoast.display import FILL, POLYGON
+        from pycoast.store import convert_db
+        area_def = ('+proj=stere +lon_0=8.00 +lat_0=50.00 +lat_ts=50.00 +ellps=WGS84',
+                    (-3363403.31, -2291879.85, 2630596.69, 2203620.1))
+        layers = [('coasts', {'resolution': 'l', 'level': [0, 1, 2, 3],
+                              'fill': 'green', 'outline': None})]
+
+        def draw_fills():
+            # Fill the polygons of the untiled shapes and the pieces of the
+            # tiled ones alike
+            cw = ContourWriterAGG(self.db_root)
+            plan = cw.compile(area_def, layers, 640, 480)
+            img = Image.new('RGB', (640, 480))
+            for group in plan.groups:
+                draw = cw._get_canvas(img)
+                for name, args, kwargs in group:
+                    ops = [(FILL, index_array)
+                           for code, index_array in args[0]
+                           if code in (POLYGON, FILL)]
+                    cw._draw_ops(draw, ops, **kwargs)
+                cw._finalize(draw)
+            return np.array(img)
+
+        expected = draw_fills()
+        convert_db(self.db_root, tile_size=10.0)
+        res = draw_fills()
+        # The shared tile edges do not show. The pieces only differ from
+        # the whole shapes where the vertices added at the tile edges are
+        # projected off the straight edges, 0.1 % of the pixels at most.
+        diff = np.any(res != expected, axis=2)
+        self.assertTrue(diff.mean() < 0.001)
+
+    def test_simplify_shapes(self):
+        from pycoast.geometry import read_shapefile, simplify_shapes
+        shapes = read_shapefile(os.path.join(self.db_root, 'GSHHS_shp', 'l',
+                                             'GSHHS_l_L1.shp'))
+        simplified = simplify_shapes(shapes, 0.1)
+        self.assertEqual(len(simplified), len(shapes))
+        np.testing.assert_array_equal(simplified.bbox, shapes.bbox)
+        self.assertTrue(simplified.point_counts.sum() <
+                        0.7 * shapes.point_counts.sum())
+        for shape_id in range(0, len(shapes), 50):
+            points = np.asarray(shapes[shape_id].points)
+            kept = np.asarray(simplified[shape_id].points)
+            # Rings keep their ends and do not collapse
+            np.testing.assert_array_equal(kept[[0, -1]], points[[0, -1]])
+            self.assertTrue(len(kept) >= min(len(points), 4))
+            self.assertTrue(np.all((kept[:, None] ==
+                                    points[None]).all(axis=2).any(axis=1)))
+
+    def test_pyramid(self):
+        from pycoast.store import convert_db, get_pyramid_levels
+        expected = self._draw_europe(self.db_root)
+        paths = convert_db(self.db_root, pyramid=(0.01, 0.1))
+        self.assertEqual(len([path for path in paths
+                              if path.endswith('.pyramid')]), 4)
+        shapefilename = os.path.join(self.db_root, 'GSHHS_shp', 'l',
+                                     'GSHHS_l_L1.shp')
+        levels = get_pyramid_levels(shapefilename)
+        self.assertEqual([tolerance for tolerance, path in levels],
+                         [0.01, 0.1])
+        # Pyramids of replaced shapefiles are not used
+        stat = os.stat(shapefilename)
+        os.utime(shapefilename, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(get_pyramid_levels(shapefilename), [])
+        os.utime(shapefilename, (stat.st_atime, stat.st_mtime))
+
+        # The coarsest level within the tolerance is read
+        cw = ContourWriter(self.db_root)
+        for max_tolerance, expected_key, expected_path in (
+                (None, ('GSHHS', None, 'l', 1), shapefilename),
+                (0.005, ('GSHHS', None, 'l', 1), shapefilename),
+                (0.05, ('GSHHS', None, 'l', 1, 0.01), levels[0][1]),
+                (1.0, ('GSHHS', None, 'l', 1, 0.1), levels[1][1])):
+            self.assertEqual(cw._get_db_files('GSHHS', None, 'l', 1, False,
+                                              max_tolerance=max_tolerance),
+                             [(expected_key, expected_path)])
+
+        # Shapes are moved by less than half a pixel
+        res = self._draw_europe(self.db_root)
+        self.assertTrue(np.any(res != expected, axis=2).mean() < 0.005)
+        area_def = ('+proj=laea +lat_0=90 +lon_0=0 +a=6371228.0 +units=m',
+                    (-5326849.0625, -5326849.0625, 5326849.0625,
+                     5326849.0625))
+        costs = [writer.estimate_cost(area_def, ['coasts'], 100, 100)['l']
+                 for writer in (ContourWriter(gshhs_root_dir), cw)]
+        self.assertEqual(costs[0].shapes, costs[1].shapes)
+        self.assertTrue(costs[1].points < 0.7 * costs[0].points)
+
+    def test_pyramid_prefetch(self):
+        from pycoast.store import convert_db
+        convert_db(self.db_root, pyramid=(0.01, 0.1))
+        area_def = ('+proj=stere +lon_0=8.00 +lat_0=50.00 +lat_ts=50.00 +ellps=WGS84',
+                    (-3363403.31, -2291879.85, 2630596.69, 2203620.1))
+        cw = ContourWriter(self.db_root, prefetch_workers=2)
+        try:
+            cw.prefetch('coasts', 'l', [0, 1, 2, 3], area_def=area_def,
+                        x_size=640, y_size=480)
+            # The simplified levels drawn on the area are loaded
+            keys = list(cw._pending)
+            self.assertEqual(len(keys), 4)
+            self.assertTrue(all(len(key) == 5 for key in keys))
+            img = Image.new('RGB', (640, 480))
+            cw.add_coastlines(img, area_def, resolution='l',
+                              level=[0, 1, 2, 3], fill='green')
+            self.assertEqual(len(cw._pending), 0)
+            self.assertEqual(cw.cache_info().items, 4)
+            self.assertTrue(all(key in cw._shape_cache for key in keys))
+        finally:
+            cw.close()
+
+    def test_pixel_size(self):
+        import pyproj
+        from pycoast.cw_base import _compute_pixel_size
+        prj = pyproj.Proj('+proj=longlat +ellps=WGS84')
+        # Narrowest at the edges, half a degree of longitude at 45 degrees
+        self.assertAlmostEqual(
+            _compute_pixel_size((-180, -45, 180, 45), 720, 180, prj),
+            0.5 * np.cos(np.radians(45)), places=4)
+        self.assertTrue(
+            _compute_pixel_size((-180, -90, 180, 90), 720, 360, prj) > 0)
+        prj = pyproj.Proj('+proj=geos +lon_0=0.0 +a=6378169.00 '
+                          '+b=6356583.80 +h=35785831.0')
+        extent = (-5570248.4773392612, -5567248.074173444,
+                  5567248.074173444, 5570248.4773392612)
+        # Smallest near the sub-satellite point
+        self.assertTrue(0.2 < _compute_pixel_size(extent, 425, 425, prj)
+                        < 0.25)
+        self.assertEqual(_compute_pixel_size((-1e7, -1e7, -9e6, -9e6),
+                                             10, 10, prj), 0.0)
+
+
+class TestClipping(unittest.TestCase):
+    def test_clip_polygon(self):
+        from pycoast.geometry import clip_polygon
+        square = np.array([[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]], float)
+        rings = clip_polygon(square, 2, -1, 6, 2)
+        self.assertEqual(len(rings), 1)
+        ring, clip_edges = rings[0]
+        np.testing.assert_array_equal(ring[0], ring[-1])
+        np.testing.assert_array_equal(ring.min(axis=0), [2, 0])
+        np.testing.assert_array_equal(ring.max(axis=0), [4, 2])
+        # Two edges are created by the clipping
+        self.assertEqual(clip_edges.sum(), 2)
+        self.assertEqual(clip_polygon(square, 5, 5, 6, 6), [])
+
+    def test_clip_concave_polygon(self):
+        from pycoast.geometry import clip_polygon
+        # U shape giving two separate prongs above y == 2
+        u_shape = np.array([[0, 0], [3, 0], [3, 3], [2, 3], [2, 1], [1, 1],
+                            [1, 3], [0, 3], [0, 0]], float)
+        rings = clip_polygon(u_shape, -1, 2, 5, 5)
+        self.assertEqual(len(rings), 2)
+        for ring, clip_edges in rings:
+            self.assertEqual(len(ring), 5)
+            self.assertEqual(clip_edges.sum(), 1)
+
+    def test_clip_polyline(self):
+        from pycoast.geometry import clip_polyline
+        line = np.array([[-1, 1], [1, 1], [1, 3], [3, 3], [3, 1]], float)
+        pieces = clip_polyline(line, 0, 0, 2, 2)
+        self.assertEqual(len(pieces), 1)
+        np.testing.assert_array_equal(pieces[0], [[0, 1], [1, 1], [1, 2]])
+        self.assertEqual(len(clip_polyline(line, 0, 0, 4, 2)), 2)
+
+    def test_tile_shapes(self):
+        from pycoast.geometry import read_shapefile, tile_shapes
+        shapes = read_shapefile(os.path.join(gshhs_root_dir, 'GSHHS_shp',
+                                             'l', 'GSHHS_l_L1.shp'))
+        tiled = tile_shapes(shapes, tile_size=10.0)
+        self.assertTrue(len(tiled) >= len(shapes))
+        tiles = tiled.index.candidates(0.0, 9.9, 40.0, 49.9)
+        bbox = tiled.bbox[tiles]
+        self.assertTrue(np.all(bbox[:, 0] >= 0.0) and
+                        np.all(bbox[:, 2] <= 10.0))
+        self.assertTrue(np.all(bbox[:, 1] >= 40.0) and
+                        np.all(bbox[:, 3] <= 50.0))
+
+    def test_trim_polygon(self):
+        from pycoast.geometry import trim_polygon
+        # A prong beyond x == 6, of which only the first and last vertices
+        # beyond are kept
+        ring = np.array([[0, 0], [4, 0], [8, -1], [9, 1], [8, 3], [4, 2],
+                         [0, 2], [0, 0]], float)
+        np.testing.assert_array_equal(
+            trim_polygon(ring, -1, -2, 6, 4),
+            [[0, 0], [4, 0], [8, -1], [8, 3], [4, 2], [0, 2], [0, 0]])
+        self.assertTrue(trim_polygon(ring, 10, 10, 12, 12) is None)
+
+    def test_trim_polyline(self):
+        from pycoast.geometry import trim_polyline
+        line = np.array([[-9, 1], [-5, 1], [1, 1], [1, 9], [5, 9], [5, 1],
+                         [3, 1]], float)
+        pieces = trim_polyline(line, 0, 0, 4, 4)
+        self.assertEqual(len(pieces), 2)
+        np.testing.assert_array_equal(pieces[0], [[-5, 1], [1, 1], [1, 9]])
+        np.testing.assert_array_equal(pieces[1], [[5, 1], [3, 1]])
+
+    def test_clip_ops(self):
+        from pycoast.cw_base import _clip_ops
+        from pycoast.display import LINE, POLYGON
+        inside = np.array([[10.0, 10.0], [50.0, 10.0], [10.0, 50.0],
+                           [10.0, 10.0]])
+        outside = inside + 1000.0
+        big = np.array([[-500.0, -500.0], [0.0, -600.0], [600.0, -500.0],
+                        [600.0, 600.0], [-500.0, 600.0], [-500.0, -500.0]])
+        line = np.array([[-600.0, 50.0], [-500.0, 50.0], [50.0, 50.0],
+                         [50.0, 500.0]])
+        ops = list(_clip_ops([(POLYGON, inside), (POLYGON, outside),
+                              (POLYGON, big), (LINE, line),
+                              (LINE, np.zeros((0, 2)))], 100, 100,
+                             margin=10))
+        self.assertEqual([code for code, index_array in ops],
+                         [POLYGON, POLYGON, LINE, LINE])
+        self.assertTrue(ops[0][1] is inside)
+        np.testing.assert_array_equal(ops[1][1], big[[0, 2, 3, 4, 5]])
+        np.testing.assert_array_equal(ops[2][1], line[1:])
+
+    def test_clipped_polygon_unchanged(self):
+        # A large polygon cut by the clipping, drawn on a zoomed in area
+        import pycoast.cw_base
+        from pycoast import ContourWriterAGG
+        area_def = ('+proj=stere +lon_0=8.00 +lat_0=50.00 +lat_ts=50.00 +ellps=WGS84',
+                    (-400000.0, -300000.0, 400000.0, 340000.0))
+        polygon = [(-30, 20), (40, 25), (45, 70), (10, 75), (5, 48),
+                   (-20, 52)]
+        clip_ops = pycoast.cw_base._clip_ops
+        for cls in (ContourWriter, ContourWriterAGG):
+            images = []
+            for clip in (True, False):
+                if not clip:
+                    pycoast.cw_base._clip_ops = \
+                        lambda ops, x_size, y_size: ops
+                try:
+                    img = Image.new('RGB', (400, 320))
+                    cw = cls(gshhs_root_dir)
+                    cw.add_polygon(img, area_def, polygon, outline='red',
+                                   fill='gray')
+                    images.append(np.array(img))
+                finally:
+                    pycoast.cw_base._clip_ops = clip_ops
+            # No pixel may differ
+            n_differ = np.count_nonzero((images[0] != images[1]).any(axis=2))
+            self.assertEqual(n_differ, 0)
+
+    def test_zoomed_render(self):
+        # Only the geometry near the image is drawn, with the same result
+        import pycoast.cw_base
+        area_def = ('+proj=stere +lon_0=8.00 +lat_0=50.00 +lat_ts=50.00 +ellps=WGS84',
+                    (-600000.0, -400000.0, 600000.0, 400000.0))
+        layers = [('coasts', {'resolution': 'l', 'level': [0, 1, 2, 3],
+                              'fill': 'green', 'outline': 'white'})]
+        cw = ContourWriter(gshhs_root_dir)
+        plan = cw.compile(area_def, layers, 640, 480)
+        clip_ops = pycoast.cw_base._clip_ops
+        pycoast.cw_base._clip_ops = lambda ops, x_size, y_size: ops
+        try:
+            unclipped = cw.compile(area_def, layers, 640, 480)
+        finally:
+            pycoast.cw_base._clip_ops = clip_ops
+        self.assertTrue(plan.nbytes < unclipped.nbytes / 5)
+        np.testing.assert_array_equal(
+            np.array(plan.render(Image.new('RGB', (640, 480)))),
+            np.array(unclipped.render(Image.new('RGB', (640, 480)))))
+
+
+class TestBBoxIndex(unittest.TestCase):
+    def test_query(self):
+        from pycoast.geometry import BBoxIndex, bbox_overlaps
+        rng = np.random.RandomState(0)
+        lon_min = rng.uniform(-180, 170, 2000)
+        lat_min = rng.uniform(-90, 80, 2000)
+        size = rng.exponential(2, (2000, 2))
+        bbox = np.column_stack((lon_min, lat_min,
+                                np.minimum(lon_min + size[:, 0], 180),
+                                np.minimum(lat_min + size[:, 1], 90)))
+        # A few boxes covering the globe end up in the always checked list
+        bbox[:3] = [-180, -90, 180, 90]
+        index = BBoxIndex(bbox)
+        for box in ((0, 10, 50, 60), (-180, -170, -90, -80),
+                    (-180, 180, -90, 90), (30.5, 30.6, 20.1, 20.2)):
+            expected = np.flatnonzero(bbox_overlaps(bbox, *box))
+            candidates = index.candidates(*box)
+            self.assertEqual(np.setdiff1d(expected, candidates).size, 0)
+            self.assertTrue(len(candidates) <= len(bbox))
+
+    def test_shapes_query(self):
+        from pycoast.geometry import read_shapefile, bbox_overlaps
+        shapes = read_shapefile(os.path.join(gshhs_root_dir, 'GSHHS_shp', 'l',
+                                             'GSHHS_l_L1.shp'))
+        box = (5.0, 30.0, 54.0, 71.0)
+        expected = np.flatnonzero(bbox_overlaps(shapes.bbox, *box))
+        shape_ids = shapes.query(*box)
+        np.testing.assert_array_equal(shape_ids, expected)
+        self.assertTrue(len(shapes.index.candidates(*box)) < len(shapes) / 2)
+
+class TestPixelCache(unittest.TestCase):
+    area_def = ('+proj=stere +lon_0=8.00 +lat_0=50.00 +lat_ts=50.00 +ellps=WGS84',
+                (-3363403.31, -2291879.85, 2630596.69, 2203620.1))
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _draw(self, cw):
+        img = Image.new('RGB', (640, 480))
+        cw.add_coastlines(img, self.area_def, resolution='l', level=4,
+                          fill='green', outline='white')
+        cw.add_borders(img, self.area_def, outline='red')
+        return np.array(img)
+
+    def test_cache(self):
+        from pycoast.cache import PixelCache
+        from pycoast.display import LINE, POLYGON, DisplayList
+        cache = PixelCache(self.cache_dir, 2000)
+        display_list = DisplayList.from_ops(
+            [(POLYGON, np.array([[0., 0.], [10., 0.], [10., 10.]])),
+             (LINE, np.array([[1., 2.], [3., 4.]]))])
+        self.assertEqual(cache.get('a'), None)
+        cache.put('a', display_list)
+        cached = cache.get('a')
+        self.assertEqual(list(cached.codes), [POLYGON, LINE])
+        np.testing.assert_array_equal(cached.coords, display_list.coords)
+        np.testing.assert_array_equal(cached.offsets, [0, 3, 5])
+
+        # The oldest files are evicted beyond the byte budget
+        nbytes = cache.info().nbytes
+        cache.max_bytes = int(2.5 * nbytes)
+        for key in ('b', 'c'):
+            os.utime(os.path.join(self.cache_dir, 'a.npz'), (0, 0))
+            cache.put(key, display_list)
+        self.assertEqual(cache.get('a'), None)
+        info = cache.info()
+        self.assertEqual((info.hits, info.misses, info.evictions, info.items),
+                         (1, 2, 1, 2))
+        self.assertEqual(
+            [name for name in os.listdir(self.cache_dir)
+             if not name.endswith('.npz')], [])
+
+        # Corrupt files are removed
+        with open(os.path.join(self.cache_dir, 'b.npz'), 'wb') as fid:
+            fid.write(b'garbage')
+        self.assertEqual(cache.get('b'), None)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir,
+                                                     'b.npz')))
+        cache.clear()
+        self.assertEqual(cache.info().items, 0)
+
+    def test_writer_pixel_cache(self):
+        expected = self._draw(ContourWriter(gshhs_root_dir))
+        cw = ContourWriter(gshhs_root_dir, pixel_cache_dir=self.cache_dir)
+        np.testing.assert_array_equal(self._draw(cw), expected)
+        info = cw.pixel_cache_info()
+        self.assertEqual((info.hits, info.misses, info.items), (0, 2, 2))
+
+        # A new writer draws from the pixel cache without reading shapes
+        cw = ContourWriter(gshhs_root_dir, pixel_cache_dir=self.cache_dir)
+        np.testing.assert_array_equal(self._draw(cw), expected)
+        self.assertEqual(cw.pixel_cache_info().hits, 2)
+        self.assertEqual(cw.cache_info().misses, 0)
+        self.assertEqual(ContourWriter(gshhs_root_dir).pixel_cache_info(),
+                         None)
+
+    def test_changed_dataset(self):
+        db_root = tempfile.mkdtemp()
+        try:
+            shutil.copytree(os.path.join(gshhs_root_dir, 'GSHHS_shp'),
+                            os.path.join(db_root, 'GSHHS_shp'))
+            img = Image.new('RGB', (640, 480))
+            cw = ContourWriter(db_root, pixel_cache_dir=self.cache_dir)
+            cw.add_coastlines(img, self.area_def, resolution='l', level=4)
+            os.utime(os.path.join(db_root, 'GSHHS_shp', 'l',
+                                  'GSHHS_l_L4.shp'), (0, 0))
+            cw.add_coastlines(img, self.area_def, resolution='l', level=4)
+            info = cw.pixel_cache_info()
+            self.assertEqual((info.hits, info.misses), (0, 2))
+        finally:
+            shutil.rmtree(db_root)
+
+class TestOverlayPlan(unittest.TestCase):
+    area_def = ('+proj=stere +lon_0=8.00 +lat_0=50.00 +lat_ts=50.00 +ellps=WGS84',
+                (-3363403.31, -2291879.85, 2630596.69, 2203620.1))
+    coasts = {'resolution': 'l', 'level': 4, 'fill': 'green',
+              'outline': 'white'}
+    grid = {'Dlon': 10.0, 'Dlat': 10.0, 'dlon': 2.0, 'dlat': 2.0,
+            'outline': 'blue', 'minor_outline': 'lightblue',
+            'write_text': False}
+
+    def test_render(self):
+        cw = ContourWriter(gshhs_root_dir)
+        img = Image.new('RGB', (640, 480))
+        cw.add_coastlines(img, self.area_def, **self.coasts)
+        cw.add_rivers(img, self.area_def, level=5, outline='blue')
+        cw.add_grid(img, self.area_def, **self.grid)
+        expected = np.array(img)
+
+        plan = cw.compile(self.area_def,
+                          {'grid': self.grid,
+                           'coasts': self.coasts,
+                           'rivers': {'level': 5, 'outline': 'blue'}},
+                          640, 480)
+        self.assertTrue(plan.nbytes > 0)
+        info = cw.cache_info()
+        for i in range(2):
+            img = plan.render(Image.new('RGB', (640, 480)))
+            np.testing.assert_array_equal(np.array(img), expected)
+        # Rendering reads nothing
+        self.assertEqual(cw.cache_info(), info)
+
+    def test_errors(self):
+        cw = ContourWriter(gshhs_root_dir)
+        plan = cw.compile(self.area_def, [('coasts', self.coasts)], 640, 480)
+        self.assertRaises(ValueError, plan.render,
+                          Image.new('RGB', (320, 240)))
+        self.assertRaises(ValueError, cw.compile, self.area_def,
+                          [('lakes', {})], 640, 480)
+        self.assertRaises(ValueError, cw.compile, self.area_def,
+                          [('coasts', self.coasts)])
+
+class TestBatch(unittest.TestCase):
+    areas = [('+proj=stere +lon_0=8.00 +lat_0=50.00 +lat_ts=50.00 +ellps=WGS84',
+              (-3363403.31, -2291879.85, 2630596.69, 2203620.1)),
+             ('+proj=stere +lon_0=-60 +lat_0=-10 +lat_ts=-10 +ellps=WGS84',
+              (-3000000.0, -3000000.0, 3000000.0, 3000000.0)),
+             ('+proj=merc +lon_0=180 +ellps=WGS84',
+              (-5000000.0, -5000000.0, 5000000.0, 5000000.0))]
+    layers = [('coasts', {'resolution': 'l', 'level': [0, 1, 2, 3],
+                          'fill': 'green'}),
+              ('borders', {'outline': 'red'}),
+              ('rivers', {'level': 5, 'outline': 'blue'})]
+
+    def test_batch(self):
+        cw = ContourWriter(gshhs_root_dir, cache_size=0)
+        expected = []
+        for area_def in self.areas:
+            img = Image.new('RGB', (640, 480))
+            cw.add_coastlines(img, area_def, **self.layers[0][1])
+            cw.add_borders(img, area_def, **self.layers[1][1])
+            cw.add_rivers(img, area_def, **self.layers[2][1])
+            expected.append(np.array(img))
+
+        images = [Image.new('RGB', (640, 480)) for area_def in self.areas]
+        cw = ContourWriter(gshhs_root_dir, cache_size=0)
+        cw.add_overlays_batch(zip(images, self.areas), self.layers)
+        for img, res in zip(images, expected):
+            np.testing.assert_array_equal(np.array(img), res)
+        # Each of the six datasets is read once
+        self.assertEqual(cw.cache_info().misses, 6)
+
+    def test_parallel(self):
+        layers = self.layers + [('line', {'lonlats': [(0, 40), (20, 60)],
+                                          'outline': 'yellow'})]
+        cw = ContourWriter(gshhs_root_dir)
+        expected = [Image.new('RGBA', (640, 480), (10, 20, 30, 128))
+                    for area_def in self.areas]
+        cw.add_overlays_batch(zip(expected, self.areas), layers)
+
+        images = [Image.new('RGBA', (640, 480), (10, 20, 30, 128))
+                  for area_def in self.areas]
+        cw.add_overlays_batch(zip(images, self.areas), layers, workers=2)
+        for img, res in zip(images, expected):
+            np.testing.assert_array_equal(np.array(img), np.array(res))
+
+    def test_parallel_and_prefetch(self):
+        expected = [Image.new('RGB', (640, 480)) for area_def in self.areas]
+        ContourWriter(gshhs_root_dir).add_overlays_batch(
+            zip(expected, self.areas), self.layers)
+
+        cw = ContourWriter(gshhs_root_dir, prefetch_workers=2)
+        try:
+            for i in range(2):
+                # The prefetching threads are loading while the drawing
+                # processes start
+                cw.clear_cache()
+                cw.prefetch('coasts', 'l', [0, 1, 2, 3])
+                cw.prefetch('rivers', 'c', 5)
+                cw.prefetch('borders', 'c', 1)
+                images = [Image.new('RGB', (640, 480))
+                          for area_def in self.areas]
+                cw.add_overlays_batch(zip(images, self.areas), self.layers,
+                                      workers=2)
+                for img, res in zip(images, expected):
+                    np.testing.assert_array_equal(np.array(img),
+                                                  np.array(res))
+                if i == 0:
+                    pool = cw._process_pool
+            # The processes are kept for the following batches
+            self.assertTrue(cw._process_pool is pool)
+            finalizer = cw._process_pool_finalizer
+        finally:
+            cw.close()
+        self.assertFalse(finalizer.alive)
+        self.assertTrue(cw._process_pool is None)
+
+    def test_pickle(self):
+        import pickle
+        cw = ContourWriter(gshhs_root_dir, cache_size=1000,
+                           prefetch_workers=2)
+        cw.prefetch('coasts')
+        copy = pickle.loads(pickle.dumps(cw))
+        cw.close()
+        self.assertEqual(copy.db_root_path, gshhs_root_dir)
+        self.assertEqual(copy.cache_info().max_bytes, 1000)
+        self.assertEqual(copy.cache_info().items, 0)
+        self.assertEqual(copy.prefetch_workers, 2)
+
+    def test_union_bounding_box(self):
+        from pycoast.cw_base import _union_bounding_box
+        self.assertEqual(_union_bounding_box([(0, 10, -5, 5),
+                                              (-20, 5, 0, 30)]),
+                         (-20, 10, -5, 30))
+        self.assertEqual(_union_bounding_box([(0, 10, -5, 5),
+                                              (170, -170, 0, 30)]), None)
+
+class TestThreads(unittest.TestCase):
+    areas = TestBatch.areas[:2]
+
+    def _draw(self, cw, area_def):
+        img = Image.new('RGB', (320, 240))
+        cw.add_coastlines(img, area_def, resolution='l', level=[0, 1, 2, 3],
+                          fill='green', outline='white')
+        cw.add_rivers(img, area_def, level=5, outline='blue')
+        cw.add_borders(img, area_def, outline='red')
+        cw.add_polygon(img, area_def, [(0, 40), (20, 60), (30, 40)],
+                       outline='yellow')
+        return np.array(img)
+
+    def _stress(self, cw, n_threads=8, n_rounds=2):
+        expected = [self._draw(ContourWriter(gshhs_root_dir), area_def)
+                    for area_def in self.areas]
+        results = {}
+        errors = []
+
+        def render(thread_id):
+            try:
+                for i in range(n_rounds):
+                    area_id = (thread_id + i) % len(self.areas)
+                    results[(thread_id, i)] = \
+                        (area_id, self._draw(cw, self.areas[area_id]))
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=render, args=(thread_id,))
+                   for thread_id in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), n_threads * n_rounds)
+        for area_id, res in results.values():
+            np.testing.assert_array_equal(res, expected[area_id])
+
+    def test_shared_writer(self):
+        self._stress(ContourWriter(gshhs_root_dir))
+
+    def test_small_cache(self):
+        # Datasets are evicted and loaded again all the time
+        self._stress(ContourWriter(gshhs_root_dir, cache_size=200000))
+
+    def test_prefetch_and_pixel_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        cw = ContourWriter(gshhs_root_dir, prefetch_workers=2,
+                           pixel_cache_dir=cache_dir)
+        try:
+            self._stress(cw)
+        finally:
+            cw.close()
+            shutil.rmtree(cache_dir)
+
+    def test_single_load(self):
+        reads = []
+
+        class CountingWriter(ContourWriter):
+            def _read_shapes(self, key, shapefilename):
+                reads.append(key)
+                return ContourWriter._read_shapes(self, key, shapefilename)
+
+        self._stress(CountingWriter(gshhs_root_dir))
+        # Every dataset was read by one thread only
+        self.assertEqual(len(reads), 6)
+
+    def test_load_locks_dropped(self):
+        cw = ContourWriter(gshhs_root_dir, cache_size=200000)
+        self._stress(cw)
+        # Locks of finished loads are not kept
+        self.assertEqual(cw._load_locks, {})
+        with cw._load_lock('key'):
+            self.assertEqual(list(cw._load_locks), ['key'])
+            cw.clear_cache()
+            self.assertEqual(cw._load_locks, {})
+        self.assertEqual(cw._load_locks, {})
+
+class TestCulling(unittest.TestCase):
+    dateline_area = ('+proj=merc +lon_0=180 +ellps=WGS84',
+                     (-5000000.0, -5000000.0, 5000000.0, 5000000.0))
+    polar_area = ('+proj=laea +lat_0=90 +lon_0=0 +a=6371228.0 +units=m',
+                  (-5326849.0625, -5326849.0625, 5326849.0625, 5326849.0625))
+
+    def _expected_outside(self, area_def, level):
+        """Count the shapes outside the lon/lat box of an area, one by one
+        """
+        import pyproj
+        from pycoast.cw_base import _get_lon_lat_bounding_box
+        from pycoast.geometry import read_shapefile
+        lon_min, lon_max, lat_min, lat_max = _get_lon_lat_bounding_box(
+            area_def[1], 320, 240, pyproj.Proj(area_def[0]))
+        shapes = read_shapefile(os.path.join(gshhs_root_dir, 'GSHHS_shp',
+                                             'l', 'GSHHS_l_L%d.shp' % level))
+        outside = 0
+        for shape in shapes:
+            s_lon_min, s_lat_min, s_lon_max, s_lat_max = shape.bbox
+            if lon_min > lon_max:
+                in_lon = s_lon_max >= lon_min or s_lon_min <= lon_max
+            else:
+                in_lon = s_lon_max >= lon_min and s_lon_min <= lon_max
+            in_lat = s_lat_max >= lat_min and s_lat_min <= lat_max
+            if not (in_lon and in_lat):
+                outside += 1
+        return len(shapes), outside
+
+    def _cull_info(self, area_def):
+        cw = ContourWriter(gshhs_root_dir)
+        cw.add_coastlines(Image.new('RGB', (320, 240)), area_def,
+                          resolution='l', level=1)
+        return cw.cull_info()
+
+    def test_dateline(self):
+        import pyproj
+        from pycoast.cw_base import _get_lon_lat_bounding_box
+        lon_min, lon_max, lat_min, lat_max = _get_lon_lat_bounding_box(
+            self.dateline_area[1], 320, 240,
+            pyproj.Proj(self.dateline_area[0]))
+        self.assertTrue(lon_min > lon_max)
+        info = self._cull_info(self.dateline_area)
+        self.assertEqual(tuple(info[:2]),
+                         self._expected_outside(self.dateline_area, 1))
+        self.assertEqual(info.hidden, 0)
+        # Most of the world is culled
+        self.assertTrue(info.outside > 0.8 * info.shapes)
+
+    def test_polar(self):
+        info = self._cull_info(self.polar_area)
+        self.assertEqual(tuple(info[:2]),
+                         self._expected_outside(self.polar_area, 1))
+        self.assertTrue(info.outside > 0)
+
+    def test_wrapped_overlaps(self):
+        from pycoast.geometry import bbox_overlaps
+        bbox = np.array([[170.0, 0.0, 175.0, 5.0],
+                         [-175.0, 0.0, -170.0, 5.0],
+                         [0.0, 0.0, 10.0, 5.0],
+                         [175.0, 0.0, 185.0, 5.0],
+                         [-185.0, 0.0, -178.0, 5.0],
+                         [-175.0, 10.0, -170.0, 15.0]])
+        np.testing.assert_array_equal(
+            bbox_overlaps(bbox, 172.0, -172.0, -5.0, 8.0),
+            [True, True, False, True, True, False])
+        np.testing.assert_array_equal(
+            bbox_overlaps(bbox, 177.0, 179.0, -5.0, 8.0),
+            [False, False, False, True, False, False])
+
+    def test_query(self):
+        from pycoast.geometry import Shapes
+        bbox = np.array([[170.0, 0.0, 175.0, 5.0],
+                         [-175.0, 0.0, -170.0, 5.0],
+                         [0.0, 0.0, 10.0, 5.0]])
+        shapes = Shapes(np.zeros((0, 2)), np.zeros(4, dtype=np.int64),
+                        np.arange(4), bbox, 5)
+        np.testing.assert_array_equal(shapes.query(172.0, -172.0, -5, 8),
+                                      [0, 1])
+
+    def test_cull_info(self):
+        cw = ContourWriter(gshhs_root_dir)
+        img = Image.new('RGB', (320, 240))
+        cw.add_coastlines(img, self.dateline_area, resolution='l', level=1)
+        cw.add_polygon(img, self.dateline_area,
+                       [(0, 0), (10, 0), (10, 10)], outline='red')
+        info = cw.cull_info()
+        first = self._cull_info(self.dateline_area)
+        self.assertEqual(info, (first.shapes + 1, first.outside + 1, 0, 0))
+        cw.clear_cull_info()
+        self.assertEqual(cw.cull_info(), (0, 0, 0, 0))
+
+    def test_horizon(self):
+        import pyproj
+        from pycoast.cw_base import _get_visible_cap, _visible_mask
+        from pycoast.geometry import read_shapefile
+        proj4_string = ('+proj=geos +lon_0=0.0 +a=6378169.00 +b=6356583.80 '
+                        '+h=35785831.0')
+        area_def = (proj4_string, (-5570248.4773392612, -5567248.074173444,
+                                   5567248.074173444, 5570248.4773392612))
+        cw = ContourWriter(gshhs_root_dir)
+        cw.add_coastlines(Image.new('RGB', (425, 425)), area_def,
+                          resolution='l', level=1)
+        info = cw.cull_info()
+        self.assertEqual(info.outside, 0)
+        # About half of the world is beyond the horizon
+        self.assertTrue(0.3 * info.shapes < info.hidden < 0.7 * info.shapes)
+
+        # No point of the hidden shapes is within the projection
+        shapes = read_shapefile(os.path.join(gshhs_root_dir, 'GSHHS_shp',
+                                             'l', 'GSHHS_l_L1.shp'))
+        visible = _visible_mask([shape.bbox for shape in shapes],
+                                _get_visible_cap(proj4_string))
+        self.assertEqual(np.count_nonzero(~visible), info.hidden)
+        prj = pyproj.Proj(proj4_string)
+        for shape, is_visible in zip(shapes, visible):
+            if not is_visible:
+                points = np.asarray(shape.points)
+                x, y = prj(points[:, 0], points[:, 1])
+                self.assertFalse(np.any(np.abs(x) < 1e10))
+
+    def test_visible_cap(self):
+        from pycoast.cw_base import _get_visible_cap
+        lon_0, lat_0, radius = _get_visible_cap(
+            '+proj=geos +lon_0=140.7 +h=35785831.0')
+        self.assertEqual((lon_0, lat_0), (140.7, 0.0))
+        self.assertTrue(81 < radius < 83)
+        self.assertEqual(_get_visible_cap('+proj=ortho +lat_0=45 +lon_0=10'),
+                         (10.0, 45.0, 91.0))
+        self.assertTrue(_get_visible_cap(self.dateline_area[0]) is None)
+
+    def test_small_features(self):
+        import pickle
+        import pyproj
+        from pycoast.cw_base import _get_pixel_extents
+        from pycoast.geometry import read_shapefile
+        cw = ContourWriter(gshhs_root_dir)
+        small = ContourWriter(gshhs_root_dir, min_feature_size=1.0)
+        self.assertEqual(pickle.loads(pickle.dumps(small)).min_feature_size,
+                         1.0)
+        images = []
+        for writer in (cw, small):
+            img = Image.new('RGB', (425, 425))
+            writer.add_coastlines(img, self.polar_area, resolution='l',
+                                  level=2)
+            images.append(np.array(img))
+        self.assertEqual(cw.cull_info().small, 0)
+        info = small.cull_info()
+        self.assertTrue(info.small > 0)
+        self.assertEqual(info[:2], cw.cull_info()[:2])
+        # Only specks of a pixel or two are missing
+        self.assertTrue(np.any(images[0] != images[1], axis=2).mean() < 0.02)
+
+        # The culled shapes are smaller than their bounding box estimate
+        shapes = read_shapefile(os.path.join(gshhs_root_dir, 'GSHHS_shp',
+                                             'l', 'GSHHS_l_L2.shp'))
+        prj = pyproj.Proj(self.polar_area[0])
+        extents = _get_pixel_extents([shape.bbox for shape in shapes],
+                                     self.polar_area[1], 425, 425, prj)
+        scale = 425 / (self.polar_area[1][2] - self.polar_area[1][0])
+        for shape, extent in zip(shapes, extents):
+            if extent < 1.0:
+                points = np.asarray(shape.points)
+                x, y = prj(points[:, 0], points[:, 1])
+                size = max(np.ptp(x), np.ptp(y)) * scale
+                self.assertTrue(size <= extent * 1.01 + 1e-9)
+
+    def test_pixel_extents(self):
+        import pyproj
+        from pycoast.cw_base import _get_pixel_extents
+        area_extent = (-5570248.4773392612, -5567248.074173444,
+                       5567248.074173444, 5570248.4773392612)
+        prj = pyproj.Proj('+proj=geos +lon_0=0.0 +a=6378169.00 '
+                          '+b=6356583.80 +h=35785831.0')
+        extents = _get_pixel_extents([[0.0, 0.0, 1.0, 0.5],
+                                      [170.0, 0.0, 171.0, 1.0]],
+                                     area_extent, 425, 425, prj)
+        # About 111 km at 26 km per pixel
+        self.assertTrue(4.0 < extents[0] < 4.5)
+        self.assertEqual(extents[1], np.inf)
+        self.assertEqual(len(_get_pixel_extents(np.zeros((0, 4)),
+                                                area_extent, 425, 425,
+                                                prj)), 0)
+
+    def test_bbox_distance(self):
+        from pycoast.geometry import bbox_distance
+        bbox = np.array([[-10.0, -10.0, 10.0, 10.0],
+                         [20.0, -5.0, 30.0, 5.0],
+                         [170.0, -5.0, 190.0, 5.0],
+                         [-30.0, 80.0, -20.0, 85.0],
+                         [90.0, 60.0, 100.0, 70.0]])
+        np.testing.assert_allclose(bbox_distance(bbox, 0.0, 0.0)[[0, 1, 4]],
+                                   [0.0, 20.0, 90.0])
+        np.testing.assert_allclose(bbox_distance(bbox, 180.0, 0.0)[2], 0.0)
+        # Compare with the nearest of points sampled in the boxes
+        for lon_0, lat_0 in ((0.0, 0.0), (150.0, 80.0), (-60.0, -45.0)):
+            distance = bbox_distance(bbox, lon_0, lat_0)
+            for box, box_distance in zip(bbox, distance):
+                lons, lats = np.radians(np.meshgrid(
+                    np.linspace(box[0], box[2], 101),
+                    np.linspace(box[1], box[3], 101)))
+                cos_dist = (np.sin(np.radians(lat_0)) * np.sin(lats) +
+                            np.cos(np.radians(lat_0)) * np.cos(lats) *
+                            np.cos(lons - np.radians(lon_0)))
+                nearest = np.degrees(np.arccos(np.clip(cos_dist, -1, 1)))
+                self.assertTrue(box_distance <= nearest.min() + 1e-9)
+                self.assertTrue(box_distance > nearest.min() - 0.2)
+
+
+class TestDecimation(unittest.TestCase):
+    geos_area = ('+proj=geos +lon_0=0.0 +a=6378169.00 +b=6356583.80 '
+                 '+h=35785831.0',
+                 (-5570248.4773392612, -5567248.074173444,
+                  5567248.074173444, 5570248.4773392612))
+
+    def test_decimate_ops(self):
+        from pycoast.cw_base import _decimate_ops
+        from pycoast.display import FILL, LINE, POLYGON
+        t = np.linspace(0, 2 * np.pi, 2001)
+        ring = np.column_stack((50 + 20 * np.cos(t), 50 + 20 * np.sin(t)))
+        line = np.column_stack((np.linspace(0, 10, 500), np.zeros(500)))
+        ops = list(_decimate_ops([(POLYGON, ring), (LINE, line),
+                                  (LINE, line[:1]), (FILL, ring)], 0.5))
+        self.assertEqual([code for code, index_array in ops],
+                         [POLYGON, LINE, LINE, FILL])
+        reduced = ops[0][1]
+        self.assertTrue(len(reduced) < 400)
+        np.testing.assert_array_equal(reduced[[0, -1]], ring[[0, -1]])
+        # Every dropped vertex is within a cell diagonal of a kept one
+        dist = np.hypot(ring[:, None, 0] - reduced[None, :, 0],
+                        ring[:, None, 1] - reduced[None, :, 1]).min(axis=1)
+        self.assertTrue(dist.max() <= np.hypot(0.5, 0.5))
+        self.assertTrue(len(ops[1][1]) <= 22)
+        np.testing.assert_array_equal(ops[1][1][[0, -1]], line[[0, -1]])
+        np.testing.assert_array_equal(ops[2][1], line[:1])
+        self.assertTrue(ops[3][1] is ring)
+
+    def test_douglas_peucker(self):
+        from pycoast.geometry import douglas_peucker
+        x = np.linspace(0, 100, 1001)
+        points = np.column_stack((x, 0.2 * np.sin(x)))
+        np.testing.assert_array_equal(douglas_peucker(points, 0.5),
+                                      points[[0, -1]])
+        points[500, 1] = 5
+        simplified = douglas_peucker(points, 0.5)
+        self.assertTrue(len(simplified) < 10)
+        self.assertTrue(np.any(np.all(simplified == points[500], axis=1)))
+        ring = np.array([[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]], float)
+        np.testing.assert_array_equal(douglas_peucker(ring, 0.5), ring)
+
+    def _plan_size(self, cw):
+        return cw.compile(self.geos_area,
+                          {'coasts': {'resolution': 'l', 'level': 1}},
+                          425, 425).nbytes
+
+    def test_writer(self):
+        def draw(cw):
+            img = Image.new('RGB', (425, 425))
+            cw.add_coastlines(img, self.geos_area, resolution='l', level=1)
+            cw.add_shapefile_shapes(img, self.geos_area, os.path.join(
+                os.path.dirname(__file__), 'test_data', 'shapes',
+                'Metareas.shp'), outline='red')
+            return np.array(img)
+
+        cw = ContourWriter(gshhs_root_dir)
+        self.assertEqual(cw.vertex_tolerance, 0.5)
+        full = ContourWriter(gshhs_root_dir, vertex_tolerance=0)
+        # Merged vertices are within the pixels drawn by PIL
+        np.testing.assert_array_equal(draw(cw), draw(full))
+        self.assertTrue(self._plan_size(cw) < 0.8 * self._plan_size(full))
+
+        simple = ContourWriter(gshhs_root_dir, simplify_tolerance=1.0)
+        self.assertTrue(self._plan_size(simple) < self._plan_size(cw))
+
+    def test_defaults(self):
+        import pickle
+        try:
+            from pycoast.cw_agg import ContourWriterAGG
+        except ImportError:
+            return
+        self.assertEqual(ContourWriterAGG(gshhs_root_dir).vertex_tolerance,
+                         0)
+        cw = pickle.loads(pickle.dumps(
+            ContourWriterAGG(gshhs_root_dir, vertex_tolerance=0.25,
+                             simplify_tolerance=0.5)))
+        self.assertEqual((cw.vertex_tolerance, cw.simplify_tolerance),
+                         (0.25, 0.5))
+
+
 def suite():
     loader = unittest.TestLoader()
     mysuite = unittest.TestSuite()
     mysuite.addTest(loader.loadTestsFromTestCase(TestPIL))
     mysuite.addTest(loader.loadTestsFromTestCase(TestPILAGG))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestShapefileShapes))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestCities))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestShapeCache))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestPrefetch))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestResolution))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestProjCache))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestBatchProjection))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestSegments))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestBoundingBox))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestGeometryStore))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestBBoxIndex))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestClipping))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestPixelCache))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestOverlayPlan))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestBatch))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestThreads))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestCulling))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestDecimation))
 
     return mysuite
\ No newline at end of file